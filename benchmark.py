@@ -0,0 +1,940 @@
+import argparse
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from data_loader import myDataSet
+from parameters import train_conf
+
+
+def timeIt(func, repeat):
+    '''
+    多次运行取最短耗时
+    :param func: 无参函数
+    :param repeat: 重复次数
+    :return: (最短耗时秒数, 最后一次的返回值)
+    '''
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def makeDataSet(conf, csv_source, **kwargs):
+    kwargs.setdefault("grid_search", conf.grid_search)
+    return myDataSet(csv_source=csv_source, need_col=conf.need_col, output_col=conf.output_col,
+                     grids_width=conf.grids_width, grids_height=conf.grids_height,
+                     meter_per_grid=conf.meter_per_grid, road=conf.road_name, long_term=conf.long_term, **kwargs)
+
+
+def legacySceneBuild(init_data, output_col):
+    '''
+    原iterrows+groupby逐行逐帧实现，仅作为对照
+    :return: [scenes, array(seq_length,vehicle_num,len(output_col))]
+    '''
+    _index = 0
+    zip_data = []
+    for index, row in init_data.iterrows():
+        if row['Vehicle_ID'] == "Vehicle_ID":
+            zip_data.append(init_data[_index:index])
+            _index = index + 1
+
+    scenes = []
+    for one_zip_data in zip_data:
+        time_zip_data = one_zip_data.groupby("Global_Time")
+        scenes.append(np.array([time_zip_data.get_group(time).loc[:, output_col].values.astype(float)
+                                for time in one_zip_data["Global_Time"].unique()]))
+    return scenes
+
+
+def benchSceneBuild(conf, csv_source, repeat):
+    '''
+    组切分+稠密化：原逐行实现 vs 向量化实现，并校验两者结果一致
+    '''
+    dataset = makeDataSet(conf, csv_source)
+    init_data = dataset.init_data
+
+    legacy_time, legacy_scenes = timeIt(lambda: legacySceneBuild(init_data, conf.output_col), repeat)
+    vector_time, vector_scenes = timeIt(lambda: dataset.cutTofinal(dataset.cutbyDelimiter(init_data)), repeat)
+
+    assert len(legacy_scenes) == len(vector_scenes)
+    for legacy, vector in zip(legacy_scenes, vector_scenes):
+        assert np.array_equal(legacy, vector)
+
+    print("scene build on {} ({} scenes)".format(csv_source, len(vector_scenes)))
+    print("  legacy iterrows/groupby: {:.4f}s".format(legacy_time))
+    print("  vectorized:              {:.4f}s  ({:.1f}x)".format(vector_time, legacy_time / vector_time))
+
+
+def benchCache(conf, csv_source, repeat):
+    '''
+    首次构建缓存 vs 命中缓存的加载耗时，缓存写在临时目录
+    '''
+    import tempfile
+    with tempfile.TemporaryDirectory() as cache_dir:
+        build_time, _ = timeIt(lambda: makeDataSet(conf, csv_source, cache_dir=cache_dir), 1)
+        load_time, _ = timeIt(lambda: makeDataSet(conf, csv_source, cache_dir=cache_dir), repeat)
+    print("dataset cache on {}".format(csv_source))
+    print("  build (parse+grids+write): {:.4f}s".format(build_time))
+    print("  load from cache:           {:.4f}s".format(load_time))
+
+
+def legacyGetGrid(dataset, x_seq):
+    '''
+    原itertools.combinations逐对实现，仅作为对照
+    :param x_seq: array(vehicle_num,input_size)
+    :return: array(vehicle_num,grids_height,grids_width)
+    '''
+    center_width = int(dataset.grids_width / 2)
+    center_height = int(dataset.grids_height / 2)
+    masks = np.zeros((x_seq.shape[0], dataset.grids_height, dataset.grids_width)) - 1
+    for vehicle_a, vehicle_b in itertools.combinations(list(range(x_seq.shape[0])), 2):
+        width_dist = int((x_seq[vehicle_a][dataset.col_seq["Local_X"]] - x_seq[vehicle_b][
+            dataset.col_seq["Local_X"]]) / dataset.meter_per_grid)
+        height_dist = int((x_seq[vehicle_a][dataset.col_seq["Local_Y"]] - x_seq[vehicle_b][
+            dataset.col_seq["Local_Y"]]) / dataset.meter_per_grid)
+        if abs(width_dist) > center_width or abs(height_dist) > center_height:
+            continue
+        masks[vehicle_b][center_height - height_dist][center_width + width_dist] = vehicle_a
+        masks[vehicle_a][center_height + height_dist][center_width - width_dist] = vehicle_b
+    return masks.astype(int)
+
+
+def randomScene(dataset, frames, vehicle_num, road_length, seed=0):
+    '''
+    随机生成一组车辆位置，road_length越小越拥挤，同格冲突越多
+    :return: array(frames,vehicle_num,len(output_col))
+    '''
+    rng = np.random.RandomState(seed)
+    scene = np.zeros((frames, vehicle_num, len(dataset.output_col)))
+    scene[..., dataset.col_seq["Local_X"]] = rng.uniform(0, dataset.road_info["max_Local_X"], (frames, vehicle_num))
+    scene[..., dataset.col_seq["Local_Y"]] = rng.uniform(0, road_length, (frames, vehicle_num))
+    return scene
+
+
+def benchGrid(conf, csv_source, repeat):
+    '''
+    grids计算：原逐对循环 vs 广播实现，真实数据与拥挤的随机数据上都校验逐位一致
+    '''
+    dataset = makeDataSet(conf, csv_source)
+    scenes = list(dataset.zip_data) + [randomScene(dataset, 20, 60, 40, seed=seed) for seed in range(3)]
+    for scene in scenes:
+        assert np.array_equal(np.array([legacyGetGrid(dataset, frame) for frame in scene]),
+                              dataset.getGrid(scene, from_df=0))
+
+    legacy_time, _ = timeIt(lambda: [[legacyGetGrid(dataset, frame) for frame in scene]
+                                     for scene in dataset.zip_data], repeat)
+    vector_time, _ = timeIt(lambda: [dataset.getGrid(scene, from_df=0) for scene in dataset.zip_data], repeat)
+    print("grids on {} ({} scenes, {} frames)".format(csv_source, len(dataset.zip_data),
+                                                       sum(len(scene) for scene in dataset.zip_data)))
+    print("  legacy combinations loop: {:.4f}s".format(legacy_time))
+    print("  broadcast per scene:      {:.4f}s  ({:.1f}x)".format(vector_time, legacy_time / vector_time))
+
+
+def benchGridSearch(conf, csv_source, repeat):
+    '''
+    pairwise vs sweep邻车搜索随车辆数的扩展性，车流密度固定(每米0.6辆，约5车道拥堵)，校验两者逐位一致
+    '''
+    pairwise = makeDataSet(conf, csv_source, grid_search="pairwise")
+    sweep = makeDataSet(conf, csv_source, grid_search="sweep")
+    for scene in pairwise.zip_data:
+        assert np.array_equal(pairwise.getGrid(scene, from_df=0), sweep.getGrid(scene, from_df=0))
+
+    print("grid search scaling (10 frames per scene)")
+    print("  {:>8} {:>12} {:>12} {:>8}".format("vehicles", "pairwise", "sweep", "speedup"))
+    for vehicle_num in [25, 50, 100, 200, 400, 800]:
+        scene = randomScene(pairwise, 10, vehicle_num, vehicle_num / 0.6, seed=vehicle_num)
+        pairwise_time, pairwise_grids = timeIt(lambda: pairwise.getGrid(scene, from_df=0), repeat)
+        sweep_time, sweep_grids = timeIt(lambda: sweep.getGrid(scene, from_df=0), repeat)
+        assert np.array_equal(pairwise_grids, sweep_grids)
+        print("  {:>8} {:>11.4f}s {:>11.4f}s {:>7.1f}x".format(vehicle_num, pairwise_time, sweep_time,
+                                                              pairwise_time / sweep_time))
+
+
+def benchGridMemory(conf, csv_source, repeat):
+    '''
+    每个样本grids的字节数：稠密-1掩码(int64返回、float32送入模型) vs 稀疏(frame,target,row,col,neighbor)索引
+    '''
+    dataset = makeDataSet(conf, csv_source)
+    dense, sparse, cells = 0, 0, 0
+    for item in range(len(dataset)):
+        x_seq_data, _, grids, _ = dataset[item]
+        dense += x_seq_data.shape[0] * x_seq_data.shape[1] * conf.grids_height * conf.grids_width
+        sparse += grids.nbytes
+        cells += len(grids)
+    samples = max(len(dataset), 1)
+    print("grid memory per sample on {} ({} samples)".format(csv_source, len(dataset)))
+    print("  occupied cells:        {:.1f} of {:.0f} ({:.2%})".format(cells / samples, dense / samples,
+                                                                     cells / max(dense, 1)))
+    print("  dense int64 masks:     {:.0f} bytes".format(dense * 8 / samples))
+    print("  dense float32 tensor:  {:.0f} bytes".format(dense * 4 / samples))
+    print("  sparse int16 indices:  {:.0f} bytes  ({:.1f}x smaller than float32)".format(
+        sparse / samples, dense * 4 / max(sparse, 1)))
+
+
+def benchPrecompute(conf, csv_source, repeat):
+    '''
+    逐次__getitem__实时计算 vs 构建时单进程/多进程预计算，以及预计算后一轮遍历的耗时
+    '''
+    import os
+    lazy = makeDataSet(conf, csv_source)
+    lazy_time, _ = timeIt(lambda: [lazy[item] for item in range(len(lazy))], repeat)
+    serial_time, _ = timeIt(lambda: lazy.precompute(workers=1), 1)
+    pool_time, _ = timeIt(lambda: lazy.precompute(workers=None), 1)
+    eager_time, _ = timeIt(lambda: [lazy[item] for item in range(len(lazy))], repeat)
+    print("precompute on {} ({} scenes)".format(csv_source, len(lazy)))
+    print("  lazy epoch (grids per __getitem__): {:.4f}s".format(lazy_time))
+    print("  build, 1 process:                   {:.4f}s".format(serial_time))
+    print("  build, {} processes:                 {:.4f}s".format(os.cpu_count(), pool_time))
+    print("  eager epoch (slicing only):         {:.4f}s".format(eager_time))
+    print("  memory footprint:                   {:.1f}MB".format(lazy.memoryFootprint() / 2 ** 20))
+
+
+def legacyNormalization(dataset, seq_data, col_seq):
+    '''
+    原逐帧逐车的one hot与车道处理、三次concatenate/delete实现，仅作为对照
+    :return: array(seq_length,vehicle_num,9) float64, (min_Local_Y,max_Local_Y)
+    '''
+    seq_data = seq_data.copy()
+    road_info = dataset.road_info
+    seq_data[:, :, col_seq['Local_X']] = seq_data[:, :, col_seq['Local_X']] / (road_info["max_Local_X"])
+    min_Local_Y, max_Local_Y = np.min(seq_data[:, :, col_seq['Local_Y']]), np.max(
+        seq_data[:, :, col_seq['Local_Y']]) + 20
+    seq_data[:, :, col_seq['Local_Y']] = (seq_data[:, :, col_seq['Local_Y']] - min_Local_Y) / (
+            max_Local_Y - min_Local_Y)
+    seq_data[:, :, col_seq["v_length"]] = (seq_data[:, :, col_seq["v_length"]] - road_info[
+        "min_v_length"]) / (road_info["max_v_length"] - road_info["min_v_length"])
+    seq_data[:, :, col_seq["v_Width"]] = (seq_data[:, :, col_seq["v_Width"]] - road_info[
+        "min_v_Width"]) / (road_info["max_v_Width"] - road_info["min_v_Width"])
+
+    v_Class = np.array([np.eye(3)[np.array(frame - 1, dtype=int)] for frame in seq_data[:, :, col_seq["v_Class"]]],
+                       dtype=int)
+    seq_data = np.concatenate([seq_data, v_Class], axis=2)
+
+    Lane_ID = np.array([[[0, 1] if one_vehicle == 1 else [1, 0] if one_vehicle == 5 else [1, 1]
+                         for one_vehicle in frame] for frame in seq_data[:, :, col_seq["Lane_ID"]]])
+    seq_data = np.concatenate([seq_data, Lane_ID], axis=2)
+    return np.delete(seq_data, [col_seq["v_Class"], col_seq["Lane_ID"]], axis=2), (min_Local_Y, max_Local_Y)
+
+
+def benchNormalization(conf, csv_source, repeat):
+    '''
+    归一化：原逐帧逐车循环 vs 查表+预分配输出，真实数据与较大的随机组上都校验与原结果转float32后逐位一致
+    '''
+    dataset = makeDataSet(conf, csv_source)
+    rng = np.random.RandomState(0)
+    big_scene = randomScene(dataset, 100, 200, 1000)
+    big_scene[..., dataset.col_seq["v_length"]] = rng.uniform(5, 20, big_scene.shape[:2])
+    big_scene[..., dataset.col_seq["v_Width"]] = rng.uniform(2, 8, big_scene.shape[:2])
+    big_scene[..., dataset.col_seq["v_Class"]] = rng.randint(1, 4, big_scene.shape[:2])
+    big_scene[..., dataset.col_seq["Lane_ID"]] = rng.randint(1, 9, big_scene.shape[:2])
+
+    for name, scenes in [(csv_source, list(dataset.zip_data)), ("random 100x200", [big_scene])]:
+        for scene in scenes:
+            legacy, legacy_Local_Y = legacyNormalization(dataset, scene, dataset.col_seq)
+            vector, Local_Y = dataset.normalization(scene, dataset.col_seq)
+            assert np.array_equal(legacy.astype(np.float32), vector) and legacy_Local_Y == Local_Y
+        legacy_time, _ = timeIt(lambda: [legacyNormalization(dataset, scene, dataset.col_seq)
+                                         for scene in scenes], repeat)
+        vector_time, _ = timeIt(lambda: [dataset.normalization(scene, dataset.col_seq) for scene in scenes], repeat)
+        print("normalization on {} ({} scenes)".format(name, len(scenes)))
+        print("  legacy per-frame loops: {:.4f}s".format(legacy_time))
+        print("  lookup tables:          {:.4f}s  ({:.1f}x)".format(vector_time, legacy_time / vector_time))
+
+
+def legacyBatchExec(x, y, grids, device):
+    '''
+    原batchExec逐个as_tensor转换类型，仅作为对照，hidden_state初始化两边相同故略去
+    '''
+    x = torch.as_tensor(torch.squeeze(x), dtype=torch.float32, device=device)
+    y = torch.as_tensor(torch.squeeze(y), dtype=torch.float32, device=device)
+    grids = torch.as_tensor(grids[0], dtype=torch.long, device=device)
+    return x, y, grids
+
+
+def allocatedBytes(func):
+    '''
+    用profiler统计func运行期间torch新分配的字节数，只累加各算子自身的分配，不重复计入嵌套调用
+    '''
+    from torch.profiler import ProfilerActivity, profile
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        func()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def benchSampleBytes(conf, csv_source, repeat):
+    '''
+    每个样本从__getitem__经default_collate到batchExec新分配的字节数(不含两边相同的hidden_state)
+    原流程：float64数组 -> collate成float64张量 -> batchExec转float32、grids转long
+    现流程：float32/int16张量视图 -> collateScenes -> batchExec只搬设备，grids在模型内转long
+    '''
+    from torch.utils.data.dataloader import default_collate
+    from data_loader import collateScenes
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    # 原数据集缓存的就是float64，转换放在计时外
+    legacy_samples = [tuple(item.numpy().astype(float) if item.is_floating_point() else item.numpy()
+                            for item in dataset[item][:3]) for item in range(len(dataset))]
+
+    def legacyStep(item):
+        legacyBatchExec(*default_collate([legacy_samples[item]]), device="cpu")
+
+    def currentStep(item):
+        # 同federated.batchExec，federated导入时就会开始训练，不能直接导入
+        x, y, grids, mask, _ = collateScenes([dataset[item]])
+        x, y, grids, mask = x.to("cpu"), y.to("cpu"), grids.to("cpu"), mask.to("cpu")
+        grids.long()  # 模型forward里的转换
+
+    legacy = sum(allocatedBytes(lambda: legacyStep(item)) for item in range(len(dataset)))
+    current = sum(allocatedBytes(lambda: currentStep(item)) for item in range(len(dataset)))
+    samples = max(len(dataset), 1)
+    print("bytes allocated per sample on {} ({} samples)".format(csv_source, len(dataset)))
+    print("  float64 dataset + batchExec conversion: {:.0f} bytes".format(legacy / samples))
+    print("  float32/int16 tensors, no conversion:   {:.0f} bytes  ({:.1f}x less)".format(
+        current / samples, legacy / max(current, 1)))
+    seq_bytes = sum(seq_data.nbytes for seq_data in dataset.cache["seq_data"])
+    print("  precomputed dataset memory:             {:.1f}MB (float64 features: {:.1f}MB)".format(
+        dataset.memoryFootprint() / 2 ** 20, (dataset.memoryFootprint() + seq_bytes) / 2 ** 20))
+
+
+def makeModel(conf, seed=0):
+    from model import VPTLSTM
+    torch.manual_seed(seed)
+    return VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
+                   output_size=conf.output_size, grids_width=conf.grids_width, grids_height=conf.grids_height,
+                   dropout_par=conf.dropout_par, device="cpu")
+
+
+def benchBatch(conf, csv_source, repeat):
+    '''
+    collateScenes补齐成batch后的吞吐量(组/秒)：训练一轮(前向+反向+Adam)与评估一轮(前向)
+    只取前16组，getSocialTensor逐格循环时训练很慢
+    '''
+    from torch.utils.data import Subset
+    from data_loader import makeDataLoader
+    from utils import lossCaculate
+    full = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    dataset = Subset(full, range(min(16, len(full))))
+    conf.num_workers, conf.batch_tokens = 0, None
+
+    def epoch(model, loader, optimizer=None):
+        for x, y, grids, mask, Local_Y in loader:
+            hidden_states = torch.zeros(x.shape[1], conf.rnn_size)
+            cell_states = torch.zeros(x.shape[1], conf.rnn_size)
+            if conf.long_term:
+                model.getFunction(full.getGrid, full.road_info, *Local_Y.unbind(1))
+            with torch.set_grad_enabled(optimizer is not None):
+                out = model(x, grids, hidden_states, cell_states, long_term=conf.long_term, mask=mask)
+                loss = lossCaculate(pred=out, true=y, conf=conf, mask=mask)
+            if optimizer is not None:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+    print("batched throughput on {} ({} scenes, long_term={})".format(csv_source, len(dataset), conf.long_term))
+    print("  {:>6} {:>14} {:>14} {:>10}".format("batch", "train scenes/s", "eval scenes/s", "padding"))
+    for batch_size in [1, 2, 4, 8]:
+        conf.batch_size = batch_size
+        loader = makeDataLoader(dataset, conf, shuffle=False)
+        padded = sum(mask.numel() for _, _, _, mask, _ in loader)
+        model = makeModel(conf)
+        optimizer = torch.optim.Adam(model.parameters())
+        train_time, _ = timeIt(lambda: epoch(model.train(), loader, optimizer), repeat)
+        eval_time, _ = timeIt(lambda: epoch(model.eval(), loader), repeat)
+        valid = sum(x.shape[1] for x, _, _, _ in dataset)
+        print("  {:>6} {:>14.1f} {:>14.1f} {:>9.1%}".format(batch_size, len(dataset) / train_time,
+                                                          len(dataset) / eval_time, 1 - valid / padded))
+
+
+def paddingWaste(shapes, batches):
+    '''
+    :return: 补齐后的车辆数*帧数中补齐部分的比例
+    '''
+    valid = sum(shapes[batch, 1].sum() * shapes[batch[0], 0] for batch in batches)
+    padded = sum(len(batch) * shapes[batch, 1].max() * shapes[batch[0], 0] for batch in batches)
+    return 1 - valid / padded
+
+
+def benchBucket(conf, csv_source, repeat):
+    '''
+    BucketBatchSampler vs 同样平均token数的随机batch：补齐比例、batch数与评估吞吐量(组/秒)
+    另在车辆数5~80均匀分布的模拟组上比较补齐比例
+    '''
+    from torch.utils.data import BatchSampler, RandomSampler
+    from data_loader import BucketBatchSampler, collateScenes
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    model = makeModel(conf).eval()
+
+    def randomBatches(shapes):
+        batch_size = max(1, round(conf.batch_tokens / shapes.prod(axis=1).mean()))
+        return list(BatchSampler(RandomSampler(range(len(shapes)), generator=torch.Generator().manual_seed(0)),
+                                 batch_size, drop_last=False))
+
+    def evalEpoch(batches):
+        for batch in batches:
+            x, y, grids, mask, Local_Y = collateScenes([dataset[item] for item in batch])
+            hidden_states = torch.zeros(x.shape[1], conf.rnn_size)
+            with torch.no_grad():
+                model(x, grids, hidden_states, hidden_states.clone(), mask=mask)
+
+    rng = np.random.RandomState(0)
+    synthetic = np.stack([np.full(2000, 99), rng.randint(5, 81, 2000)], axis=1)
+    for name, shapes in [(csv_source, dataset.sampleShapes()), ("synthetic 5-80 vehicles", synthetic)]:
+        bucket = BucketBatchSampler(shapes, conf.batch_tokens, bucket_width=conf.bucket_width, seed=0).planBatches()
+        random = randomBatches(shapes)
+        print("batching on {} ({} scenes, {} tokens per batch)".format(name, len(shapes), conf.batch_tokens))
+        print("  {:>8} {:>8} {:>9} {:>14}".format("", "batches", "padding", "eval scenes/s"))
+        for label, batches in [("random", random), ("bucket", bucket)]:
+            throughput = ""
+            if shapes is not synthetic:
+                eval_time, _ = timeIt(lambda: evalEpoch(batches), repeat)
+                throughput = "{:.1f}".format(len(shapes) / eval_time)
+            print("  {:>8} {:>8} {:>8.1%} {:>14}".format(label, len(batches), paddingWaste(shapes, batches),
+                                                         throughput))
+
+
+def repeatCsv(csv_source, copies, big_csv):
+    '''
+    源文件的各组重复copies次写到big_csv，模拟大文件
+    '''
+    with open(csv_source, "rb") as f:
+        header = f.readline()
+        body = f.read()
+    body = body[:body.rindex(b"\n" + header) + 1 + len(header)]  # 到最后一个分割行为止，之后的数据本就被丢弃
+    with open(big_csv, "wb") as f:
+        f.write(header + body * copies)
+
+
+def benchStream(conf, csv_source, repeat, copies=20):
+    '''
+    整体读入 vs 按块流式读取：遍历一遍全部样本的耗时与tracemalloc峰值内存
+    源文件的各组重复copies次写到临时文件，模拟大文件
+    '''
+    import os
+    import tempfile
+    import tracemalloc
+    from data_loader import myStreamDataSet
+
+    def peakMemory(func):
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, peak
+
+    def streamAll(**kwargs):
+        dataset = myStreamDataSet(csv_source=big_csv, need_col=conf.need_col, output_col=conf.output_col,
+                                  grids_width=conf.grids_width, grids_height=conf.grids_height,
+                                  meter_per_grid=conf.meter_per_grid, road=conf.road_name, long_term=conf.long_term,
+                                  grid_search=conf.grid_search, chunk_bytes=conf.stream_chunk_bytes, **kwargs)
+        return sum(1 for _ in dataset)
+
+    def loadAll():
+        dataset = makeDataSet(conf, big_csv, precompute=True, workers=1)
+        return sum(1 for item in range(len(dataset)) if dataset[item] is not None)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        big_csv = os.path.join(tmp_dir, "stream.csv")
+        repeatCsv(csv_source, copies, big_csv)
+        print("one pass over {} x{} ({:.1f}MB)".format(csv_source, copies, os.path.getsize(big_csv) / 2 ** 20))
+        for name, func in [("myDataSet (load all)", loadAll),
+                           ("stream, in order", lambda: streamAll(shuffle=False)),
+                           ("stream, shuffle {}".format(conf.stream_buffer),
+                            lambda: streamAll(buffer_scenes=conf.stream_buffer, seed=0))]:
+            seconds, count = timeIt(func, repeat)
+            _, peak = peakMemory(func)  # tracemalloc本身会拖慢运行，单独跑一次
+            print("  {:24s} {:.3f}s  {:.1f} scenes/s  peak {:.1f}MB".format(
+                name + ":", seconds, count / seconds, peak / 2 ** 20))
+
+
+def benchSceneIndex(conf, csv_source, repeat, copies=20):
+    '''
+    节点启动：解析整个文件 vs 按组索引只读本节点的1/copies组，源文件重复copies次模拟全局大文件
+    '''
+    import os
+    import tempfile
+    from data_loader import loadSceneIndex
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        big_csv = os.path.join(tmp_dir, "global.csv")
+        repeatCsv(csv_source, copies, big_csv)
+        index_time, index = timeIt(lambda: loadSceneIndex(big_csv), 1)  # 第一次建立，之后各节点直接读
+        shard = len(index["start"]) // copies
+        full_time, full = timeIt(lambda: makeDataSet(conf, big_csv), repeat)
+        print("node startup on {} x{} ({:.1f}MB, {} scenes)".format(
+            csv_source, copies, os.path.getsize(big_csv) / 2 ** 20, len(full)))
+        print("  build index once:         {:.3f}s".format(index_time))
+        print("  parse whole file:         {:.3f}s".format(full_time))
+        for name, scenes in [("first", range(shard)), ("last", range(len(full) - shard, len(full)))]:
+            shard_time, _ = timeIt(lambda: makeDataSet(conf, big_csv, scenes=scenes), repeat)
+            print("  {:5s} {} scenes by index: {:.3f}s  ({:.1f}x)".format(
+                name, shard, shard_time, full_time / shard_time))
+
+
+def loadInChild(conf, source, repeat, kwargs):
+    '''
+    在新进程中构建数据集，各次测量的峰值内存互不影响，pyarrow等不经过tracemalloc的分配也能统计到
+    :return: (最短耗时, 组数, 峰值RSS字节)；source为None时只统计空进程
+    '''
+    import resource
+    seconds, count = 0.0, 0
+    if source is not None:
+        seconds, dataset = timeIt(lambda: makeDataSet(conf, source, **kwargs), repeat)
+        count = len(dataset)
+    return seconds, count, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchParquet(conf, csv_source, repeat, copies=20):
+    '''
+    csv vs parquet后端：整体加载和只加载1/copies组的耗时与进程峰值内存，源文件重复copies次模拟大文件
+    '''
+    import multiprocessing
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from data_loader import convertToParquet, loadSceneIndex
+
+    def inChild(source, **kwargs):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            return pool.submit(loadInChild, conf, source, repeat, kwargs).result()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        big_csv = os.path.join(tmp_dir, "global.csv")
+        repeatCsv(csv_source, copies, big_csv)
+        scene_count = len(loadSceneIndex(big_csv)["start"])
+        convert_time, parquet_file = timeIt(lambda: convertToParquet(big_csv), 1)
+        shard = range(scene_count // copies)
+
+        _, _, base_rss = inChild(None)
+        print("csv vs parquet on {} x{} (csv {:.1f}MB, parquet {:.1f}MB, converted once in {:.2f}s)".format(
+            csv_source, copies, os.path.getsize(big_csv) / 2 ** 20, os.path.getsize(parquet_file) / 2 ** 20,
+            convert_time))
+        for name, source, kwargs in [("csv, all scenes", big_csv, {}),
+                                     ("parquet, all scenes", parquet_file, {}),
+                                     ("csv index, {} scenes".format(len(shard)), big_csv, {"scenes": shard}),
+                                     ("parquet, {} scenes".format(len(shard)), parquet_file, {"scenes": shard})]:
+            seconds, count, rss = inChild(source, **kwargs)
+            # 没超过导入各模块时的峰值则记为0
+            print("  {:24s} {:.3f}s  {} scenes  peak +{:.1f}MB".format(
+                name + ":", seconds, count, max(rss - base_rss, 0) / 2 ** 20))
+
+
+def syntheticNGSIM(path, vehicles, seconds, seed=0):
+    '''
+    生成原始NGSIM格式的随机轨迹：英尺、毫秒，10帧/秒，各车从Local_Y=0匀速驶过2200英尺的路段
+    另有十分之一的车在i-80路段上，切分时应被过滤
+    '''
+    rng = np.random.RandomState(seed)
+    enter = rng.randint(0, seconds * 10, vehicles)
+    speed = rng.uniform(15, 90, vehicles)  # 英尺/秒
+    total = np.ceil(2200 / speed * 10).astype(int)
+    vehicle = np.repeat(np.arange(1, vehicles + 1), total)
+    step = np.arange(total.sum()) - np.repeat(np.cumsum(total) - total, total)
+    frame = np.repeat(enter, total) + step
+    lane = np.repeat(rng.randint(1, 6, vehicles), total)
+    local_y = np.repeat(speed, total) * step / 10
+    local_x = lane * 12 - 6 + rng.normal(0, 0.3, len(step))
+    raw = pd.DataFrame({"Vehicle_ID": vehicle, "Frame_ID": frame, "Total_Frames": np.repeat(total, total),
+                        "Global_Time": 1118846980000 + frame * 100, "Local_X": local_x, "Local_Y": local_y,
+                        "Global_X": 6451000 + local_x, "Global_Y": 1872000 + local_y,
+                        "v_length": np.repeat(rng.uniform(9, 50, vehicles), total),
+                        "v_Width": np.repeat(rng.uniform(6, 8.5, vehicles), total),
+                        "v_Class": np.repeat(rng.randint(1, 4, vehicles), total),
+                        "v_Vel": np.repeat(speed, total), "v_Acc": 0.0, "Lane_ID": lane,
+                        "Location": np.where(np.repeat(rng.rand(vehicles) < 0.1, total), "i-80", "us-101")})
+    raw.to_csv(path, index=False)
+    return len(raw)
+
+
+def benchPreprocess(conf, csv_source, repeat, vehicles=2000, seconds=300):
+    '''
+    原始数据切分：随机生成5分钟的原始轨迹，单进程与多进程的行/s，切分结果用myDataSet加载校验
+    '''
+    import os
+    import tempfile
+    from data_execute import preprocess
+    from parameters import dataExecute_conf
+    execute_conf = dataExecute_conf()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        execute_conf.data_source = os.path.join(tmp_dir, "data.csv")
+        output = os.path.join(tmp_dir, "train.csv")
+        raw_rows = syntheticNGSIM(execute_conf.data_source, vehicles, seconds)
+        print("preprocess {} raw rows ({:.1f}MB)".format(raw_rows, os.path.getsize(execute_conf.data_source) / 2 ** 20))
+        for workers in sorted({1, os.cpu_count() or 1}):
+            seconds_used, stats = timeIt(lambda: preprocess(execute_conf, output, workers=workers), repeat)
+            print("  {} worker(s): {:.2f}s  {:.0f} rows/s  -> {} scenes, {} rows".format(
+                workers, seconds_used, stats["raw_rows"] / seconds_used, stats["scenes"], stats["rows"]))
+        dataset = makeDataSet(conf, output)
+        assert len(dataset) == stats["scenes"]
+
+
+def benchWindow(conf, csv_source, repeat, window=10, stride=1):
+    '''
+    滑动窗口样本：每个窗口复制成独立的组再算特征和grids vs 每组算一次、按(组序号,起始帧)切视图
+    '''
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1, window=window, window_stride=stride)
+
+    def materialize():
+        scenes = [dataset.zip_data[scene][offset:offset + window].copy() for scene, offset in dataset.window_index]
+        return [dataset.computeScene(scene) for scene in scenes]
+
+    legacy_time, legacy = timeIt(materialize, repeat)
+    build_time, _ = timeIt(lambda: dataset.precompute(workers=1), repeat)
+    legacy_bytes = sum(scene[0].nbytes + scene[1].nbytes for scene in legacy)
+    current_bytes = sum(array.nbytes for array in dataset.cache["seq_data"] + dataset.cache["grids"]) + \
+                    dataset.window_index.nbytes
+    sample_time, _ = timeIt(lambda: [dataset[item] for item in range(len(dataset))], repeat)
+    print("window={} stride={} on {} ({} scenes -> {} samples)".format(
+        window, stride, csv_source, len(dataset.zip_data), len(dataset)))
+    print("  copy every window:    {:.3f}s  {:.1f}MB".format(legacy_time, legacy_bytes / 2 ** 20))
+    print("  views into scenes:    {:.3f}s  {:.1f}MB  ({:.1f}x faster, {:.1f}x less memory)".format(
+        build_time, current_bytes / 2 ** 20, legacy_time / build_time, legacy_bytes / current_bytes))
+    print("  __getitem__ all samples: {:.3f}s".format(sample_time))
+
+
+def legacyDataMakeUp(model, stable_value, last_point):
+    '''
+    原dataMakeUp：每组把预测位置搬回numpy算grids再拷回设备，仅作为对照
+    '''
+    combine_data = torch.cat([last_point[:, 0:2], stable_value], dim=1)
+    turn_left = (combine_data[:, 0] * model.road_info["max_Local_X"] > model.road_info["lane_one_max"]).float()
+    turn_right = (combine_data[:, 0] * model.road_info["max_Local_X"] < model.road_info["lane_five_min"]).float()
+    combine_data = torch.cat([combine_data, turn_left[:, None], turn_right[:, None]], dim=1)
+
+    min_Local_Y = torch.as_tensor(model.min_Local_Y, dtype=torch.float64).reshape(-1, 1)
+    max_Local_Y = torch.as_tensor(model.max_Local_Y, dtype=torch.float64).reshape(-1, 1)
+    scene_num, vehicle_num = min_Local_Y.shape[0], last_point.shape[0] // min_Local_Y.shape[0]
+    last_point[:, 0] = last_point[:, 0] * model.road_info["max_Local_X"]
+    last_point[:, 1] = (last_point[:, 1].view(scene_num, vehicle_num) * (max_Local_Y - min_Local_Y).to(last_point)
+                        + min_Local_Y.to(last_point)).view(-1)
+    counts = [vehicle_num] * scene_num if model.mask is None else \
+        model.mask.view(scene_num, vehicle_num).sum(1).tolist()
+    grid = []
+    for scene, count in enumerate(counts):
+        one_point = last_point[scene * vehicle_num:scene * vehicle_num + count].detach().cpu().numpy()
+        one_grid = model.getGrid(one_point, from_df=0, sparse=True)
+        one_grid[:, [1, 4]] += scene * vehicle_num
+        grid.append(one_grid)
+    return combine_data, torch.as_tensor(np.concatenate(grid), device=model.device, dtype=torch.long)
+
+
+def benchRollout(conf, csv_source, repeat):
+    '''
+    长时预测每个预测步的耗时：原dataMakeUp逐组回到numpy算grids vs 整个batch在torch里算
+    同时给出整个前向里平均每个预测步的耗时，两种实现输出逐位一致
+    '''
+    from data_loader import collateScenes
+    conf.long_term = True
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    model = makeModel(conf).eval()
+    print("long-term rollout on {} (cpu)".format(csv_source))
+    print("  {:>6} {:>9} {:>18} {:>18} {:>18}".format("batch", "vehicles", "grids legacy ms", "grids torch ms",
+                                                       "forward/step ms"))
+    for batch_size in [1, 8, 32]:
+        x, y, grids, mask, Local_Y = collateScenes([dataset[item % len(dataset)] for item in range(batch_size)])
+        model.getFunction(dataset.getGrid, dataset.road_info, *Local_Y.unbind(1))
+        model.mask = mask.reshape(-1)
+        stable_value, last_point = x[0, :, 2:7], x[-1, :, :5]
+        legacy_time, (legacy_data, legacy_grid) = timeIt(
+            lambda: legacyDataMakeUp(model, stable_value, last_point.clone()), repeat * 10)
+        torch_time, (torch_data, torch_grid) = timeIt(
+            lambda: model.dataMakeUp(stable_value, last_point.clone()), repeat * 10)
+        assert torch.equal(legacy_data, torch_data) and torch.equal(legacy_grid, torch_grid)
+
+        hidden_states = torch.zeros(x.shape[1], conf.rnn_size)
+        with torch.no_grad():
+            forward_time, out = timeIt(lambda: model(x, grids, hidden_states, hidden_states.clone(), long_term=True,
+                                                     mask=mask), repeat)
+        print("  {:>6} {:>9} {:>18.3f} {:>18.3f} {:>18.2f}".format(
+            batch_size, int(mask.sum()), legacy_time * 1000, torch_time * 1000, forward_time / len(out) * 1000))
+
+
+def benchAugment(conf, csv_source, repeat):
+    '''
+    DataLoader一轮的吞吐量(组/秒)：不增强 vs 抖动、镜像、抽帧全开的BatchAugment
+    '''
+    from data_loader import makeDataLoader
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    conf.num_workers = 0
+    conf.augment, conf.augment_jitter, conf.augment_mirror, conf.augment_time_scales = True, 0.1, 0.5, [1, 2]
+    print("loader throughput with augmentation on {} ({} scenes)".format(csv_source, len(dataset)))
+    print("  {:>14} {:>14} {:>14} {:>16}".format("batching", "plain scenes/s", "augmented", "augment ms/batch"))
+    for name, batch_tokens in [("batch_size={}".format(conf.batch_size), None), ("tokens=8000", 8000),
+                               ("tokens=32000", 32000)]:
+        conf.batch_tokens = batch_tokens
+        plain = makeDataLoader(dataset, conf, augment=False)
+        augmented = makeDataLoader(dataset, conf, augment=True)
+        plain_time, batches = timeIt(lambda: [batch for batch in plain], repeat)
+        augment_time, _ = timeIt(lambda: [batch for batch in augmented], repeat)
+        print("  {:>14} {:>14.0f} {:>14.0f} {:>16.2f}".format(name, len(dataset) / plain_time,
+                                                            len(dataset) / augment_time,
+                                                            (augment_time - plain_time) / len(batches) * 1000))
+
+
+def legacyGetSocialTensor(model, one_frame_grids, hidden_states=None):
+    '''
+    原getSocialTensor逐个有车格子赋值，仅作为对照，参数同getSocialTensor
+    '''
+    hidden_states = model.hidden_states if hidden_states is None else hidden_states
+    social_tensor = hidden_states.new_zeros(hidden_states.shape[0], model.grids_height, model.grids_width,
+                                            model.rnn_size)
+    for one_grid in range(one_frame_grids.shape[0]):
+        target, row, col = one_frame_grids[one_grid, 1], one_frame_grids[one_grid, 2], one_frame_grids[one_grid, 3]
+        social_tensor[target][row][col] = hidden_states[target]
+    return social_tensor
+
+
+def benchFrameForward(conf, csv_source, repeat):
+    '''
+    frameForward每帧的耗时：getSocialTensor逐格赋值 vs 一次index_put_，前向与前向+反向
+    前向输出逐位一致，梯度只差累加顺序带来的舍入；逐格赋值的反向随格子数急剧变慢，batch只取到8
+    '''
+    from data_loader import collateScenes
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    model = makeModel(conf).eval()
+    print("frameForward on {} (cpu, per frame)".format(csv_source))
+    print("  {:>6} {:>9} {:>6} {:>12} {:>12} {:>18} {:>18}".format(
+        "batch", "vehicles", "cells", "loop fwd ms", "scatter ms", "loop fwd+bwd ms", "scatter fwd+bwd ms"))
+    for batch_size in [1, 4, 8]:
+        x, _, grids, mask, _ = collateScenes([dataset[item % len(dataset)] for item in range(batch_size)])
+        grids = grids.long()
+        frame_grids = grids[grids[:, 0] == 0]
+        hidden_states = torch.randn(x.shape[1], conf.rnn_size, requires_grad=True)
+
+        def step(backward):
+            model.hidden_states = hidden_states
+            model.cell_states = torch.zeros(x.shape[1], conf.rnn_size)
+            with torch.set_grad_enabled(backward):
+                output = model.frameForward(x[0], grid=frame_grids)
+            if backward:
+                hidden_states.grad = None
+                output.sum().backward()
+                return output, hidden_states.grad.clone()
+            return output, None
+
+        results = {}
+        for name, method in [("loop", lambda grid, hidden_states=None: legacyGetSocialTensor(model, grid, hidden_states)), ("scatter", None)]:
+            if method is not None:
+                model.getSocialTensor = method
+            forward_time, output = timeIt(lambda: step(False), repeat)
+            backward_time, (_, grad) = timeIt(lambda: step(True), repeat)
+            results[name] = (forward_time, backward_time, output[0], grad)
+            if method is not None:
+                del model.getSocialTensor
+        assert torch.equal(results["loop"][2], results["scatter"][2])
+        # 同一目标车多个格子的梯度累加顺序不同，只差浮点舍入
+        assert torch.allclose(results["loop"][3], results["scatter"][3], rtol=0, atol=1e-6)
+        print("  {:>6} {:>9} {:>6} {:>12.2f} {:>12.2f} {:>18.2f} {:>18.2f}".format(
+            batch_size, int(mask.sum()), len(frame_grids), results["loop"][0] * 1000, results["scatter"][0] * 1000,
+            results["loop"][1] * 1000, results["scatter"][1] * 1000))
+
+
+def benchSocialPooling(conf, csv_source, repeat):
+    '''
+    frameForward每帧的耗时：稠密social_tensor+卷积 vs 只算有车格子的sparseSocialConv，两者共用一份参数
+    '''
+    from data_loader import collateScenes
+    from model import VPTLSTM
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    models = {"dense": makeModel(conf).eval()}
+    models["sparse"] = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size,
+                               input_size=conf.input_size, output_size=conf.output_size,
+                               grids_width=conf.grids_width, grids_height=conf.grids_height,
+                               dropout_par=conf.dropout_par, device="cpu", social_pooling="sparse").eval()
+    models["sparse"].load_state_dict(models["dense"].state_dict())
+    print("social pooling on {} (cpu, per frame, rnn_size={})".format(csv_source, conf.rnn_size))
+    print("  {:>6} {:>9} {:>6} {:>10} {:>10} {:>15} {:>15} {:>9}".format(
+        "batch", "vehicles", "cells", "dense ms", "sparse ms", "dense fwd+bwd", "sparse fwd+bwd", "max diff"))
+    for batch_size in [1, 8, 32]:
+        x, _, grids, mask, _ = collateScenes([dataset[item % len(dataset)] for item in range(batch_size)])
+        grids = grids.long()
+        frame_grids = grids[grids[:, 0] == 0]
+        hidden_states = torch.randn(x.shape[1], conf.rnn_size, requires_grad=True)
+
+        def step(model, backward):
+            model.hidden_states, model.cell_states = hidden_states, torch.zeros(x.shape[1], conf.rnn_size)
+            with torch.set_grad_enabled(backward):
+                output = model.frameForward(x[0], grid=frame_grids)
+            if backward:
+                output.sum().backward()
+            return output.detach()
+
+        times = {}
+        for name, model in models.items():
+            times[name] = [timeIt(lambda: step(model, backward), repeat * 5) for backward in (False, True)]
+        diff = (times["dense"][0][1] - times["sparse"][0][1]).abs().max().item()
+        print("  {:>6} {:>9} {:>6} {:>10.2f} {:>10.2f} {:>15.2f} {:>15.2f} {:>9.1e}".format(
+            batch_size, int(mask.sum()), len(frame_grids), times["dense"][0][0] * 1000, times["sparse"][0][0] * 1000,
+            times["dense"][1][0] * 1000, times["sparse"][1][0] * 1000, diff))
+
+
+def benchSkipIsolated(conf, csv_source, repeat):
+    '''
+    frameForward每帧的耗时：所有车辆都经过social分支 vs skip_isolated只让有邻车的车辆经过卷积
+    sparse traffic只保留1/4车辆的格子，模拟车辆稀疏的路段
+    '''
+    from data_loader import collateScenes
+    from model import VPTLSTM
+    dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    models = {"all": makeModel(conf)}
+    models["skip"] = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size,
+                             input_size=conf.input_size, output_size=conf.output_size,
+                             grids_width=conf.grids_width, grids_height=conf.grids_height,
+                             dropout_par=conf.dropout_par, device="cpu", skip_isolated=True)
+    models["skip"].load_state_dict(models["all"].state_dict())
+    print("skip isolated vehicles on {} (cpu, per frame, rnn_size={})".format(csv_source, conf.rnn_size))
+    print("  {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>14} {:>14} {:>9}".format(
+        "traffic", "batch", "vehicles", "isolated", "all ms", "skip ms", "all train ms", "skip train ms",
+        "max diff"))
+    for traffic in ["full", "sparse"]:
+        for batch_size in [1, 8, 32]:
+            x, _, grids, mask, _ = collateScenes([dataset[item % len(dataset)] for item in range(batch_size)])
+            grids = grids.long()
+            frame_grids = grids[grids[:, 0] == 0]
+            if traffic == "sparse":
+                frame_grids = frame_grids[frame_grids[:, 1] % 4 == 0]
+            hidden_states = torch.randn(x.shape[1], conf.rnn_size, requires_grad=True)
+
+            def step(model, train):
+                model.train(train)
+                model.hidden_states, model.cell_states = hidden_states, torch.zeros(x.shape[1], conf.rnn_size)
+                model.mask = mask.reshape(-1)
+                with torch.set_grad_enabled(train):
+                    output = model.frameForward(x[0], grid=frame_grids)
+                if train:
+                    output.sum().backward()
+                return output.detach()
+
+            times = {}
+            for name, model in models.items():
+                times[name] = [timeIt(lambda: step(model, train), repeat * 5) for train in (False, True)]
+            diff = (times["all"][0][1] - times["skip"][0][1]).abs().max().item()
+            stats = models["skip"].socialStats(reset=True)
+            print("  {:>8} {:>6} {:>9} {:>8.0%} {:>9.2f} {:>9.2f} {:>14.2f} {:>14.2f} {:>9.1e}".format(
+                traffic, batch_size, int(mask.sum()), stats["skipped_ratio"], times["all"][0][0] * 1000,
+                times["skip"][0][0] * 1000, times["all"][1][0] * 1000, times["skip"][1][0] * 1000, diff))
+
+
+def benchPacked(conf, csv_source, repeat):
+    '''
+    多组一起前向的吞吐量(组/秒)：逐组循环 vs collateScenes补齐 vs collatePacked拼接，训练(前向+反向+Adam)与评估(前向)
+    组按固定种子打乱，batch内车辆数不一，补齐的车辆也要计算
+    '''
+    from data_loader import collatePacked, collateScenes
+    from utils import lossCaculate
+    full = makeDataSet(conf, csv_source, precompute=True, workers=1)
+    order = np.random.default_rng(0).permutation(len(full))[:16]
+    samples = [full[item] for item in order]
+
+    def epoch(model, batches, optimizer=None, packed=False):
+        for x, y, grids, layout, Local_Y in batches:
+            layout = {"offsets": layout} if packed else {"mask": layout}
+            hidden_states = torch.zeros(x.shape[1], conf.rnn_size)
+            cell_states = torch.zeros(x.shape[1], conf.rnn_size)
+            if conf.long_term:
+                model.getFunction(full.getGrid, full.road_info, *Local_Y.unbind(1))
+            with torch.set_grad_enabled(optimizer is not None):
+                out = model(x, grids, hidden_states, cell_states, long_term=conf.long_term, **layout)
+                loss = lossCaculate(pred=out, true=y, conf=conf, **layout)
+            if optimizer is not None:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+    print("multi-scene forward on {} ({} scenes, long_term={})".format(csv_source, len(samples), conf.long_term))
+    print("  {:>6} {:>8} {:>22} {:>22} {:>9}".format("batch", "mode", "train scenes/s", "eval scenes/s", "vehicles"))
+    serial = [collateScenes([sample]) for sample in samples]
+    model = makeModel(conf)
+    optimizer = torch.optim.Adam(model.parameters())
+    base = [len(samples) / timeIt(lambda: epoch(model.train(), serial, optimizer), repeat)[0],
+            len(samples) / timeIt(lambda: epoch(model.eval(), serial), repeat)[0]]
+    valid = sum(sample[0].shape[1] for sample in samples)
+    print("  {:>6} {:>8} {:>22.1f} {:>22.1f} {:>9}".format(1, "serial", base[0], base[1], valid))
+    for batch_size in [4, 8, 16]:
+        chunks = [samples[start:start + batch_size] for start in range(0, len(samples), batch_size)]
+        for mode, collate in [("padded", collateScenes), ("packed", collatePacked)]:
+            batches = [collate(chunk) for chunk in chunks]
+            train = len(samples) / timeIt(lambda: epoch(model.train(), batches, optimizer, mode == "packed"),
+                                          repeat)[0]
+            evaluate = len(samples) / timeIt(lambda: epoch(model.eval(), batches, packed=mode == "packed"), repeat)[0]
+            print("  {:>6} {:>8} {:>13.1f} ({:>4.1f}x) {:>13.1f} ({:>4.1f}x) {:>9}".format(
+                batch_size, mode, train, train / base[0], evaluate, evaluate / base[1],
+                sum(batch[0].shape[1] for batch in batches)))
+
+
+def benchStateless(conf, csv_source, repeat):
+    '''
+    评估一次前向的延迟：VPTLSTM vs StatelessVPTLSTM的eager、torch.jit.script、torch.compile(只编译frameStep)
+    编译和第一次运行的耗时单独列出，不计入延迟
+    '''
+    import copy
+    from data_loader import collateScenes
+    from model import StatelessVPTLSTM
+    print("stateless forward latency on {} (cpu, eval, no_grad)".format(csv_source))
+    print("  {:>5} {:>6} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}".format(
+        "mode", "batch", "eager ms", "func ms", "script ms", "compile ms", "compile s", "max diff"))
+    for long_term in [False, True]:
+        conf = copy.copy(conf)
+        conf.long_term = long_term
+        dataset = makeDataSet(conf, csv_source, precompute=True, workers=1)
+        model = makeModel(conf).eval()
+        stateless = StatelessVPTLSTM(model, dataset.road_info, conf.meter_per_grid).eval()
+        scripted = torch.jit.script(stateless)
+        # 逐帧循环留在python，只编译每帧的计算，grid的行数随帧变化
+        compiled = StatelessVPTLSTM(model, dataset.road_info, conf.meter_per_grid).eval()
+        compiled.frameStep = torch.compile(compiled.frameStep, dynamic=True)
+        for batch_size in [1, 8]:
+            x, _, grids, mask, Local_Y = collateScenes([dataset[item % len(dataset)] for item in range(batch_size)])
+            hidden_states = torch.zeros(x.shape[1], conf.rnn_size)
+            model.getFunction(dataset.getGrid, dataset.road_info, *Local_Y.unbind(1))
+            kwargs = {"long_term": long_term, "mask": mask}
+            functional = dict(kwargs, min_Local_Y=Local_Y[:, 0], max_Local_Y=Local_Y[:, 1])
+
+            with torch.no_grad():
+                eager_time, expected = timeIt(lambda: model(x, grids, hidden_states, hidden_states, **kwargs), repeat)
+                times, diff = [], 0.0
+                for net in (stateless, scripted, compiled):
+                    warmup_time, _ = timeIt(lambda: net(x, grids, hidden_states, hidden_states, **functional), 1)
+                    one_time, out = timeIt(lambda: net(x, grids, hidden_states, hidden_states, **functional), repeat)
+                    times.append(one_time)
+                    diff = max(diff, (out - expected).abs().max().item())
+            print("  {:>5} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f} {:>10.1e}".format(
+                "long" if long_term else "short", batch_size, eager_time * 1000, times[0] * 1000, times[1] * 1000,
+                times[2] * 1000, warmup_time, diff))
+
+
+BENCHMARKS = {
+    "scene": benchSceneBuild,
+    "cache": benchCache,
+    "grid": benchGrid,
+    "grid_search": benchGridSearch,
+    "grid_memory": benchGridMemory,
+    "precompute": benchPrecompute,
+    "normalization": benchNormalization,
+    "sample_bytes": benchSampleBytes,
+    "batch": benchBatch,
+    "bucket": benchBucket,
+    "stream": benchStream,
+    "scene_index": benchSceneIndex,
+    "parquet": benchParquet,
+    "preprocess": benchPreprocess,
+    "window": benchWindow,
+    "rollout": benchRollout,
+    "augment": benchAugment,
+    "frame_forward": benchFrameForward,
+    "social_pooling": benchSocialPooling,
+    "skip_isolated": benchSkipIsolated,
+    "packed": benchPacked,
+    "stateless": benchStateless,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="data_loader/model性能测试")
+    parser.add_argument("bench", choices=sorted(BENCHMARKS))
+    parser.add_argument("--csv", default=train_conf().test_csv_source)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](train_conf(), args.csv, args.repeat)
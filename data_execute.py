@@ -0,0 +1,215 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from parameters import dataExecute_conf
+
+# 输出列，与train.csv、test.csv的表头一致，行号列在最前
+OUTPUT_COL = ["Vehicle_ID", "Frame_ID", "Total_Frames", "Global_Time", "Local_X", "Local_Y", "Global_X", "Global_Y",
+              "v_length", "v_Width", "v_Class", "v_Vel", "Lane_ID", "Location"]
+# 原始数据以英尺为单位的列
+LENGTH_COL = ["Local_X", "Local_Y", "Global_X", "Global_Y", "v_length", "v_Width"]
+
+_worker_conf = None  # 切分子进程中的dataExecute_conf
+
+
+def _initWorker(conf):
+    global _worker_conf
+    _worker_conf = conf
+
+
+def _cutWindow(task):
+    return cutWindow(*task, conf=_worker_conf)
+
+
+def readRaw(conf):
+    '''
+    读取原始NGSIM数据，只保留conf.road路段，长度换算为米，Global_Time保持原始的毫秒
+    :param conf: dataExecute_conf
+    :return: df(rows,len(OUTPUT_COL))，去掉重复的(Vehicle_ID,Global_Time)后按(Global_Time,Vehicle_ID)排序
+    '''
+    raw = pd.read_csv(conf.data_source, usecols=conf.useCols)
+    raw = raw[raw["Location"] == conf.road].copy()
+    raw[LENGTH_COL] = raw[LENGTH_COL] * conf.meter_per_foot
+    # 不同时段的Frame_ID会重复，Global_Time在整个路段上唯一
+    raw = raw.drop_duplicates(["Vehicle_ID", "Global_Time"])
+    raw = raw.sort_values(["Global_Time", "Vehicle_ID"], kind="stable")
+    return raw[OUTPUT_COL].reset_index(drop=True)
+
+
+def frameIndex(global_time, conf):
+    '''
+    原始Global_Time(毫秒)换算为帧序号，只在切分时间窗口和找连续帧时使用，不写入输出
+    :return: array int64
+    '''
+    return np.asarray(global_time, dtype=np.int64) // conf.ms_per_frame
+
+
+def windowFrames(conf):
+    '''
+    :return: (每组帧数, 相邻两帧间隔的原始帧数)
+    '''
+    step = int(conf.stride)
+    return int(conf.time_length * 1000 / conf.ms_per_frame / step), step
+
+
+def segmentBounds(vehicle, frame):
+    '''
+    按(Vehicle_ID,帧)排序后，同一辆车连续的帧为一段
+    :return: (每行所在段的起点, 终点)，均为行序号，[start,end)
+    '''
+    new = np.ones(len(vehicle), dtype=bool)
+    new[1:] = (vehicle[1:] != vehicle[:-1]) | (frame[1:] != frame[:-1] + 1)
+    start = np.flatnonzero(new)
+    end = np.append(start[1:], len(vehicle))
+    seg = np.cumsum(new) - 1
+    return start[seg], end[seg]
+
+
+def denoise(window, conf):
+    '''
+    去掉原始帧间位移超过hist_dist米的车辆，再对Local_X、Local_Y做hist_time帧的居中滑动平均
+    :param window: df，按(Vehicle_ID,Global_Time)排序
+    :return: df，行的顺序不变
+    '''
+    vehicle, frame = window["Vehicle_ID"].values, frameIndex(window["Global_Time"].values, conf)
+    start, end = segmentBounds(vehicle, frame)
+    local_x, local_y = window["Local_X"].values, window["Local_Y"].values
+
+    jump = np.hypot(np.diff(local_x), np.diff(local_y)) > conf.hist_dist
+    jump &= start[1:] == start[:-1]  # 只看同一段内相邻的两帧
+    window = window[~np.isin(vehicle, vehicle[1:][jump])]
+
+    vehicle, frame = window["Vehicle_ID"].values, frameIndex(window["Global_Time"].values, conf)
+    start, end = segmentBounds(vehicle, frame)
+    rows = np.arange(len(window))
+    low = np.maximum(rows - conf.hist_time // 2, start)
+    high = np.minimum(rows + conf.hist_time - conf.hist_time // 2, end)
+    window = window.copy()
+    for col in ["Local_X", "Local_Y"]:
+        total = np.concatenate([[0], np.cumsum(window[col].values)])
+        window[col] = (total[high] - total[low]) / (high - low)
+    return window
+
+
+def cutWindow(window_start, window, conf):
+    '''
+    一个时间窗口内按area_step滑动的各个区域切出组
+    窗口内每隔stride帧取一帧，共time_length秒；首帧Local_Y落在[y0,y0+area_length)且每一帧都在的车为一组，
+    车辆数不少于need_num才保留
+    :param window_start: 窗口首帧的帧序号，见frameIndex
+    :param window: df，窗口内的原始数据，noise=True时前后各多带hist_time//2帧用于滑动平均
+    :param conf: dataExecute_conf
+    :return: (各组的csv字节，每组之后接一行分割行, 组数, 行数)
+    '''
+    frames, step = windowFrames(conf)
+    window = window.sort_values(["Vehicle_ID", "Global_Time"], kind="stable")
+    if conf.noise:
+        window = denoise(window, conf)
+
+    offset = frameIndex(window["Global_Time"].values, conf) - window_start
+    window = window[(offset >= 0) & (offset < frames * step) & (offset % step == 0)]
+    vehicle, counts = np.unique(window["Vehicle_ID"].values, return_counts=True)
+    window = window[np.isin(window["Vehicle_ID"].values, vehicle[counts == frames])]
+    if not len(window):
+        return b"", 0, 0
+
+    # 每frames行为一辆车，首帧的Local_Y决定所在区域
+    first_y = window["Local_Y"].values[::frames]
+    tiles = np.arange(np.floor(first_y.min() / conf.area_step) * conf.area_step, first_y.max() + 1e-9,
+                      conf.area_step)
+    inside = (first_y[None, :] >= tiles[:, None]) & (first_y[None, :] < tiles[:, None] + conf.area_length)
+
+    # Global_Time按csv_time_unit写出，与随附的train.csv、test.csv一致
+    window = window.assign(Global_Time=window["Global_Time"] / conf.csv_time_unit)
+    header = "," + ",".join(OUTPUT_COL) + "\n"
+    blocks, rows = [], 0
+    for one_inside in inside[inside.sum(axis=1) >= conf.need_num]:
+        scene = window.iloc[np.repeat(np.flatnonzero(one_inside) * frames, frames) + np.tile(np.arange(frames),
+                                                                                          one_inside.sum())]
+        blocks.append(scene.reset_index(drop=True).to_csv(header=False, lineterminator="\n") + header)
+        rows += len(scene)
+    return "".join(blocks).encode(), len(blocks), rows
+
+
+def cutWindows(tasks, conf, workers):
+    '''
+    按窗口顺序生成cutWindow的结果，边算边写，内存中只有正在处理的几个窗口
+    :param tasks: [(窗口首帧, 窗口内的原始数据)]
+    :param workers: 进程数，1为单进程
+    '''
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_initWorker, initargs=(conf,)) as pool:
+            yield from pool.imap(_cutWindow, tasks)
+    else:
+        for task in tasks:
+            yield cutWindow(*task, conf=conf)
+
+
+def preprocess(conf, output, workers=None):
+    '''
+    原始NGSIM数据切分为myDataSet使用的以表头分割的csv
+    按time_step秒滑动的时间窗口分给进程池，各窗口内再按area_step米滑动的区域切出组，结果按窗口顺序写出
+    先写临时文件再改名
+    :param conf: dataExecute_conf
+    :param output: 输出csv位置
+    :param workers: 进程数，None为CPU核数
+    :return: {"raw_rows","scenes","rows","seconds"}
+    '''
+    start_time = time.time()
+    raw = readRaw(conf)
+    read_time = time.time() - start_time
+
+    frames, step = windowFrames(conf)
+    margin = conf.hist_time // 2 if conf.noise else 0
+    frame = frameIndex(raw["Global_Time"].values, conf)
+    window_start = np.arange(frame.min(), frame.max() + 1, int(conf.time_step * 1000 / conf.ms_per_frame)) \
+        if len(raw) else np.zeros(0, dtype=np.int64)
+    low = np.searchsorted(frame, window_start - margin)
+    high = np.searchsorted(frame, window_start + (frames - 1) * step + margin, side="right")
+    tasks = [(int(one_start), raw.iloc[one_low:one_high]) for one_start, one_low, one_high in
+             zip(window_start, low, high) if one_high > one_low]
+
+    workers = max(min(workers or os.cpu_count() or 1, len(tasks)), 1)
+    tmp_file = "{}.{}.tmp".format(output, os.getpid())
+    scenes, rows = 0, 0
+    with open(tmp_file, "wb") as f:
+        f.write(("," + ",".join(OUTPUT_COL) + "\n").encode())
+        for block, one_scenes, one_rows in cutWindows(tasks, conf, workers):
+            f.write(block)
+            scenes, rows = scenes + one_scenes, rows + one_rows
+    os.replace(tmp_file, output)
+
+    seconds = time.time() - start_time
+    print("{}切分完成：原始{}行，{}个时间窗口，输出{}组{}行到{}".format(
+        conf.data_source, len(raw), len(tasks), scenes, rows, output))
+    print("读取{:.2f}s，共用时{:.2f}s，{}个进程，{:.0f}行/s".format(
+        read_time, seconds, workers, len(raw) / max(seconds, 1e-9)))
+    return {"raw_rows": len(raw), "scenes": scenes, "rows": rows, "seconds": seconds}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="原始NGSIM数据切分为myDataSet使用的csv")
+    parser.add_argument("--source", default=None, help="原始数据，默认dataExecute_conf.data_source")
+    parser.add_argument("--output", default=None, help="输出csv，默认dataExecute_conf.output")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认dataExecute_conf.workers")
+    parser.add_argument("--cache", action="store_true", help="切分后按train_conf预计算并写入myDataSet缓存")
+    args = parser.parse_args()
+
+    conf = dataExecute_conf()
+    conf.data_source = args.source or conf.data_source
+    output = args.output or conf.output
+    preprocess(conf, output, workers=args.workers or conf.workers)
+
+    if args.cache:
+        from data_loader import myDataSet
+        from parameters import train_conf
+        train = train_conf()
+        myDataSet(csv_source=output, need_col=train.need_col, output_col=train.output_col,
+                  grids_width=train.grids_width, grids_height=train.grids_height,
+                  meter_per_grid=train.meter_per_grid, road=train.road_name, long_term=train.long_term,
+                  cache_dir=train.cache_dir, grid_search=train.grid_search, workers=train.precompute_workers)
@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_loader import myDataSet
+from parameters import train_conf
+
+# road_info中各原始列的取值范围，(列, 下限键, 上限键)，下限键为None时为0
+ROAD_BOUNDS = [("Local_X", "min_Local_X", "max_Local_X"), ("Local_Y", None, "max_Local_Y"),
+               ("v_length", "min_v_length", "max_v_length"), ("v_Width", "min_v_Width", "max_v_Width"),
+               ("Lane_ID", None, "max_Lane_ID")]
+# normalization输出的9个特征
+FEATURES = ["local_x", "local_y", "v_length", "v_width", "motor", "auto", "truck", "turn_left", "turn_right"]
+
+
+def describe(values):
+    '''
+    :param values: array，一维
+    :return: {"count","mean","min","p50","p90","p99","max"}，空数组时只有count
+    '''
+    values = np.asarray(values, dtype=float).reshape(-1)
+    if not len(values):
+        return {"count": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"count": int(len(values)), "mean": float(values.mean()), "min": float(values.min()), "p50": float(p50),
+            "p90": float(p90), "p99": float(p99), "max": float(values.max())}
+
+
+def loadStages(dataset, csv_source, need_col, road, cache_dir=None):
+    '''
+    按myDataSet.__init__的步骤加载并计时：csv在cache_dir中有缓存时与训练一样从npz加载，否则分段解析源文件
+    :param dataset: 只初始化了参数的myDataSet
+    :return: (zip_data, [组数, (seq_data, grids, Local_Y)],
+              {"cache_key","cache_load"}或{"parse","split","grid","normalize"}秒数, 实际加载的文件)
+    '''
+    if cache_dir is not None and os.path.splitext(csv_source)[1] != ".parquet":
+        start = time.perf_counter()
+        cache_file = dataset.cacheFile(csv_source, cache_dir, need_col=need_col, road=road)
+        cache_key = time.perf_counter() - start
+        if os.path.exists(cache_file):
+            start = time.perf_counter()
+            dataset.loadCache(cache_file)
+            seconds = {"cache_key": cache_key, "cache_load": time.perf_counter() - start}
+            cache = dataset.cache
+            return dataset.zip_data, list(zip(cache["seq_data"], cache["grids"], map(tuple, cache["Local_Y"]))), \
+                   seconds, cache_file
+
+    seconds = {}
+    start = time.perf_counter()
+    if os.path.splitext(csv_source)[1] == ".parquet":
+        raw = dataset.readParquet(csv_source, need_col)
+        seconds["parse"] = time.perf_counter() - start
+        start = time.perf_counter()
+        zip_data = dataset.cutTofinal(raw)
+    else:
+        init_data = pd.read_csv(csv_source, usecols=need_col)
+        seconds["parse"] = time.perf_counter() - start
+        start = time.perf_counter()
+        zip_data = dataset.cutTofinal(dataset.cutbyDelimiter(init_data))
+    seconds["split"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grids = [dataset.getGrid(one_zip_data, from_df=0, sparse=True).astype(np.int16) for one_zip_data in zip_data]
+    seconds["grid"] = time.perf_counter() - start
+    start = time.perf_counter()
+    normalized = [dataset.normalization(one_zip_data, dataset.col_seq) for one_zip_data in zip_data]
+    seconds["normalize"] = time.perf_counter() - start
+    return zip_data, [(seq_data, one_grids, Local_Y) for (seq_data, Local_Y), one_grids in zip(normalized, grids)], \
+           seconds, csv_source
+
+
+def parseSeconds(dataset, csv_source, need_col):
+    '''
+    只计时解析源文件，不切分也不计算grids；从缓存加载时单独给出，便于与缓存对比
+    '''
+    start = time.perf_counter()
+    if os.path.splitext(csv_source)[1] == ".parquet":
+        dataset.readParquet(csv_source, need_col)
+    else:
+        pd.read_csv(csv_source, usecols=need_col)
+    return time.perf_counter() - start
+
+
+def windowPairs(dataset, one_zip_data):
+    '''
+    每帧落在格子窗口内的(目标车,邻车)对数，同一格子的多辆邻车都计入，与getGrid的筛选条件一致
+    用myDataSet.sweepPairs按Local_Y排序扫描出候选对，不构建每帧N²的距离矩阵
+    :return: array(seq_length,)
+    '''
+    frames, vehicle_num = one_zip_data.shape[:2]
+    local_x = one_zip_data[..., dataset.col_seq["Local_X"]].reshape(frames, vehicle_num)
+    local_y = one_zip_data[..., dataset.col_seq["Local_Y"]].reshape(frames, vehicle_num)
+    frame, target, neighbor = dataset.sweepPairs(local_y, (dataset.grids_height // 2 + 2) * dataset.meter_per_grid)
+    width_dist = np.trunc((local_x[frame, neighbor] - local_x[frame, target]) / dataset.meter_per_grid)
+    height_dist = np.trunc((local_y[frame, neighbor] - local_y[frame, target]) / dataset.meter_per_grid)
+    inside = (np.abs(width_dist) <= dataset.grids_width // 2) & (np.abs(height_dist) <= dataset.grids_height // 2)
+    return np.bincount(frame[inside], minlength=frames)
+
+
+def sceneStats(dataset, zip_data, computed):
+    '''
+    各组形状、每帧车辆数、每帧有车格子占比与窗口内车对数，按帧汇总
+    '''
+    shapes = np.array([one_zip_data.shape[:2] for one_zip_data in zip_data], dtype=np.int64).reshape(-1, 2)
+    frames, vehicles = shapes[:, 0], shapes[:, 1]
+    cells = dataset.grids_height * dataset.grids_width
+    occupied = np.concatenate([np.bincount(grids[:, 0].astype(np.int64), minlength=len(seq_data))
+                               for seq_data, grids, _ in computed]) if computed else np.zeros(0)
+    pairs = np.concatenate([windowPairs(dataset, one_zip_data) for one_zip_data in zip_data]) \
+        if zip_data else np.zeros(0)
+    frame_vehicles = np.repeat(vehicles, frames)
+    return {
+        "scenes": int(len(zip_data)),
+        "frames": int(frames.sum()),
+        "frames_per_scene": describe(frames),
+        "vehicles_per_scene": describe(vehicles),
+        "vehicles_per_frame": describe(frame_vehicles),
+        "vehicles_per_frame_histogram": {int(count): int(total) for count, total in
+                                         zip(*np.unique(frame_vehicles, return_counts=True))},
+        "occupied_cells_per_frame": describe(occupied),
+        # 每帧有车格子数/(车辆数*每辆车的格子数)
+        "occupied_cell_ratio_per_frame": describe(occupied / np.maximum(frame_vehicles * cells, 1)),
+        "window_pairs_per_frame": describe(pairs),
+        # 同一格子落入多辆邻车时只保留一辆，被覆盖的车对占比
+        "overwritten_pair_ratio": float(1 - occupied.sum() / pairs.sum()) if pairs.sum() else 0.0,
+    }
+
+
+def featureStats(dataset, zip_data, computed):
+    '''
+    原始列的取值范围与road_info对比，归一化后9个特征的取值范围
+    '''
+    rows = np.concatenate([one_zip_data.reshape(-1, one_zip_data.shape[-1]) for one_zip_data in zip_data]) \
+        if zip_data else np.zeros((0, len(dataset.output_col)))
+    raw = {}
+    for col, low_key, high_key in ROAD_BOUNDS:
+        if col not in dataset.col_seq:
+            continue
+        values = rows[:, dataset.col_seq[col]]
+        low, high = dataset.road_info[low_key] if low_key else 0, dataset.road_info[high_key]
+        raw[col] = dict(describe(values), bound_min=low, bound_max=high,
+                        outside_ratio=float(((values < low) | (values > high)).mean()) if len(values) else 0.0)
+
+    features = np.concatenate([seq_data.reshape(-1, seq_data.shape[-1]) for seq_data, _, _ in computed]) \
+        if computed else np.zeros((0, len(FEATURES)))
+    normalized = {name: dict(describe(features[:, seq]),
+                             outside_unit_ratio=float(((features[:, seq] < 0) | (features[:, seq] > 1)).mean())
+                             if len(features) else 0.0)
+                  for seq, name in enumerate(FEATURES)}
+    return {"raw": raw, "normalized": normalized}
+
+
+def datasetStats(conf, csv_source, parse=False):
+    '''
+    :param conf: train_conf，使用need_col、output_col、grids参数、road_name、cache_dir
+    :param csv_source: csv或parquet
+    :param parse: 从缓存加载时另外计时解析源文件
+    :return: 统计结果dict，可直接写成json
+    '''
+    dataset = myDataSet(None, conf.need_col, conf.output_col, conf.grids_width, conf.grids_height,
+                        conf.meter_per_grid, conf.road_name, long_term=conf.long_term, grid_search=conf.grid_search)
+    zip_data, computed, seconds, loaded = loadStages(dataset, csv_source, conf.need_col, conf.road_name,
+                                                     cache_dir=conf.cache_dir)
+    parse_seconds = parseSeconds(dataset, csv_source, conf.need_col) if parse and "cache_load" in seconds else None
+    memory = {"scene_bytes": int(sum(one_zip_data.nbytes for one_zip_data in zip_data)),
+              "feature_bytes": int(sum(seq_data.nbytes for seq_data, _, _ in computed)),
+              "grid_bytes": int(sum(grids.nbytes for _, grids, _ in computed))}
+    return {
+        "source": csv_source,
+        "source_bytes": os.path.getsize(csv_source),
+        "settings": {"grids_width": conf.grids_width, "grids_height": conf.grids_height,
+                     "meter_per_grid": conf.meter_per_grid, "road": conf.road_name, "grid_search": conf.grid_search},
+        "loaded_from": loaded,
+        "load_seconds": dict(seconds, total=sum(seconds.values())),
+        "source_parse_seconds": parse_seconds if parse_seconds is not None else seconds.get("parse"),
+        "memory": memory,
+        "scenes": sceneStats(dataset, zip_data, computed),
+        "features": featureStats(dataset, zip_data, computed),
+    }
+
+
+if __name__ == '__main__':
+    conf = train_conf()
+    parser = argparse.ArgumentParser(description="统计数据集的组、车辆、grids与特征分布及加载各步耗时，写为json")
+    parser.add_argument("--source", default=conf.train_csv_source, help="csv或parquet，默认train_conf.train_csv_source")
+    parser.add_argument("--output", default=None, help="json位置，默认与源文件同名的.stats.json")
+    parser.add_argument("--grid-search", choices=["pairwise", "sweep"], default=conf.grid_search)
+    parser.add_argument("--cache-dir", default=conf.cache_dir, help="myDataSet缓存目录，有缓存时从npz加载，默认train_conf.cache_dir")
+    parser.add_argument("--no-cache", action="store_true", help="不使用缓存，分段解析源文件")
+    parser.add_argument("--parse", action="store_true", help="从缓存加载时另外计时解析源文件")
+    args = parser.parse_args()
+
+    conf.grid_search = args.grid_search
+    conf.cache_dir = None if args.no_cache else args.cache_dir
+    stats = datasetStats(conf, args.source, parse=args.parse)
+    output = args.output or os.path.splitext(args.source)[0] + ".stats.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(stats, f, ensure_ascii=False, indent=2)
+
+    scenes, seconds = stats["scenes"], stats["load_seconds"]
+    print("{}：{}组{}帧，每帧车辆数中位数{:.0f}、最大{:.0f}，有车格子占比中位数{:.3f}".format(
+        args.source, scenes["scenes"], scenes["frames"], scenes["vehicles_per_frame"].get("p50", 0),
+        scenes["vehicles_per_frame"].get("max", 0), scenes["occupied_cell_ratio_per_frame"].get("p50", 0)))
+    if "cache_load" in seconds:
+        print("从缓存{}加载：校验源文件{:.2f}s，读取npz{:.2f}s".format(stats["loaded_from"], seconds["cache_key"],
+                                                              seconds["cache_load"]))
+        if stats["source_parse_seconds"] is not None:
+            print("解析源文件{:.2f}s".format(stats["source_parse_seconds"]))
+    else:
+        print("加载耗时：解析{parse:.2f}s，切分{split:.2f}s，grids{grid:.2f}s，归一化{normalize:.2f}s".format(**seconds))
+    print("统计结果已写入{}".format(output))
@@ -3,7 +3,7 @@ from model import VPTLSTM
 from parameters import train_conf
 import copy
 # from utils import  get_NGSIM
-from data_loader import myDataSet
+from data_loader import makeDataLoader, myDataSet
 import os
 import csv
 from utils import myError, lrDecline, optimizerChoose, lossCaculate
@@ -109,20 +109,23 @@ def FL():
     model_1=VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
                           output_size=conf.output_size,
                           grids_width=conf.grids_width, grids_height=conf.grids_height, dropout_par=conf.dropout_par,
-                          device=device).to(device)
+                          device=device, social_pooling=conf.social_pooling,
+                          skip_isolated=conf.skip_isolated).to(device)
     model_2 = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
                     output_size=conf.output_size,
                     grids_width=conf.grids_width, grids_height=conf.grids_height, dropout_par=conf.dropout_par,
-                    device=device).to(device)
+                    device=device, social_pooling=conf.social_pooling,
+                          skip_isolated=conf.skip_isolated).to(device)
     model_global = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
                       output_size=conf.output_size,
                       grids_width=conf.grids_width, grids_height=conf.grids_height, dropout_par=conf.dropout_par,
-                      device=device).to(device)
+                      device=device, social_pooling=conf.social_pooling,
+                          skip_isolated=conf.skip_isolated).to(device)
     # read_dir.append()
     # Parameters
     dataDir = os.getenv('DATA_DIR', './data')
     test_dataset = loadData(dataDir)
-    testLoader = torch.utils.data.DataLoader(test_dataset, batch_size=1, shuffle=True)
+    testLoader = makeDataLoader(test_dataset, conf)
     read_dir_1 = "./ws-mnist-keras/node1/model/"
     read_dir_2 = "./ws2-mnist-pytorch/node2/model/"
     # save_dir = "C:/Users/18810/Desktop/FL/net_global.pkl"
@@ -287,7 +290,9 @@ def loadData(dataDir):
 
     test_data = myDataSet(csv_source=conf.test_csv_source, need_col=conf.need_col, output_col=conf.output_col,
                                grids_width=conf.grids_width, grids_height=conf.grids_height,
-                               meter_per_grid=conf.meter_per_grid, road=conf.road_name, long_term=conf.long_term)
+                               meter_per_grid=conf.meter_per_grid, road=conf.road_name, long_term=conf.long_term,
+                               cache_dir=conf.cache_dir, grid_search=conf.grid_search,
+                               precompute=conf.precompute, workers=conf.precompute_workers)
     # train_data_length, test_data_length = train_data.__len__(), test_data.__len__()
     print("loading down")
     return test_data
@@ -309,16 +314,18 @@ def get_weights(w,weight):
         w_avg[key] = torch.div(w_avg[key], len(w))
     return w_avg
 
-def batchExec(x, y, grids, conf, device):
-    x = torch.as_tensor(torch.squeeze(x), dtype=torch.float32, device=device)
-    y = torch.as_tensor(torch.squeeze(y), dtype=torch.float32, device=device)
-    grids = torch.as_tensor(torch.squeeze(grids), dtype=torch.float32, device=device)
+def batchExec(x, y, grids, mask, conf, device):
+    # collateScenes已把各组沿车辆维补齐拼好，这里只搬设备不转类型
+    x = x.to(device)  # [seq_length,batch*vehicle_num,9]
+    y = y.to(device)
+    grids = grids.to(device)  # 稀疏索引[K,5]
+    mask = mask.to(device)  # 有效车辆[batch,vehicle_num]
 
     # hidden_state
     vehicle_num = x.shape[1]
     hidden_states = torch.zeros(vehicle_num, conf.rnn_size, device=device)
     cell_states = torch.zeros(vehicle_num, conf.rnn_size, device=device)
-    return x, y, grids, hidden_states, cell_states
+    return x, y, grids, mask, hidden_states, cell_states
 
 def test(model, device, testLoader,test_data,conf):
     model.eval()
@@ -327,29 +334,29 @@ def test(model, device, testLoader,test_data,conf):
     all_distance=[]
     acc_count=0
     with torch.no_grad():
-        for test_x, test_y, test_grids in (testLoader):
-            test_x, test_y, test_grids, hidden_states, cell_states = batchExec(x=test_x, y=test_y,
-                                                                                    grids=test_grids, conf=conf,device=device)
+        for test_x, test_y, test_grids, test_mask, test_Local_Y in (testLoader):
+            min_Local_Y, max_Local_Y = test_Local_Y.to(device).unbind(1)  # 各组反归一化参数，随样本返回
+            test_x, test_y, test_grids, test_mask, hidden_states, cell_states = batchExec(
+                x=test_x, y=test_y, grids=test_grids, mask=test_mask, conf=conf, device=device)
             if conf.long_term:
                 model.getFunction(getGrid=test_data.getGrid, road_info=test_data.road_info,
-                                     min_Local_Y=test_data.min_Local_Y, max_Local_Y=test_data.max_Local_Y)
+                                     min_Local_Y=min_Local_Y, max_Local_Y=max_Local_Y)
             out = model(x_seq=test_x, grids=test_grids, hidden_states=hidden_states, cell_states=cell_states,
-                           long_term=conf.long_term)
-            loss = lossCaculate(pred=out, true=test_y, conf=conf)
+                           long_term=conf.long_term, mask=test_mask)
+            loss = lossCaculate(pred=out, true=test_y, conf=conf, mask=test_mask)
             # test_loss_batches.append(loss.item())
             # testLoss+=loss
             #
             # loss = lossCaculate(pred=outputs, true=labels, conf=conf)
             loss += loss.item()
-            pred_x, pred_y = out[9, 0, 0] * 24, out[9, 0, 1] * (
-                        test_data.max_Local_Y - test_data.min_Local_Y) + test_data.min_Local_Y
-            true_x, true_y = test_x[9, 0, 0] * 24, test_x[9, 0, 1] * (
-                        test_data.max_Local_Y - test_data.min_Local_Y) + test_data.min_Local_Y
+            first = torch.arange(test_mask.shape[0], device=device) * test_mask.shape[1]  # 每组的第0辆车
+            pred_x, pred_y = out[9, first, 0] * 24, out[9, first, 1] * (
+                        max_Local_Y - min_Local_Y) + min_Local_Y
+            true_x, true_y = test_x[9, first, 0] * 24, test_x[9, first, 1] * (
+                        max_Local_Y - min_Local_Y) + min_Local_Y
             distance = ((true_y - pred_y) ** 2 + (true_x - pred_x) ** 2) ** 0.5
-
-            if distance < 10:
-                acc_count += 1
-            all_distance.append(distance)
+            acc_count += int((distance < 10).sum())
+            all_distance.extend(distance.tolist())
 
         # for data, target in testLoader:
         #     data, target = data.to(device), target.to(device)
@@ -1,12 +1,20 @@
+from typing import List, Optional
+
 import torch
 import torch.nn.modules as nn
-import numpy as np
+
+from social_grid import pairwiseGrid
 
 
 class VPTLSTM(nn.Module):
 
     def __init__(self, rnn_size, embedding_size, input_size, output_size, grids_width, grids_height, dropout_par,
-                 device):
+                 device, social_pooling="dense", skip_isolated=False):
+        '''
+        social_pooling: social_tensor_conv1的计算方式，"dense"先填满social_tensor再卷积；
+                        "sparse"只对有车格子乘以对应的卷积核切片，见sparseSocialConv。两者参数相同，checkpoint可互换
+        skip_isolated: 格子窗口内没有邻车的车辆不经过social分支的卷积，见socialEmbed
+        '''
 
         super(VPTLSTM, self).__init__()
         ######参数初始化##########
@@ -18,6 +26,12 @@ class VPTLSTM(nn.Module):
         self.grids_width = grids_width
         self.grids_height = grids_height
         self.dropout_par = dropout_par
+        if social_pooling not in ("dense", "sparse"):
+            raise ValueError("social_pooling只能为dense或sparse")
+        self.social_pooling = social_pooling
+        self.skip_isolated = skip_isolated
+        self.isolated_cache = None  # (参数版本, 没有邻车时social分支的输出)
+        self.social_counts = {"frames": 0, "empty_frames": 0, "vehicles": 0, "isolated": 0}
 
         ############网络层初始化###############
         # 输入embeded_input,hidden_states
@@ -40,16 +54,22 @@ class VPTLSTM(nn.Module):
 
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(self.dropout_par)
+        self.mask = None
+        self.offsets = None
 
-    def forward(self, x_seq, grids, hidden_states, cell_states, long_term=False):
+    def forward(self, x_seq, grids, hidden_states, cell_states, long_term=False, mask=None, offsets=None):
         '''
         模型前向传播
         params:
         x_seq: 输入的一组数据tensor(seq_len=99,vehicle_num=26,input_size=9)
-        grids: 相关性判断矩阵tensor(99,26,39,5)
+        grids: 有车格子的稀疏索引tensor(K,5)，每行(frame,target,row,col,neighbor)，按frame有序
         hidden_states: 隐藏状态，tensor(vehicle_num=26,rnn_size=128)
         cell_states: 记忆胞元，tensor(vehicle_num=26,rnn_size=128)
         long_term:长时预测模式
+        mask: 多组数据补齐成batch时的有效车辆tensor(batch,vehicle_num) bool，见data_loader.collateScenes
+              此时x_seq的车辆维为batch*vehicle_num，补齐车辆的输出置0；None为单组数据
+        offsets: 多组数据不补齐、直接拼接成batch时各组车辆的起点tensor(batch+1,)，见data_loader.collatePacked
+                 第b组为[offsets[b],offsets[b+1])，不能与mask同时使用
 
         return:
         long_term=0:
@@ -58,9 +78,15 @@ class VPTLSTM(nn.Module):
         未来5秒预测
         '''
         self.x_seq = x_seq  # [seq_len=99,vehicle_num=26,input_size=9]
-        self.grids = grids  # [seq_len=99,vehicle_num=26,grids_height=39,grid_width=5]
+        grids = grids.long()  # 数据集给出int16，搬到设备后再转为索引用的long
+        # 按frame切成每帧一段[k,5]
+        self.grids = torch.split(grids, torch.bincount(grids[:, 0], minlength=x_seq.shape[0]).tolist())
         self.hidden_states = hidden_states  # [vehicle_num=26,rnn_size=128]
         self.cell_states = cell_states  # [vehicle_num=26,rnn_size=128]
+        if mask is not None and offsets is not None:
+            raise ValueError("mask和offsets不能同时使用")
+        self.mask = None if mask is None else mask.reshape(-1)
+        self.offsets = None if offsets is None else torch.as_tensor(offsets, dtype=torch.long, device=x_seq.device)
 
         if not long_term:
             outputs = []
@@ -86,30 +112,16 @@ class VPTLSTM(nn.Module):
         '''
         一帧正向传播，更新hidden_state和cell_state,返回下一个点预测结果
         输入：frame：tensor(vehicle_num=26,vec=9)
+             grid：tensor(k,5) 该帧有车格子的稀疏索引
         输出：output：tensor(vehicle_num=26,vec=5)
         vec=[mx,my,sx,sy,corr]
         '''
-        # 得到social_tensor:  tensor(vehicle_num=26,girds_height=39,grids_width=5,rnn_size=128)
-        social_tensor = self.getSocialTensor(grid)
-
         # Embed inputs
         # 输入(vehicle_num,input_size),输出(vehicle_num,embedding_size=64)
         input_embedded = self.dropout(self.relu(self.input_embedding_layer(frame)))
 
-        # Social_tensor的运算
-        # 输入tensor(vehicle_num=26,rnn_size=128,girds_height=39,grids_width=5)，
-        # 输出tensor(vehicle_num=26,rnn_size=128/2,girds_height=39-6,grids_width=5-2)
-        social_tensor = social_tensor.permute(0, 3, 1, 2)
-        tensor_embedded = self.dropout(self.relu(self.social_tensor_conv1(social_tensor)))
-
-        # 输入tensor(vehicle_num=26,rnn_size=128/2,girds_height=39-6,grids_width=5-2)
-        # 输出tensor(vehicle_num=26,rnn_size=128/4,girds_height=39-12,grids_width=5-4)
-        tensor_embedded = self.dropout(self.relu(self.social_tensor_conv2(tensor_embedded)))
-
-        # 输入tensor(vehicle_num=26,rnn_size=128/4,girds_height=39-12,grids_width=5-4)
-        # 打平到tensor(vehicle_num=26,-1)
-        # 全连接得到tensor(26,embeding_size)
-        tensor_embedded = self.dropout(self.relu(self.social_tensor_embed(torch.flatten(tensor_embedded, 1))))
+        # Social_tensor的运算，输出tensor(vehicle_num=26,embeding_size)
+        tensor_embedded = self.socialEmbed(grid)
 
         # 拼接embed后的input和social_tensor  #输入2个(vehicle_num,embedding_size=64)输出(vehicle_num,2*embedding_size)
         concat_embedded = torch.cat((input_embedded, tensor_embedded), 1)
@@ -122,31 +134,190 @@ class VPTLSTM(nn.Module):
         # 输入[vehicle_num,rnn_size],输出[vehicle_num,output_size]
         # output=self.sigmoid(self.output_layer(self.hidden_states))
         output = self.output_layer(self.hidden_states)
+        if self.mask is not None:
+            output = output.masked_fill(~self.mask[:, None], 0)
 
         return output
 
-    def getSocialTensor(self, one_frame_grids):
+    def socialEmbed(self, grid):
+        '''
+        social分支：social_tensor经两层卷积和全连接得到每辆车的嵌入
+        skip_isolated时格子窗口内没有邻车的车辆social_tensor全为0，第一层卷积的输出就是偏置，只对有邻车的车辆做卷积：
+            训练且dropout生效时各车辆的dropout不同，只省去第一层卷积；
+            否则没有邻车的车辆直接使用isolatedEmbedding，整个分支只对有邻车的车辆计算
+        :param grid: tensor(k,5) 该帧有车格子的稀疏索引
+        :return: tensor(vehicle_num,embedding_size)
         '''
+        if not self.skip_isolated:
+            return self.socialBranch(self.socialConv1(grid, self.hidden_states))
+
+        vehicle_num = self.hidden_states.shape[0]
+        has_neighbor = torch.zeros(vehicle_num, dtype=torch.bool, device=grid.device)
+        has_neighbor[grid[:, 1]] = True
+        self.countSocial(has_neighbor)
+        index = torch.nonzero(has_neighbor).squeeze(1)
+        conv1 = None
+        if len(index):
+            # grids的target换成在有邻车车辆中的序号
+            position = torch.cumsum(has_neighbor, 0) - 1
+            sub_grid = torch.cat([grid[:, :1], position[grid[:, 1:2]], grid[:, 2:]], dim=1)
+            conv1 = self.socialConv1(sub_grid, self.hidden_states[index])
 
-        :param one_frame_grids: 一帧的相关性判断矩阵tensor(vehicle_num=26,grids_height=39,grids_width=5)，没车默认-1
+        if self.training and self.dropout.p > 0:
+            out_height, out_width = self.conv1OutputSize()
+            tensor_embedded = self.social_tensor_conv1.bias.view(1, -1, 1, 1).expand(vehicle_num, -1, out_height,
+                                                                                     out_width)
+            if conv1 is not None:
+                tensor_embedded = tensor_embedded.index_put((index,), conv1)
+            return self.socialBranch(tensor_embedded)
+
+        tensor_embedded = self.isolatedEmbedding().expand(vehicle_num, -1)
+        if conv1 is not None:
+            tensor_embedded = tensor_embedded.index_put((index,), self.socialBranch(conv1))
+        return tensor_embedded
+
+    def socialConv1(self, grid, hidden_states):
+        '''
+        按social_pooling计算第一层卷积
+        :param grid: tensor(k,5) 有车格子的稀疏索引，target为hidden_states中的序号
+        :param hidden_states: tensor(vehicle_num,rnn_size)
+        :return: tensor(vehicle_num,rnn_size/2,out_height,out_width)，未经激活
+        '''
+        if self.social_pooling == "sparse":
+            return self.sparseSocialConv(grid, hidden_states)
+        # 得到social_tensor:  tensor(vehicle_num=26,girds_height=39,grids_width=5,rnn_size=128)
+        social_tensor = self.getSocialTensor(grid, hidden_states).permute(0, 3, 1, 2)
+        return self.social_tensor_conv1(social_tensor)
+
+    def socialBranch(self, tensor_embedded):
+        '''
+        第一层卷积之后的social分支
+        :param tensor_embedded: tensor(vehicle_num,rnn_size/2,out_height,out_width) 第一层卷积的输出，未经激活
+        :return: tensor(vehicle_num,embedding_size)
+        '''
+        # 输入tensor(vehicle_num=26,rnn_size=128,girds_height=39,grids_width=5)，
+        # 输出tensor(vehicle_num=26,rnn_size=128/2,girds_height=39-6,grids_width=5-2)
+        tensor_embedded = self.dropout(self.relu(tensor_embedded))
+
+        # 输入tensor(vehicle_num=26,rnn_size=128/2,girds_height=39-6,grids_width=5-2)
+        # 输出tensor(vehicle_num=26,rnn_size=128/4,girds_height=39-12,grids_width=5-4)
+        tensor_embedded = self.dropout(self.relu(self.social_tensor_conv2(tensor_embedded)))
+
+        # 输入tensor(vehicle_num=26,rnn_size=128/4,girds_height=39-12,grids_width=5-4)
+        # 打平到tensor(vehicle_num=26,-1)
+        # 全连接得到tensor(26,embeding_size)
+        return self.dropout(self.relu(self.social_tensor_embed(torch.flatten(tensor_embedded, 1))))
+
+    def isolatedEmbedding(self):
+        '''
+        没有邻车即social_tensor全为0时social分支的输出，只在dropout不生效时是常量
+        需要梯度时每次重新计算一辆车的量，梯度照常传到各层偏置和权重；
+        不需要梯度时缓存，参数被优化器更新、load_state_dict或搬到其它设备后才重新计算
+        :return: tensor(1,embedding_size)
+        '''
+        out_height, out_width = self.conv1OutputSize()
+        bias = self.social_tensor_conv1.bias.view(1, -1, 1, 1).expand(1, -1, out_height, out_width)
+        if torch.is_grad_enabled():
+            return self.socialBranch(bias)
+        parameters = [self.social_tensor_conv1.bias, self.social_tensor_conv2.weight, self.social_tensor_conv2.bias,
+                      self.social_tensor_embed.weight, self.social_tensor_embed.bias]
+        version = tuple((parameter.data_ptr(), parameter._version) for parameter in parameters)
+        if self.isolated_cache is None or self.isolated_cache[0] != version:
+            self.isolated_cache = (version, self.socialBranch(bias))
+        return self.isolated_cache[1]
+
+    def countSocial(self, has_neighbor):
+        '''
+        累计social分支跳过的车辆帧数，补齐的车辆不计；只统计训练，eval时的前向不计入
+        计数留在设备上累加，每帧不与主机同步，socialStats取出时才转为整数
+        :param has_neighbor: tensor(vehicle_num,) bool 该帧格子窗口内有邻车的车辆
+        '''
+        if not self.training:
+            return
+        valid = has_neighbor.new_ones(has_neighbor.shape) if self.mask is None else self.mask
+        self.social_counts["frames"] += 1
+        self.social_counts["empty_frames"] = self.social_counts["empty_frames"] + (~has_neighbor.any()).long()
+        self.social_counts["vehicles"] = self.social_counts["vehicles"] + valid.sum()
+        self.social_counts["isolated"] = self.social_counts["isolated"] + (valid & ~has_neighbor).sum()
+
+    def socialStats(self, reset=False):
+        '''
+        :param reset: 取出后清零，如每轮训练开始时
+        :return: {"frames","empty_frames","vehicles","isolated","skipped_ratio"}，skip_isolated时训练中累计的social分支跳过情况
+                 isolated为没有邻车、没有经过卷积的车辆帧数
+        '''
+        counts = {name: int(count) for name, count in self.social_counts.items()}
+        counts["skipped_ratio"] = counts["isolated"] / max(counts["vehicles"], 1)
+        if reset:
+            self.social_counts = dict.fromkeys(self.social_counts, 0)
+        return counts
+
+    def conv1OutputSize(self):
+        '''
+        :return: social_tensor_conv1输出的(out_height,out_width)
+        '''
+        (kernel_height, kernel_width), (stride_height, stride_width) = self.social_tensor_conv1.kernel_size, \
+                                                                       self.social_tensor_conv1.stride
+        return (self.grids_height - kernel_height) // stride_height + 1, \
+               (self.grids_width - kernel_width) // stride_width + 1
+
+    def getSocialTensor(self, one_frame_grids, hidden_states=None):
+        '''
+
+        :param one_frame_grids: 一帧有车格子的稀疏索引tensor(k,5)，每行(frame,target,row,col,neighbor)
+        :param hidden_states: 填入格子的状态tensor(vehicle_num,rnn_size)，None为self.hidden_states
         :return: social_tensor:嵌入相应隐藏张量的状态量tensor(vehicle_num=26,girds_height=39,grids_width=5，rnn_size=128)
         '''
+        hidden_states = self.hidden_states if hidden_states is None else hidden_states
         # 得到一个全为0的空的tensor(vehicle_num=26,grids_height=39,grids_width=5,rnn_size=128)
-        social_tensor = torch.zeros_like(one_frame_grids.unsqueeze(-1).expand(-1, -1, -1, self.rnn_size))
+        social_tensor = hidden_states.new_zeros(hidden_states.shape[0], self.grids_height, self.grids_width,
+                                                self.rnn_size)
+
+        # 有车的格子填入目标车的hidden_state，与原逐格赋值的结果一致；稀疏索引中每格只出现一次，一次index_put_写完，可反向传播
+        target, row, col = one_frame_grids[:, 1], one_frame_grids[:, 2], one_frame_grids[:, 3]
+        return social_tensor.index_put_((target, row, col), hidden_states[target])
+
+    def sparseSocialConv(self, one_frame_grids, hidden_states=None):
+        '''
+        social_tensor_conv1(getSocialTensor(grid))的稀疏实现，不生成稠密的social_tensor
+        第一层卷积是线性的：每个有车格子的状态乘以它在各输出位置卷积核中对应的切片，累加到这些输出位置上再加偏置
+        格子里的状态是目标车的hidden_state，先对每辆车算出与全部卷积核切片的乘积，再按格子取出累加
+        计算量与车辆数、有车格子数成正比而与格子面积无关，使用同一套social_tensor_conv1参数
+        与稠密实现只差浮点累加顺序
+        :param one_frame_grids: 一帧有车格子的稀疏索引tensor(k,5)，每行(frame,target,row,col,neighbor)
+        :param hidden_states: 填入格子的状态tensor(vehicle_num,rnn_size)，None为self.hidden_states
+        :return: tensor(vehicle_num,rnn_size/2,out_height,out_width)，未经激活
+        '''
+        hidden_states = self.hidden_states if hidden_states is None else hidden_states
+        conv = self.social_tensor_conv1
+        (kernel_height, kernel_width), (stride_height, stride_width) = conv.kernel_size, conv.stride
+        out_height, out_width = self.conv1OutputSize()
+        vehicle_num = hidden_states.shape[0]
+
+        # 每辆车的状态乘以每个卷积核切片：(vehicle_num,kernel_height,kernel_width,out_channels)
+        projected = torch.einsum("nc,ochw->nhwo", hidden_states, conv.weight)
 
-        grid_have_vehicle = torch.where(one_frame_grids != -1)  # 收到3个等长tensor，3对应三个维度的索引值
-        total_grids = grid_have_vehicle[0].shape[0]  # 总共有多少个有车的grid
-        for one_grid in range(total_grids):
-            # 三个维度
-            target_vehicle_index, grids_height_index, grids_width_index = grid_have_vehicle[0][one_grid], \
-                                                                          grid_have_vehicle[1][one_grid], \
-                                                                          grid_have_vehicle[2][one_grid]
-            social_tensor[target_vehicle_index][grids_height_index][grids_width_index] = self.hidden_states[
-                target_vehicle_index]
+        # 格子(row,col)经卷积核偏移(a,b)落在输出(i,j)：row=i*stride_height+a，col=j*stride_width+b
+        target, row, col = one_frame_grids[:, 1], one_frame_grids[:, 2], one_frame_grids[:, 3]
+        offset_height = torch.arange(kernel_height, device=row.device)
+        offset_width = torch.arange(kernel_width, device=row.device)
+        out_row, out_col = row[:, None] - offset_height, col[:, None] - offset_width
+        valid_row = (out_row >= 0) & (out_row % stride_height == 0) & (out_row < out_height * stride_height)
+        valid_col = (out_col >= 0) & (out_col % stride_width == 0) & (out_col < out_width * stride_width)
+        cell, a, b = torch.nonzero(valid_row[:, :, None] & valid_col[:, None, :], as_tuple=True)
 
-        return social_tensor
+        out_index = (target[cell] * out_height + out_row[cell, a] // stride_height) * out_width + \
+                    out_col[cell, b] // stride_width
+        output = conv.bias.expand(vehicle_num * out_height * out_width, -1)
+        output = output.index_add(0, out_index, projected[target[cell], a, b])
+        return output.view(vehicle_num, out_height, out_width, -1).permute(0, 3, 1, 2)
 
     def getFunction(self, getGrid, road_info, min_Local_Y, max_Local_Y):
+        '''
+        长时预测所需的grids计算函数和反归一化参数
+        getGrid: myDataSet.getGrid，传入tensor时在设备上直接算出稀疏索引，见myDataSet.getGridTensor
+        min_Local_Y, max_Local_Y: 单组数据为标量，batch为每组一个值的tensor(batch,)
+        '''
         self.getGrid = getGrid
         self.road_info = road_info
         self.min_Local_Y = min_Local_Y
@@ -159,7 +330,7 @@ class VPTLSTM(nn.Module):
         :param last_point:上一个循环的tensor(vehicle_num,5)
         :return:
             combine_data: tensor[vehicle_num,vec=9]  补齐的数据
-            grid:tensor(vehicle,grid_height,grid_width)
+            grid:tensor(k,5) 稀疏索引
         '''
         combine_data = torch.cat([last_point[:, 0:2], stable_value], dim=1)
         turn_left = torch.as_tensor(combine_data[:, 0] * self.road_info["max_Local_X"] > self.road_info["lane_one_max"],
@@ -167,8 +338,178 @@ class VPTLSTM(nn.Module):
         turn_right = torch.as_tensor(combine_data[:, 0] * self.road_info["max_Local_X"] < self.road_info["lane_five_min"], dtype=torch.int, device=self.device)
         combine_data = torch.cat([combine_data, torch.unsqueeze(turn_left, dim=-1).float(), torch.unsqueeze(turn_right, dim=-1).float()], dim=1)
 
+        # 按组反归一化，差值先在float64下算好，与标量运算结果一致
+        min_Local_Y = torch.as_tensor(self.min_Local_Y, dtype=torch.float64).reshape(-1)
+        max_Local_Y = torch.as_tensor(self.max_Local_Y, dtype=torch.float64).reshape(-1)
+        scene, starts, vehicle_num = self.sceneLayout(last_point.shape[0], min_Local_Y.shape[0], last_point.device)
         last_point[:, 0] = last_point[:, 0] * self.road_info["max_Local_X"]
-        last_point[:, 1] = last_point[:, 1] * (self.max_Local_Y - self.min_Local_Y) + self.min_Local_Y
-        grid = self.getGrid(last_point, from_df=0)
-        grid = torch.tensor(np.array(grid), device=self.device, dtype=torch.float32)
+        last_point[:, 1] = last_point[:, 1] * (max_Local_Y - min_Local_Y).to(last_point)[scene] \
+                           + min_Local_Y.to(last_point)[scene]
+
+        # 整个batch在设备上一次算完，每组只在自己的有效车辆之间算grids
+        if self.offsets is None:
+            positions = last_point.view(len(starts), vehicle_num, -1)
+            valid = None if self.mask is None else self.mask.view(len(starts), vehicle_num)
+        else:
+            # 拼接的batch先按组补齐，补齐的车辆不参与
+            index = scene * vehicle_num + torch.arange(len(scene), device=scene.device) - starts[scene]
+            positions = last_point.new_zeros(len(starts) * vehicle_num, last_point.shape[1])
+            positions = positions.index_copy(0, index, last_point).view(len(starts), vehicle_num, -1)
+            valid = torch.zeros(len(starts) * vehicle_num, dtype=torch.bool, device=scene.device)
+            valid = valid.index_fill(0, index, True).view(len(starts), vehicle_num)
+        grid = self.getGrid(positions, from_df=0, sparse=True, valid=valid)
+        # frame列即组序号，换算为batch内的车辆序号后frame置0
+        offset = starts[grid[:, 0]]
+        grid = torch.stack([torch.zeros_like(offset), grid[:, 1] + offset, grid[:, 2], grid[:, 3], grid[:, 4] + offset],
+                           dim=1)
         return combine_data, grid
+
+    def sceneLayout(self, vehicle_total, scene_num, device):
+        '''
+        batch内各组车辆的位置：补齐时第b组从b*vehicle_num开始，拼接时从offsets[b]开始
+        :param vehicle_total: 车辆维的长度
+        :param scene_num: 组数
+        :param device: 补齐时结果所在的设备，拼接时与offsets相同
+        :return: (每辆车所在的组tensor(vehicle_total,), 各组第一辆车的序号tensor(scene_num,), 每组车辆数的上限)
+        '''
+        if self.offsets is None:
+            vehicle_num = vehicle_total // scene_num
+            scene = torch.arange(scene_num, device=device)
+            return scene.repeat_interleave(vehicle_num), scene * vehicle_num, vehicle_num
+        counts = self.offsets.diff()
+        scene = torch.repeat_interleave(torch.arange(scene_num, device=counts.device), counts)
+        return scene, self.offsets[:-1], int(counts.max())
+
+
+class StatelessVPTLSTM(nn.Module):
+    '''
+    VPTLSTM的函数式前向：hidden_states、cell_states和每帧的grid都作为参数和返回值传递，不写入模块属性
+    长时预测的grids用social_grid.pairwiseGrid在模型内重算，不需要getFunction注入的函数
+    与VPTLSTM共用各层，state_dict的键相同，可以互相load_state_dict；可以torch.jit.script或torch.compile，多个线程可同时推理
+    只支持dense的social_pooling和collateScenes补齐的batch
+    torch.compile整个forward会把逐帧循环展开，编译很慢；一般只编译frameStep：
+        stateless.frameStep = torch.compile(stateless.frameStep, dynamic=True)
+    '''
+
+    def __init__(self, model, road_info=None, meter_per_grid=None):
+        '''
+        :param model: VPTLSTM，各层和dropout直接共用，不复制参数
+        :param road_info: myDataSet.road_info，长时预测时需要
+        :param meter_per_grid: 每个格子的米数，长时预测时需要
+        '''
+        super(StatelessVPTLSTM, self).__init__()
+        self.rnn_size = model.rnn_size
+        self.grids_width = model.grids_width
+        self.grids_height = model.grids_height
+        self.cell = model.cell
+        self.input_embedding_layer = model.input_embedding_layer
+        self.social_tensor_conv1 = model.social_tensor_conv1
+        self.social_tensor_conv2 = model.social_tensor_conv2
+        self.social_tensor_embed = model.social_tensor_embed
+        self.output_layer = model.output_layer
+        self.dropout = model.dropout  # 同一个模块，对VPTLSTM调用train()/eval()时dropout随之切换
+
+        # 长时预测的路段参数，只保留用到的标量
+        self.long_term_ready = road_info is not None and meter_per_grid is not None
+        road_info = road_info if road_info is not None else {}
+        self.max_Local_X = float(road_info.get("max_Local_X", 0))
+        self.lane_one_max = float(road_info.get("lane_one_max", 0))
+        self.lane_five_min = float(road_info.get("lane_five_min", 0))
+        self.meter_per_grid = float(meter_per_grid) if meter_per_grid is not None else 1.0
+
+    def forward(self, x_seq, grids, hidden_states, cell_states, long_term: bool = False,
+                mask: Optional[torch.Tensor] = None, min_Local_Y: Optional[torch.Tensor] = None,
+                max_Local_Y: Optional[torch.Tensor] = None):
+        '''
+        参数与返回值同VPTLSTM.forward
+        min_Local_Y, max_Local_Y: 长时预测的反归一化参数，每组一个值的tensor(batch,)，即getFunction的同名参数
+        '''
+        grids = grids.long()
+        valid: Optional[torch.Tensor] = None
+        if mask is not None:
+            valid = mask.reshape(-1)
+        # grids按frame有序，每帧一段[bounds[f],bounds[f+1])
+        bounds: List[int] = torch.searchsorted(grids[:, 0].contiguous(),
+                                               torch.arange(x_seq.shape[0] + 1, device=grids.device)).tolist()
+
+        outputs: List[torch.Tensor] = []
+        output = x_seq.new_zeros(0)
+        for frame_index in range(x_seq.shape[0]):
+            output, hidden_states, cell_states = self.frameStep(x_seq[frame_index],
+                                                                grids[bounds[frame_index]:bounds[frame_index + 1]],
+                                                                hidden_states, cell_states, valid)
+            if not long_term:
+                outputs.append(output)
+        if long_term:
+            if not self.long_term_ready or min_Local_Y is None or max_Local_Y is None:
+                raise ValueError("长时预测需要road_info、meter_per_grid和min_Local_Y、max_Local_Y")
+            stable_value = x_seq[0, :, 2:7]
+            for _ in range(x_seq.shape[0]):
+                outputs.append(output)
+                frame, grid = self.dataMakeUp(stable_value, output, min_Local_Y, max_Local_Y, valid)
+                output, hidden_states, cell_states = self.frameStep(frame, grid, hidden_states, cell_states, valid)
+        return torch.stack(outputs)
+
+    def frameStep(self, frame, grid, hidden_states, cell_states, valid: Optional[torch.Tensor]):
+        '''
+        VPTLSTM.frameForward的函数式版本
+        :param frame: tensor(vehicle_num,9)
+        :param grid: tensor(k,5) long 该帧有车格子的稀疏索引
+        :param valid: tensor(vehicle_num,) bool 有效车辆，None为全部有效
+        :return: (output tensor(vehicle_num,5), hidden_states, cell_states)
+        '''
+        input_embedded = self.dropout(torch.relu(self.input_embedding_layer(frame)))
+
+        social_tensor = self.socialTensor(grid, hidden_states).permute(0, 3, 1, 2)
+        tensor_embedded = self.dropout(torch.relu(self.social_tensor_conv1(social_tensor)))
+        tensor_embedded = self.dropout(torch.relu(self.social_tensor_conv2(tensor_embedded)))
+        tensor_embedded = self.dropout(torch.relu(self.social_tensor_embed(torch.flatten(tensor_embedded, 1))))
+
+        concat_embedded = torch.cat((input_embedded, tensor_embedded), 1)
+        hidden_states, cell_states = self.cell(concat_embedded, (hidden_states, cell_states))
+        output = self.output_layer(hidden_states)
+        if valid is not None:
+            output = output.masked_fill(~valid[:, None], 0)
+        return output, hidden_states, cell_states
+
+    def socialTensor(self, grid, hidden_states):
+        '''
+        同VPTLSTM.getSocialTensor，有车的格子填入目标车的hidden_state
+        :return: tensor(vehicle_num,grids_height,grids_width,rnn_size)
+        '''
+        vehicle_num = hidden_states.shape[0]
+        target = grid[:, 1]
+        cell = (target * self.grids_height + grid[:, 2]) * self.grids_width + grid[:, 3]
+        social_tensor = hidden_states.new_zeros(vehicle_num * self.grids_height * self.grids_width, self.rnn_size)
+        social_tensor = social_tensor.index_copy(0, cell, hidden_states[target])
+        return social_tensor.view(vehicle_num, self.grids_height, self.grids_width, self.rnn_size)
+
+    def dataMakeUp(self, stable_value, last_point, min_Local_Y, max_Local_Y, valid: Optional[torch.Tensor]):
+        '''
+        VPTLSTM.dataMakeUp的函数式版本，不修改last_point
+        :return: (下一帧输入tensor(vehicle_num,9), 稀疏索引tensor(k,5))
+        '''
+        local_x = last_point[:, 0] * self.max_Local_X
+        turn_left = (local_x > self.lane_one_max).float()
+        turn_right = (local_x < self.lane_five_min).float()
+        frame = torch.cat([last_point[:, 0:2], stable_value, turn_left[:, None], turn_right[:, None]], dim=1)
+
+        # 按组反归一化，差值先在float64下算好，与VPTLSTM一致
+        min_Local_Y = min_Local_Y.to(torch.float64).reshape(-1)
+        max_Local_Y = max_Local_Y.to(torch.float64).reshape(-1)
+        scene_num = min_Local_Y.shape[0]
+        vehicle_num = last_point.shape[0] // scene_num
+        scene = torch.arange(scene_num, device=last_point.device).repeat_interleave(vehicle_num)
+        local_y = last_point[:, 1] * (max_Local_Y - min_Local_Y).to(last_point)[scene] \
+                  + min_Local_Y.to(last_point)[scene]
+
+        scene_valid: Optional[torch.Tensor] = None
+        if valid is not None:
+            scene_valid = valid.view(scene_num, vehicle_num)
+        local_x, local_y = local_x.detach().view(scene_num, vehicle_num), local_y.detach().view(scene_num, vehicle_num)
+        grid = pairwiseGrid(local_x, local_y, scene_valid, self.grids_width, self.grids_height, self.meter_per_grid)
+        # frame列即组序号，换算为batch内的车辆序号后frame置0
+        offset = grid[:, 0] * vehicle_num
+        grid = torch.stack([torch.zeros_like(offset), grid[:, 1] + offset, grid[:, 2], grid[:, 3], grid[:, 4] + offset],
+                           dim=1)
+        return frame, grid
@@ -0,0 +1,170 @@
+import argparse
+import io
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_loader import convertToParquet, loadSceneIndex, sceneIndexFile
+from parameters import dataExecute_conf
+
+STRATEGIES = ("iid", "lane", "time", "location")
+
+
+def sceneAttributes(task):
+    '''
+    解析一段相邻组的Lane_ID和Location
+    :param task: (csv_source, 各组起点array, 各组终点array)，字节范围见buildSceneIndex
+    :return: (各组出现最多的Lane_ID，相同时取小的, 各组的Location)
+    '''
+    csv_source, start, end = task
+    with open(csv_source, "rb") as f:
+        columns = pd.read_csv(io.BytesIO(f.readline())).columns
+        f.seek(start[0])
+        block = f.read(end[-1] - start[0])
+    scenes = [block[one_start - start[0]:one_end - start[0]] for one_start, one_end in zip(start, end)]
+    rows = np.array([scene.count(b"\n") for scene in scenes])
+    lane, location = np.zeros(len(scenes), dtype=np.int64), np.full(len(scenes), "", dtype=object)
+    if not rows.sum():
+        return lane, location
+
+    init_data = pd.read_csv(io.BytesIO(b"".join(scenes)), header=None, names=columns,
+                            usecols=["Lane_ID", "Location"], skip_blank_lines=False)
+    lane_id = init_data["Lane_ID"].values.astype(np.int64)
+    scene = np.repeat(np.arange(len(scenes)), rows)
+    counts = np.bincount(scene * (lane_id.max() + 1) + lane_id, minlength=len(scenes) * (lane_id.max() + 1))
+    lane = counts.reshape(len(scenes), -1).argmax(axis=1)
+    first = (np.cumsum(rows) - rows)[rows > 0]
+    location[rows > 0] = init_data["Location"].values[first]
+    return lane, location
+
+
+def sceneKeys(csv_source, index, strategy, workers=1, scenes_per_task=256):
+    '''
+    非IID划分时排序用的每组取值
+    :return: array(batches,)，iid时为None
+    '''
+    if strategy == "iid":
+        return None
+    if strategy == "time":
+        return index["min_time"]
+
+    tasks = [(csv_source, index["start"][first:first + scenes_per_task], index["end"][first:first + scenes_per_task])
+             for first in range(0, len(index["start"]), scenes_per_task)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            attributes = pool.map(sceneAttributes, tasks)
+    else:
+        attributes = [sceneAttributes(task) for task in tasks]
+    lane, location = [np.concatenate(one) for one in zip(*attributes)] if attributes else (np.zeros(0), np.zeros(0))
+    return lane if strategy == "lane" else location
+
+
+def assignScenes(keys, scene_count, node_count, shards_per_node=1, seed=0):
+    '''
+    组按keys排序(相同取值的组随机排列)后切成node_count*shards_per_node片，每个节点随机分到shards_per_node片
+    keys为None时即IID随机划分；shards_per_node越大，非IID划分下各节点的数据越混杂
+    :return: [node_count, array(组序号)]，各节点内按组序号升序
+    '''
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(scene_count)
+    if keys is not None:
+        order = order[np.argsort(np.asarray(keys)[order], kind="stable")]
+    pieces = np.array_split(order, node_count * shards_per_node)
+    deal = rng.permutation(len(pieces)).reshape(node_count, shards_per_node)
+    return [np.sort(np.concatenate([pieces[piece] for piece in one_deal])) for one_deal in deal]
+
+
+def writeShard(task):
+    '''
+    按组索引把各组的字节原样拷到分片文件，相邻的组连同中间的分割行一次拷贝，不解析
+    :param task: (csv_source, 组序号array, 输出位置, 是否转换为parquet)
+    :return: (输出位置, 组数, 字节数)
+    '''
+    csv_source, scenes, output, parquet = task
+    index = loadSceneIndex(csv_source)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    # 转换为parquet时中间csv写到输出旁的临时文件，不能覆盖同目录下节点原有的train.csv
+    csv_output = "{}.{}.tmp.csv".format(output, os.getpid()) if parquet else output
+    tmp_file = csv_output if parquet else "{}.{}.tmp".format(csv_output, os.getpid())
+    # 连续的组序号合并为一段
+    breaks = np.flatnonzero(np.diff(scenes) != 1) + 1
+    with open(csv_source, "rb") as source, open(tmp_file, "wb") as f:
+        header = source.readline()
+        f.write(header)
+        for run in np.split(scenes, breaks) if len(scenes) else []:
+            source.seek(index["start"][run[0]])
+            f.write(source.read(index["end"][run[-1]] - index["start"][run[0]]))
+            f.write(header)
+    if tmp_file != csv_output:
+        os.replace(tmp_file, csv_output)
+
+    if parquet:
+        try:
+            convertToParquet(csv_output, output)
+        finally:
+            for path in (csv_output, sceneIndexFile(csv_output)):
+                if os.path.exists(path):
+                    os.remove(path)
+    return output, len(scenes), os.path.getsize(output)
+
+
+def partition(csv_source, outputs, strategy="iid", shards_per_node=1, seed=0, workers=None):
+    '''
+    把csv_source的各组划分给len(outputs)个节点，每个节点写一个只含自己组的分片文件
+    同样的源文件、策略和seed总是得到同样的划分
+    :param csv_source: 已处理好csv文件位置
+    :param outputs: 各节点分片文件位置，以.parquet结尾的转换为parquet
+    :param strategy: iid随机；lane按组内出现最多的Lane_ID；time按Global_Time起点；location按Location
+    :param shards_per_node: 每个节点分到的片数，见assignScenes
+    :param seed: 随机种子
+    :param workers: 进程数，None为CPU核数
+    :return: [节点数, array(组序号)]
+    '''
+    if strategy not in STRATEGIES:
+        raise ValueError("strategy只能为{}".format("、".join(STRATEGIES)))
+    if os.path.abspath(csv_source) in [os.path.abspath(output) for output in outputs]:
+        raise ValueError("分片不能覆盖源文件{}".format(csv_source))
+    start_time = time.time()
+    workers = max(workers or os.cpu_count() or 1, 1)
+    index = loadSceneIndex(csv_source)
+    keys = sceneKeys(csv_source, index, strategy, workers=workers)
+    assignment = assignScenes(keys, len(index["start"]), len(outputs), shards_per_node=shards_per_node, seed=seed)
+
+    tasks = [(csv_source, scenes, output, output.endswith(".parquet")) for scenes, output in zip(assignment, outputs)]
+    if min(workers, len(tasks)) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(writeShard, tasks)
+    else:
+        results = [writeShard(task) for task in tasks]
+    for output, scene_count, size in results:
+        print("{}：{}组，{:.1f}MB".format(output, scene_count, size / 2 ** 20))
+    print("{}按{}划分为{}个分片完成，用时{:.2f}s".format(csv_source, strategy, len(outputs), time.time() - start_time))
+    return assignment
+
+
+def nodeOutputs(conf, file_name):
+    '''
+    :return: 各workspace下各节点的分片位置，即节点读取的./data/file_name
+    '''
+    return [os.path.join(workspace, "node{}".format(node), "model", "data", file_name)
+            for workspace in conf.partition_workspaces for node in range(1, conf.partition_nodes + 1)]
+
+
+if __name__ == '__main__':
+    conf = dataExecute_conf()
+    parser = argparse.ArgumentParser(description="按节点划分训练集，各节点只读自己的分片")
+    parser.add_argument("--source", default=conf.output, help="已处理好的csv，默认dataExecute_conf.output")
+    parser.add_argument("--strategy", choices=STRATEGIES, default=conf.partition_strategy)
+    parser.add_argument("--nodes", type=int, default=conf.partition_nodes, help="每个workspace的节点数")
+    parser.add_argument("--shards-per-node", type=int, default=conf.shards_per_node)
+    parser.add_argument("--seed", type=int, default=conf.partition_seed)
+    parser.add_argument("--workers", type=int, default=conf.workers)
+    parser.add_argument("--parquet", action="store_true", help="分片写为train.parquet，节点的train_conf.train_csv_source须相应改为./data/train.parquet")
+    args = parser.parse_args()
+
+    conf.partition_nodes = args.nodes
+    partition(args.source, nodeOutputs(conf, "train.parquet" if args.parquet else "train.csv"),
+              strategy=args.strategy, shards_per_node=args.shards_per_node, seed=args.seed, workers=args.workers)
@@ -0,0 +1,273 @@
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data_loader import (BatchAugment, BucketBatchSampler, collateScenes, convertToParquet,  # noqa: E402
+                         loadSceneIndex, makeDataLoader, myDataSet, myStreamDataSet)
+from model import VPTLSTM  # noqa: E402
+from parameters import train_conf  # noqa: E402
+
+
+def writeWithEmptyScene(path):
+    '''
+    取test.csv的前两组，在两组之间多插入一个分割行，得到一个没有车辆的空组
+    '''
+    with open(os.path.join(ROOT, "data", "test.csv")) as f:
+        lines = f.read().split("\n")
+    header = lines[0]
+    delimiters = [seq for seq, line in enumerate(lines) if line == header][1:3]
+    kept = lines[:delimiters[0] + 1] + [header] + lines[delimiters[0] + 1:delimiters[1] + 1]
+    with open(path, "w") as f:
+        f.write("\n".join(kept) + "\n")
+
+
+def datasetArgs(conf):
+    return dict(need_col=conf.need_col, output_col=conf.output_col, grids_width=conf.grids_width,
+                grids_height=conf.grids_height, meter_per_grid=conf.meter_per_grid, road=conf.road_name)
+
+
+def test_empty_scene(tmp_path):
+    conf = train_conf()
+    csv_source = str(tmp_path / "empty.csv")
+    writeWithEmptyScene(csv_source)
+
+    for long_term in (False, True):
+        dataset = myDataSet(csv_source, long_term=long_term, workers=1, **datasetArgs(conf))
+        # 空组留在zip_data中，组序号与源文件一致，但不作为样本
+        assert len(dataset.zip_data) == 3 and dataset.zip_data[1].shape[1] == 0
+        assert len(dataset) == 2 and dataset.scene_index.tolist() == [0, 2]
+        assert (dataset.sampleShapes() > 0).all()
+        assert [tuple(dataset[item][0].shape[1:2]) for item in range(2)] == \
+               [tuple(dataset.zip_data[scene].shape[1:2]) for scene in (0, 2)]
+
+    stream = myStreamDataSet(csv_source, shuffle=False, **datasetArgs(conf))
+    shapes = [tuple(sample[0].shape[1:2]) for sample in stream]
+    assert shapes == [tuple(dataset.zip_data[scene].shape[1:2]) for scene in (0, 2)]
+
+
+def test_empty_scene_loader(tmp_path):
+    conf = train_conf()
+    conf.num_workers = 0
+    csv_source = str(tmp_path / "empty.csv")
+    writeWithEmptyScene(csv_source)
+    model = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
+                    output_size=conf.output_size, grids_width=conf.grids_width, grids_height=conf.grids_height,
+                    dropout_par=conf.dropout_par, device=torch.device("cpu"))
+
+    for batch_tokens, window in ((conf.batch_tokens, None), (None, None), (None, 20)):
+        conf.batch_tokens = batch_tokens
+        dataset = myDataSet(csv_source, workers=1, window=window, **datasetArgs(conf))
+        batches = list(makeDataLoader(dataset, conf, shuffle=False))
+        assert sum(len(Local_Y) for *_, Local_Y in batches) == len(dataset)
+        x, y, grids, mask, Local_Y = batches[0]
+        out = model(x_seq=x, grids=grids, hidden_states=torch.zeros(x.shape[1], conf.rnn_size),
+                    cell_states=torch.zeros(x.shape[1], conf.rnn_size), long_term=False, mask=mask)
+        assert out.shape[:2] == y.shape[:2] and torch.isfinite(out).all()
+
+
+def test_empty_grid():
+    conf = train_conf()
+    dataset = myDataSet(None, **datasetArgs(conf))
+    empty = np.zeros((4, 0, len(conf.output_col)))
+    assert dataset.getGrid(empty, from_df=0, sparse=True).shape == (0, 5)
+    assert dataset.getGrid(torch.zeros(4, 0, len(conf.output_col)), from_df=0, sparse=True).shape == (0, 5)
+    seq_data, _ = dataset.normalization(empty, dataset.col_seq)
+    assert seq_data.shape == (4, 0, 9)
+    # 和其他组一起补齐时空组全为补齐的车辆
+    x, _, _, mask, _ = collateScenes([(torch.zeros(3, 0, 9), torch.zeros(3, 0, 2), torch.zeros(0, 5, dtype=torch.int16),
+                                       torch.zeros(2, dtype=torch.float64)),
+                                      (torch.ones(3, 2, 9), torch.ones(3, 2, 2), torch.zeros(0, 5, dtype=torch.int16),
+                                       torch.zeros(2, dtype=torch.float64))])
+    assert x.shape == (3, 4, 9) and mask.tolist() == [[False, False], [True, True]]
+
+
+def test_stream_long_term():
+    conf = train_conf()
+    conf.num_workers, conf.long_term = 0, True
+    stream = myStreamDataSet(os.path.join(ROOT, "data", "test.csv"), long_term=True, shuffle=False,
+                             **datasetArgs(conf))
+    model = VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
+                    output_size=conf.output_size, grids_width=conf.grids_width, grids_height=conf.grids_height,
+                    dropout_par=conf.dropout_par, device=torch.device("cpu"))
+
+    x, y, grids, mask, Local_Y = next(iter(makeDataLoader(stream, conf)))
+    min_Local_Y, max_Local_Y = Local_Y.unbind(1)
+    # 与mnist_pyt的doTrainBatch一样从训练集取长时预测的grids计算和道路参数
+    model.getFunction(getGrid=stream.getGrid, road_info=stream.road_info, min_Local_Y=min_Local_Y,
+                      max_Local_Y=max_Local_Y)
+    out = model(x_seq=x, grids=grids, hidden_states=torch.zeros(x.shape[1], conf.rnn_size),
+                cell_states=torch.zeros(x.shape[1], conf.rnn_size), long_term=True, mask=mask)
+    assert out.shape[:2] == y.shape[:2] and torch.isfinite(out).all()
+
+
+def test_bucket_sampler():
+    conf = train_conf()
+    dataset = myDataSet(os.path.join(ROOT, "data", "test.csv"), workers=1, **datasetArgs(conf))
+    rng = np.random.RandomState(0)
+    synthetic = np.stack([rng.choice([49, 99], 500), rng.randint(5, 81, 500)], axis=1)
+    for shapes in (dataset.sampleShapes(), synthetic):
+        sampler = BucketBatchSampler(shapes, conf.batch_tokens, bucket_width=conf.bucket_width, seed=0)
+        assert len(sampler) == len(list(sampler))
+        for _ in range(2):
+            batches = list(sampler)
+            # 每组恰好出现一次
+            assert sorted(item for batch in batches for item in batch) == list(range(len(shapes)))
+            for batch in batches:
+                frames, vehicles = shapes[batch, 0], shapes[batch, 1]
+                assert (frames == frames[0]).all()
+                # 补齐后不超过token上限，单组超出时独占一个batch
+                assert len(batch) * vehicles.max() * frames[0] <= conf.batch_tokens or len(batch) == 1
+
+    # 不打乱时每轮相同
+    sampler = BucketBatchSampler(synthetic, conf.batch_tokens, bucket_width=conf.bucket_width, shuffle=False)
+    assert list(sampler) == list(sampler)
+
+
+def assertSamplesEqual(dataset, expected, items, x_atol=0.0):
+    '''
+    :param x_atol: x允许的误差，其余输出须完全一致
+    '''
+    assert len(dataset) == len(items)
+    for item, expected_item in zip(range(len(dataset)), items):
+        (x, *others), (expected_x, *expected_others) = dataset[item], expected[expected_item]
+        assert torch.allclose(x, expected_x, rtol=0, atol=x_atol)
+        assert all(torch.equal(a, b) for a, b in zip(others, expected_others))
+
+
+def test_scene_index(tmp_path):
+    conf = train_conf()
+    csv_source = str(tmp_path / "test.csv")
+    shutil.copy(os.path.join(ROOT, "data", "test.csv"), csv_source)
+    full = myDataSet(csv_source, workers=1, **datasetArgs(conf))
+    index = loadSceneIndex(csv_source)
+    assert len(index["start"]) == len(full.zip_data)
+    assert index["frames"].tolist() == [len(one_zip_data) for one_zip_data in full.zip_data]
+    assert index["vehicles"].tolist() == [one_zip_data.shape[1] for one_zip_data in full.zip_data]
+
+    for scenes in ([0], [3, 17, 48], list(range(40, 49)), [12, 5]):
+        dataset = myDataSet(csv_source, workers=1, scenes=scenes, **datasetArgs(conf))
+        assertSamplesEqual(dataset, full, scenes)
+
+    # 源文件变化后索引重新建立
+    writeWithEmptyScene(csv_source)
+    assert len(loadSceneIndex(csv_source)["start"]) == 3
+
+
+def writeTwoLocations(path):
+    '''
+    test.csv中奇数序号的组改为i-80，得到两个Location
+    '''
+    with open(os.path.join(ROOT, "data", "test.csv")) as f:
+        lines = f.read().split("\n")
+    scene = -1
+    for seq, line in enumerate(lines):
+        if line == lines[0]:
+            scene += 1
+        elif scene % 2:
+            lines[seq] = line.replace(",us-101", ",i-80")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def test_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    conf = train_conf()
+    csv_source = str(tmp_path / "test.csv")
+    writeTwoLocations(csv_source)
+    parquet_file = convertToParquet(csv_source)
+    full = myDataSet(csv_source, workers=1, **datasetArgs(conf))
+
+    # parquet中v_length、v_Width为float32，x相差不超过1个float32 ulp
+    dataset = myDataSet(parquet_file, workers=1, **datasetArgs(conf))
+    assertSamplesEqual(dataset, full, range(len(full)), x_atol=1e-6)
+    # scene_id下推，按给出的顺序返回
+    dataset = myDataSet(parquet_file, workers=1, scenes=[30, 2, 7], **datasetArgs(conf))
+    assertSamplesEqual(dataset, full, [30, 2, 7], x_atol=1e-6)
+    # Location下推
+    dataset = myDataSet(parquet_file, workers=1, locations=["i-80"], **datasetArgs(conf))
+    assertSamplesEqual(dataset, full, range(1, len(full), 2), x_atol=1e-6)
+    dataset = myDataSet(parquet_file, workers=1, scenes=[1, 2, 3], locations=["us-101"], **datasetArgs(conf))
+    assertSamplesEqual(dataset, full, [2], x_atol=1e-6)
+
+
+def test_window():
+    conf = train_conf()
+    csv_source = os.path.join(ROOT, "data", "test.csv")
+    for long_term, window, stride in ((False, 10, 1), (True, 20, 7)):
+        dataset = myDataSet(csv_source, long_term=long_term, precompute=True, workers=1, window=window,
+                            window_stride=stride, **datasetArgs(conf))
+        frames = np.array([len(one_zip_data) for one_zip_data in dataset.zip_data])
+        assert len(dataset) == ((frames - window) // stride + 1).sum()
+        assert (dataset.sampleShapes()[:, 0] == dataset.sampleFrames(window)).all()
+        for item in range(0, len(dataset), 13):
+            scene, offset = dataset.window_index[item]
+            x, y, grids, Local_Y = dataset[item]
+            # 归一化沿用整组，x、y是整组预计算结果上的视图
+            seq_data = dataset.cache["seq_data"][scene]
+            assert np.shares_memory(x.numpy(), seq_data) and np.shares_memory(y.numpy(), seq_data)
+            # grids与把窗口复制成独立的组再计算一致
+            window_grids = dataset.computeScene(dataset.zip_data[scene][offset:offset + window].copy())[1]
+            expected = dataset.makeSample(seq_data[offset:offset + window], window_grids,
+                                          dataset.cache["Local_Y"][scene])
+            assert all(torch.equal(a, b) for a, b in zip((x, y, grids, Local_Y), expected))
+
+
+def sortedGrids(grids):
+    '''
+    grids按行排序，同一帧内的顺序不影响结果
+    '''
+    return torch.unique(grids.long(), dim=0)
+
+
+def test_augment():
+    conf = train_conf()
+    conf.num_workers = 0
+    dataset = myDataSet(os.path.join(ROOT, "data", "test.csv"), precompute=True, workers=1, **datasetArgs(conf))
+    batch = [dataset[item] for item in range(6)]
+    x, y, grids, mask, Local_Y = collateScenes(batch)
+    assert not mask.all()  # batch内有补齐的车辆
+
+    # 默认不增强，打开conf.augment后才由BatchAugment整理batch
+    assert makeDataLoader(dataset, conf, augment=True).collate_fn is collateScenes
+    conf.augment = True
+    assert isinstance(makeDataLoader(dataset, conf, augment=True).collate_fn, BatchAugment)
+    assert makeDataLoader(dataset, conf).collate_fn is collateScenes
+
+    # 全部关闭时与collateScenes一致
+    plain = BatchAugment(dataset)(batch)
+    assert all(torch.equal(a, b) for a, b in zip(plain, (x, y, grids, mask, Local_Y)))
+    augment = BatchAugment(dataset)
+    assert torch.equal(sortedGrids(augment.regrid(x, mask, Local_Y)), sortedGrids(grids))
+
+    # 抽帧：每2帧取一帧，grids与按抽帧后的位置重算一致
+    augment = BatchAugment(dataset, time_scales=(2,))
+    sub_x, sub_y, sub_grids, _, _ = augment(batch)
+    frames = len(x) // 2
+    assert torch.equal(sub_x, x[:frames * 2:2]) and torch.equal(sub_y, y[1:frames * 2:2])
+    assert torch.equal(sortedGrids(sub_grids), sortedGrids(augment.regrid(sub_x, mask, Local_Y)))
+
+    # 镜像：能翻转的组全部翻转，1、5号车道标志互换，补齐的车辆仍为0
+    augment = BatchAugment(dataset, mirror=1.0)
+    flip = augment.canMirror(x, y, mask)
+    assert flip.any()
+    mirror_x, mirror_y, mirror_grids, _, _ = augment(batch)
+    vehicle_flip = flip.repeat_interleave(mask.shape[1]) & mask.reshape(-1)
+    axis = augment.mirror_axis / augment.max_Local_X
+    assert torch.allclose(mirror_x[:, vehicle_flip, 0], axis - x[:, vehicle_flip, 0])
+    assert torch.allclose(mirror_y[:, vehicle_flip, 0], axis - y[:, vehicle_flip, 0])
+    assert torch.equal(mirror_x[:, vehicle_flip, -2:], x[:, vehicle_flip, -2:].flip(-1))
+    assert torch.equal(mirror_x[:, ~vehicle_flip], x[:, ~vehicle_flip])
+    assert torch.equal(sortedGrids(mirror_grids), sortedGrids(augment.regrid(mirror_x, mask, Local_Y)))
+
+    # 抖动只改有效车辆的输入位置
+    jitter_x, jitter_y, _, _, _ = BatchAugment(dataset, jitter=0.5)(batch)
+    valid = mask.reshape(-1)
+    assert torch.equal(jitter_y, y) and torch.equal(jitter_x[..., 2:], x[..., 2:])
+    assert torch.equal(jitter_x[:, ~valid], x[:, ~valid]) and not torch.equal(jitter_x[:, valid], x[:, valid])
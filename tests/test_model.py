@@ -0,0 +1,108 @@
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data_loader import collatePacked, collateScenes, myDataSet  # noqa: E402
+from model import StatelessVPTLSTM, VPTLSTM  # noqa: E402
+from parameters import train_conf  # noqa: E402
+from utils import Gaussian2DLikelihood, lossCaculate  # noqa: E402
+
+
+def makeModel(conf, **kwargs):
+    torch.manual_seed(0)
+    return VPTLSTM(rnn_size=conf.rnn_size, embedding_size=conf.embedding_size, input_size=conf.input_size,
+                   output_size=conf.output_size, grids_width=conf.grids_width, grids_height=conf.grids_height,
+                   dropout_par=conf.dropout_par, device=torch.device("cpu"), **kwargs)
+
+
+def makeDataSet(conf, long_term=False):
+    return myDataSet(os.path.join(ROOT, "data", "test.csv"), need_col=conf.need_col, output_col=conf.output_col,
+                     grids_width=conf.grids_width, grids_height=conf.grids_height, meter_per_grid=conf.meter_per_grid,
+                     road=conf.road_name, long_term=long_term, precompute=True, workers=1)
+
+
+def test_packed_matches_padded():
+    conf = train_conf()
+    for long_term in (False, True):
+        dataset = makeDataSet(conf, long_term=long_term)
+        samples = [dataset[item] for item in (3, 5, 9, 20, 0)]
+        x, y, grids, mask, Local_Y = collateScenes(samples)
+        packed_x, packed_y, packed_grids, offsets, packed_Local_Y = collatePacked(samples)
+        valid = mask.reshape(-1)
+        assert torch.equal(packed_x, x[:, valid]) and torch.equal(packed_y, y[:, valid])
+        assert offsets.tolist() == [0] + torch.cumsum(mask.sum(dim=1), 0).tolist()
+
+        for skip_isolated in (False, True):
+            model = makeModel(conf, skip_isolated=skip_isolated).eval()
+            results = []
+            for batch_x, batch_y, batch_grids, layout, batch_Local_Y in (
+                    (x, y, grids, {"mask": mask}, Local_Y),
+                    (packed_x, packed_y, packed_grids, {"offsets": offsets}, packed_Local_Y)):
+                model.zero_grad()
+                model.getFunction(dataset.getGrid, dataset.road_info, *batch_Local_Y.unbind(1))
+                states = torch.zeros(batch_x.shape[1], conf.rnn_size)
+                out = model(batch_x, batch_grids, states.clone(), states.clone(), long_term=long_term, **layout)
+                loss = lossCaculate(pred=out, true=batch_y, conf=conf, **layout)
+                loss.backward()
+                likelihood = Gaussian2DLikelihood(out, batch_y, long_term, **layout).sum()
+                results.append((out.detach(), loss.item(), likelihood.item(),
+                                [parameter.grad.clone() for parameter in model.parameters()]))
+
+            (padded_out, padded_loss, padded_likelihood, padded_grads), (packed_out, packed_loss,
+                                                                         packed_likelihood, packed_grads) = results
+            # 补齐的车辆不影响有效车辆，两种布局的输出逐位一致，loss和梯度只差求和顺序
+            assert torch.equal(padded_out[:, valid], packed_out)
+            assert abs(padded_loss - packed_loss) <= 1e-5 * abs(padded_loss)
+            assert padded_likelihood == packed_likelihood
+            assert all(torch.allclose(a, b, rtol=1e-4, atol=1e-5) for a, b in zip(padded_grads, packed_grads))
+
+    states = torch.zeros(x.shape[1], conf.rnn_size)
+    with pytest.raises(ValueError):
+        makeModel(conf)(x, grids, states, states.clone(), mask=mask, offsets=offsets)
+
+
+def test_stateless_follows_train_eval():
+    conf = train_conf()
+    dataset = makeDataSet(conf)
+    x, y, grids, mask, Local_Y = collateScenes([dataset[item] for item in (3, 5)])
+    states = torch.zeros(x.shape[1], conf.rnn_size)
+    model = makeModel(conf)
+    assert model.dropout.p > 0
+
+    def run(module):
+        return module(x, grids, states.clone(), states.clone(), mask=mask)
+
+    stateless = StatelessVPTLSTM(model)
+    # 只对VPTLSTM调用eval()，包装后的前向以及之后script的前向都不再dropout
+    model.eval()
+    scripted = torch.jit.script(StatelessVPTLSTM(model))
+    with torch.no_grad():
+        expected = run(model)
+        assert torch.equal(run(stateless), expected) and torch.equal(run(stateless), expected)
+        assert torch.allclose(run(scripted), expected, rtol=0, atol=1e-6)
+        # 对包装后的模块调用train()同样作用于VPTLSTM
+        stateless.train()
+        assert model.dropout.training and not torch.equal(run(stateless), run(stateless))
+
+
+def test_social_stats_count_training_only():
+    conf = train_conf()
+    dataset = makeDataSet(conf)
+    x, y, grids, mask, Local_Y = collateScenes([dataset[item] for item in (3, 5)])
+    states = torch.zeros(x.shape[1], conf.rnn_size)
+    model = makeModel(conf, skip_isolated=True)
+
+    model(x, grids, states.clone(), states.clone(), mask=mask)
+    stats = model.socialStats()
+    assert stats["frames"] == len(x) and stats["vehicles"] == int(mask.sum()) * len(x)
+    # eval时的前向不计入，如联邦学习的test()
+    model.eval()
+    with torch.no_grad():
+        model(x, grids, states.clone(), states.clone(), mask=mask)
+    assert model.socialStats(reset=True) == stats
+    assert model.socialStats()["frames"] == 0
@@ -0,0 +1,40 @@
+import hashlib
+import os
+import shutil
+import sys
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data_loader import loadSceneIndex  # noqa: E402
+from partition import partition  # noqa: E402
+
+
+def digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_parquet_keeps_node_csv(tmp_path):
+    csv_source = str(tmp_path / "source.csv")
+    shutil.copy(os.path.join(ROOT, "data", "test.csv"), csv_source)
+    # 模拟节点目录下原有的train.csv及其组索引
+    node_dirs = [tmp_path / "node{}".format(node) / "data" for node in (1, 2)]
+    kept = {}
+    for node_dir in node_dirs:
+        node_dir.mkdir(parents=True)
+        shutil.copy(os.path.join(ROOT, "data", "test.csv"), str(node_dir / "train.csv"))
+        loadSceneIndex(str(node_dir / "train.csv"))
+        for name in ("train.csv", "train.index.npz"):
+            kept[str(node_dir / name)] = digest(str(node_dir / name))
+
+    outputs = [str(node_dir / "train.parquet") for node_dir in node_dirs]
+    assignment = partition(csv_source, outputs, workers=1)
+
+    for path, value in kept.items():
+        assert digest(path) == value
+    for node_dir, output, scenes in zip(node_dirs, outputs, assignment):
+        assert sorted(os.listdir(str(node_dir))) == ["train.csv", "train.index.npz", "train.parquet"]
+        assert pd.read_parquet(output, columns=["scene_id"])["scene_id"].nunique() == len(scenes)
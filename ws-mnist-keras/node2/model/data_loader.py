@@ -1,7 +1,176 @@
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
+import torch
 import pandas as pd
 import numpy as np
-import itertools
+import copy
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+
+from social_grid import pairwiseGrid
+
+CACHE_VERSION = 3  # 缓存格式或预处理逻辑变化时递增，使旧缓存失效
+
+_worker_dataset = None  # 预计算子进程中的myDataSet副本，不含原始数据
+
+
+def _initWorker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _computeScene(one_zip_data):
+    return _worker_dataset.computeScene(one_zip_data)
+
+
+def sceneIndexFile(csv_source):
+    '''
+    :return: csv旁的组索引文件路径，如train.csv对应train.index.npz
+    '''
+    return os.path.splitext(csv_source)[0] + ".index.npz"
+
+
+def buildSceneIndex(csv_source, chunk_bytes=1 << 22):
+    '''
+    扫描一遍csv建立组索引：先按块找出所有分割行的字节位置，再按块解析Vehicle_ID、Global_Time统计各组
+    组的划分与myDataSet.cutbyDelimiter一致，最后一个分割行之后的数据不算一组
+    :param csv_source: 已处理好csv文件位置
+    :param chunk_bytes: 每次读取的字节数
+    :return: {"start","end"}每组csv字节范围[start,end)，不含表头；{"min_time","max_time"}Global_Time范围；
+             {"frames","vehicles"}帧数与车辆数；{"source_size","source_mtime"}建立索引时源文件的大小与修改时间
+    '''
+    stat = os.stat(csv_source)
+    with open(csv_source, "rb") as f:
+        header = f.readline()
+        columns = pd.read_csv(io.BytesIO(header)).columns
+        pattern = b"\n" + header  # 分割行与表头完全相同，相邻的分割行共用换行符，逐个位置查找
+
+        delimiter = []
+        f.seek(len(header) - 1)
+        buffer, base = bytearray(), len(header) - 1  # base为buffer[0]在文件中的位置
+        for block in iter(lambda: f.read(chunk_bytes), b""):
+            buffer += block
+            found = buffer.find(pattern)
+            while found >= 0:
+                delimiter.append(base + found + 1)
+                found = buffer.find(pattern, found + 1)
+            # 保留可能是分割行开头的尾部
+            drop = max(len(buffer) - len(pattern) + 1, 0)
+            del buffer[:drop]
+            base += drop
+
+        end = np.array(delimiter, dtype=np.int64)
+        start = np.concatenate([[len(header)], end[:-1] + len(header)]).astype(np.int64)[:len(end)]
+
+        # 相邻的若干组一次读出、一次解析，再按行数归到各组
+        stats = []
+        first = 0
+        while first < len(start):
+            last = max(int(np.searchsorted(end, start[first] + chunk_bytes, side="right")), first + 1)
+            f.seek(start[first])
+            block = f.read(end[last - 1] - start[first])
+            scenes = [block[one_start - start[first]:one_end - start[first]]
+                      for one_start, one_end in zip(start[first:last], end[first:last])]
+            rows = [scene.count(b"\n") for scene in scenes]
+            one_stats = pd.DataFrame(index=range(last - first), columns=["min_time", "max_time", "frames", "vehicles"])
+            if sum(rows):
+                init_data = pd.read_csv(io.BytesIO(b"".join(scenes)), header=None, names=columns,
+                                        usecols=["Vehicle_ID", "Global_Time"], skip_blank_lines=False)
+                init_data["scene"] = np.repeat(np.arange(last - first), rows)
+                one_stats = init_data.groupby("scene").agg(
+                    min_time=("Global_Time", "min"), max_time=("Global_Time", "max"),
+                    frames=("Global_Time", "nunique"), vehicles=("Vehicle_ID", "nunique")).reindex(one_stats.index)
+            stats.append(one_stats)
+            first = last
+
+    stats = pd.concat(stats) if stats else pd.DataFrame(columns=["min_time", "max_time", "frames", "vehicles"])
+    return {"start": start, "end": end,
+            "min_time": stats["min_time"].to_numpy(dtype=float), "max_time": stats["max_time"].to_numpy(dtype=float),
+            "frames": stats["frames"].fillna(0).to_numpy(dtype=np.int64),
+            "vehicles": stats["vehicles"].fillna(0).to_numpy(dtype=np.int64),
+            "source_size": np.int64(stat.st_size), "source_mtime": np.int64(stat.st_mtime_ns)}
+
+
+def loadSceneIndex(csv_source, chunk_bytes=1 << 22):
+    '''
+    读取csv旁的组索引，不存在或源文件大小、修改时间变化时重新建立并写入
+    先写临时文件再改名，多个节点同时建立时不会读到半个文件
+    :return: 见buildSceneIndex
+    '''
+    index_file = sceneIndexFile(csv_source)
+    stat = os.stat(csv_source)
+    if os.path.exists(index_file):
+        with np.load(index_file) as f:
+            index = {key: f[key] for key in f.files}
+        if index["source_size"] == stat.st_size and index["source_mtime"] == stat.st_mtime_ns:
+            return index
+
+    start_time = time.time()
+    index = buildSceneIndex(csv_source, chunk_bytes)
+    tmp_file = "{}.{}.tmp.npz".format(index_file[:-len(".npz")], os.getpid())
+    np.savez(tmp_file, **index)
+    os.replace(tmp_file, index_file)
+    print("{}建立组索引完成，共计{}组，用时{:.2f}s".format(csv_source, len(index["start"]), time.time() - start_time))
+    return index
+
+
+# 转换为parquet时各列的紧凑类型，表中没有的列保持解析结果
+# Local_X/Y决定grids的格子，float32舍入会让落在格子边界的邻车换格，与csv的结果不一致，保留float64
+# Global_X/Y为大地坐标，float32只剩约0.1米精度，同样保留float64
+PARQUET_DTYPES = {"Vehicle_ID": np.int32, "Frame_ID": np.int32, "Total_Frames": np.int32, "Global_Time": np.int64,
+                  "v_length": np.float32, "v_Width": np.float32, "v_Vel": np.float32,
+                  "v_Class": np.int8, "Lane_ID": np.int8, "Location": "category"}
+
+
+def convertToParquet(csv_source, parquet_file=None, scenes_per_group=64):
+    '''
+    csv一次转换为parquet：去掉分割行和行号列，加上scene_id列，按PARQUET_DTYPES压缩类型
+    每个row group只含整组数据，按scene_id、Location读取时可以借助row group统计信息跳过无关的块
+    :param csv_source: 已处理好csv文件位置
+    :param parquet_file: 输出位置，None时为csv同名的.parquet
+    :param scenes_per_group: 每个row group的组数
+    :return: parquet文件位置
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    parquet_file = parquet_file or os.path.splitext(csv_source)[0] + ".parquet"
+    index = loadSceneIndex(csv_source)
+    start_time = time.time()
+    tmp_file = "{}.{}.tmp".format(parquet_file, os.getpid())
+    writer = None
+    with open(csv_source, "rb") as f:
+        columns = pd.read_csv(io.BytesIO(f.readline())).columns
+        for first in range(0, len(index["start"]), scenes_per_group):
+            last = min(first + scenes_per_group, len(index["start"]))
+            f.seek(index["start"][first])
+            block = f.read(index["end"][last - 1] - index["start"][first])
+            scenes = [block[start - index["start"][first]:end - index["start"][first]]
+                      for start, end in zip(index["start"][first:last], index["end"][first:last])]
+            rows = [scene.count(b"\n") for scene in scenes]
+            if not sum(rows):
+                continue
+
+            # 与parseScenes一样按round_trip解析，再统一转换类型
+            init_data = pd.read_csv(io.BytesIO(b"".join(scenes)), header=None, names=columns,
+                                    float_precision="round_trip", skip_blank_lines=False)
+            init_data = init_data.drop(columns=[col for col in columns if col.startswith("Unnamed")])
+            init_data = init_data.astype({col: dtype for col, dtype in PARQUET_DTYPES.items() if col in init_data})
+            init_data.insert(0, "scene_id", np.repeat(np.arange(first, last, dtype=np.int32), rows))
+
+            table = pa.Table.from_pandas(init_data, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_file, table.schema)
+            writer.write_table(table, row_group_size=len(init_data))
+    if writer is None:
+        raise ValueError("{}中没有完整的组".format(csv_source))
+    writer.close()
+    os.replace(tmp_file, parquet_file)
+    print("{}转换为{}完成，共计{}组，用时{:.2f}s".format(csv_source, parquet_file, len(index["start"]),
+                                                  time.time() - start_time))
+    return parquet_file
 
 
 class myDataSet(Dataset):
@@ -12,20 +181,23 @@ class myDataSet(Dataset):
         输出x:tensor(seq_length-1,vehicle_num,9)
             9个特征[local_x,local_y,v_length,v_width,motor,auto,truck,turn_left,turn_right]
         输出y:tensor(seq_length-1,vehicle_num,2)
-        输出grids:tensor(seq_len-1,vehicle_num,grids_height,grids_width)
+        输出grids:tensor(K,5)，seq_len-1帧中有车格子的稀疏索引，每行(frame,target,row,col,neighbor)
     long_term=True:
         输出x:tensor(seq_length/2,vehicle_num,9)
             9个特征[local_x,local_y,v_length,v_width,motor,auto,truck,turn_left,turn_right]
         输出y:tensor(seq_length/2,vehicle_num,2)
-        输出grids:tensor(seq_len=99,vehicle_num,grids_height,grids_width)
+        输出grids:tensor(K,5)，前seq_length/2帧的稀疏索引
+    输出Local_Y:tensor(2,)，该组反归一化用的(min_Local_Y,max_Local_Y)
     '''
 
     def __init__(self, csv_source, need_col, output_col, grids_width, grids_height, meter_per_grid, road,
-                 long_term=False):
+                 long_term=False, cache_dir=None, grid_search="pairwise", precompute=False, workers=None,
+                 scenes=None, locations=None, window=None, window_stride=1):
         '''
 
-        init用于得到[19,100,df(26,7)]，初始化所需参数
-        :param csv_source: 已处理好csv文件位置batches*seq_length*vehicle_num行
+        init用于得到[19,array(100,26,6)]，初始化所需参数
+        :param csv_source: 已处理好csv文件位置batches*seq_length*vehicle_num行，None时只初始化参数，供myStreamDataSet计算各组
+                           也可以是convertToParquet转换的.parquet文件，只读need_col列
         :param need_col: 所需列名称
         :param output_col: 最终输出包含列
         :param grids_width: 横向格子数
@@ -33,6 +205,15 @@ class myDataSet(Dataset):
         :param meter_per_grid: 格子比例尺
         :param road: 路面名称
         :param long_term: 提取长时预测数据
+        :param cache_dir: 预处理结果缓存目录，None不使用缓存
+        :param grid_search: grids邻车搜索方式，"pairwise"两两广播，"sweep"按Local_Y排序扫描，适合车多的组
+        :param precompute: 构建时预计算全部组的特征与grids，之后__getitem__只做切片；使用缓存时总是预计算
+        :param workers: 预计算进程数，None为CPU核数
+        :param scenes: 只加载这些序号的组，csv按旁边的组索引seek读取，parquet按scene_id下推过滤；None为全部
+        :param locations: 只加载这些Location的组，仅支持parquet；None为全部
+        :param window: 滑动窗口的帧数，每组按window_stride滑动切出多个样本，各样本都是组数据上的视图；
+                       None时每组一个样本
+        :param window_stride: 相邻窗口起点间隔的帧数
         '''
         # 初始化参数
         self.output_col = output_col
@@ -41,209 +222,976 @@ class myDataSet(Dataset):
         self.grids_width = grids_width
         self.grids_height = grids_height
         self.meter_per_grid = meter_per_grid
+        if grid_search not in ("pairwise", "sweep"):
+            raise ValueError("grid_search只能为pairwise或sweep")
+        self.grid_search = grid_search
 
         self.long_term = long_term
+        if window is not None and (window < 2 or window_stride < 1):
+            raise ValueError("window至少为2，window_stride至少为1")
+        self.window = window
+        self.window_stride = window_stride
+        self.window_index = None  # 滑动窗口模式下每个样本的(组序号,起始帧)
+        self.scene_index = None  # 非滑动窗口模式下每个样本的组序号，见buildWindows
 
         self.road_info = {"US101_info": {"min_Local_X": 0, "max_Local_X": 24, "max_Lane_ID": 5, "min_v_length": 1.2,
                                          "max_v_length": 23.2, "min_v_Width": 0.6, "max_v_Width": 2.6,
                                          "max_Local_Y": 682, "lane_one_max": 4.1, "lane_five_min": 13}}
         self.road_info = self.road_info[road]
+        self.cache = None  # 预计算的{"seq_data","grids","Local_Y"}，None时在__getitem__中实时计算
+        if csv_source is None:
+            self.init_data, self.zip_data = None, []
+            return
+
+        source_parts, columns, zip_data = None, None, None
+        if os.path.splitext(csv_source)[1] == ".parquet":
+            zip_data = self.readParquet(csv_source, need_col, scenes=scenes, locations=locations)
+            source_parts = [array.tobytes() for one_zip_data in zip_data for array in one_zip_data]
+        elif locations is not None:
+            raise ValueError("按Location加载只支持parquet，见convertToParquet")
+        elif scenes is not None:
+            source_parts, columns = self.readScenes(csv_source, scenes)
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = self.cacheFile(csv_source, cache_dir, need_col=need_col, road=road,
+                                        source_parts=source_parts)
+            if os.path.exists(cache_file):
+                self.loadCache(cache_file)
+                self.buildWindows()
+                print("{}从缓存{}加载完成，共计{}组数据".format(csv_source, cache_file, len(self.zip_data)))
+                return
+
         # 开始初始化
-        self.init_data = pd.read_csv(csv_source,
-                                     usecols=need_col)  # [batches*seq_length*vehicle_num+batches, len(need_col)]
-        self.zip_data = self.cutbyDelimiter(self.init_data)
-        self.zip_data = self.cutTofinal(self.zip_data)
+        if zip_data is not None:
+            self.init_data = None
+            self.zip_data = self.cutTofinal(zip_data)
+        elif scenes is not None:
+            self.init_data = None
+            self.zip_data = self.parseScenes(source_parts, columns, need_col)
+        else:
+            self.init_data = pd.read_csv(csv_source,
+                                         usecols=need_col)  # [batches*seq_length*vehicle_num+batches, len(need_col)]
+            self.zip_data = self.cutbyDelimiter(self.init_data)
+            self.zip_data = self.cutTofinal(self.zip_data)
+        if precompute or cache_file is not None:
+            self.precompute(workers)
+        if cache_file is not None:
+            self.saveCache(cache_file)
+        self.buildWindows()
         print("{}文件加载完成，共计{}组数据".format(csv_source, len(self.zip_data)))
 
-    def cutTofinal(self, zip_data):
+    def buildWindows(self):
+        '''
+        列出全部样本，__getitem__按样本序号直接查表：滑动窗口模式下为(组序号,起始帧)，否则为组序号
+        没有车辆、帧数不足window或切出的x没有帧的组没有样本；这些组仍留在zip_data和缓存中，组序号与源文件一致
         '''
+        shapes = np.array([one_zip_data.shape[:2] for one_zip_data in self.zip_data], dtype=np.int64).reshape(-1, 2)
+        frames, vehicles = shapes[:, 0], shapes[:, 1]
+        if self.window is None:
+            self.scene_index = np.flatnonzero((self.sampleFrames(frames) > 0) & (vehicles > 0))
+            if len(self.scene_index) < len(frames):
+                print("跳过{}个没有车辆或帧数不足的组".format(len(frames) - len(self.scene_index)))
+            return
+        counts = np.maximum((frames - self.window) // self.window_stride + 1, 0) * (vehicles > 0)
+        first = np.cumsum(counts) - counts
+        offset = (np.arange(counts.sum()) - np.repeat(first, counts)) * self.window_stride
+        self.window_index = np.stack([np.repeat(np.arange(len(frames)), counts), offset], axis=1)
 
-        :param zip_data: [19, df(2600,8)]
-        :return: [19,100,df(26,8)]
+    def cacheFile(self, csv_source, cache_dir, need_col, road, source_parts=None):
         '''
-        for seq, one_zip_data in enumerate(zip_data):
-            time_groups = one_zip_data["Global_Time"].unique()
-            time_zip_data = one_zip_data.groupby("Global_Time")
-            time_data = []  # 得到[100，（26，8）]
+        缓存文件名由源文件内容哈希和影响预处理结果的参数共同决定，任一变化都会重建缓存
+        :param source_parts: 只读了源文件的一部分时读到的各段字节，只对这些内容求哈希
+        :return: 缓存文件路径
+        '''
+        source_hash = hashlib.sha1()
+        if source_parts is not None:
+            for part in source_parts:
+                source_hash.update(len(part).to_bytes(8, "little"))
+                source_hash.update(part)
+        else:
+            with open(csv_source, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    source_hash.update(chunk)
 
-            for time in time_groups:
-                one_time_data = time_zip_data.get_group(time)  # （26，8）
-                time_data.append(one_time_data)
-            zip_data[seq] = time_data
+        settings = {"version": CACHE_VERSION, "need_col": list(need_col), "output_col": list(self.output_col),
+                    "grids_width": self.grids_width, "grids_height": self.grids_height,
+                    "meter_per_grid": self.meter_per_grid, "long_term": bool(self.long_term), "road": road}
+        key = hashlib.sha1((source_hash.hexdigest() + json.dumps(settings, sort_keys=True)).encode()).hexdigest()
+
+        name = os.path.splitext(os.path.basename(csv_source))[0]
+        return os.path.join(cache_dir, "{}.{}.npz".format(name, key[:16]))
+
+    def computeScene(self, one_zip_data):
+        '''
+        计算一组数据的归一化特征与grids
+        :param one_zip_data: array(seq_length=100,vehicle_num=26,vec=6)
+        :return: seq_data:array(seq_length,vehicle_num,9) float32
+                 grids:array(K,5) int16，每行(frame,target,row,col,neighbor)
+                 Local_Y:(min_Local_Y,max_Local_Y)
+        '''
+        # 所有帧的grids一次算完
+        grids = self.getGrid(one_zip_data, from_df=0, sparse=True).astype(np.int16)
+        seq_data, Local_Y = self.normalization(seq_data=one_zip_data, col_seq=self.col_seq)
+        return seq_data, grids, Local_Y
+
+    def precompute(self, workers=None):
+        '''
+        用进程池预计算全部组的归一化特征与grids，打印耗时与内存占用
+        :param workers: 进程数，None为CPU核数，1为单进程
+        '''
+        start = time.time()
+        workers = min(workers or os.cpu_count() or 1, len(self.zip_data))
+        if workers > 1:
+            # 子进程只需要参数，不带原始df和组数据
+            worker_dataset = copy.copy(self)
+            worker_dataset.init_data, worker_dataset.zip_data, worker_dataset.cache = None, None, None
+            chunksize = max(1, len(self.zip_data) // (workers * 4))
+            with multiprocessing.Pool(workers, initializer=_initWorker, initargs=(worker_dataset,)) as pool:
+                scenes = pool.map(_computeScene, self.zip_data, chunksize=chunksize)
+        else:
+            scenes = [self.computeScene(one_zip_data) for one_zip_data in self.zip_data]
+
+        self.cache = {"seq_data": [scene[0] for scene in scenes], "grids": [scene[1] for scene in scenes],
+                      "Local_Y": np.array([scene[2] for scene in scenes], dtype=float).reshape(-1, 2)}
+        print("预计算{}组数据完成，{}个进程用时{:.2f}s，占用内存{:.1f}MB".format(
+            len(scenes), max(workers, 1), time.time() - start, self.memoryFootprint() / 2 ** 20))
+
+    def memoryFootprint(self):
+        '''
+        :return: 组数据及预计算结果占用的字节数
+        '''
+        arrays = list(self.zip_data)
+        if self.cache is not None:
+            arrays += self.cache["seq_data"] + self.cache["grids"] + [self.cache["Local_Y"]]
+        return sum(array.nbytes for array in arrays)
+
+    def saveCache(self, cache_file):
+        '''
+        预计算结果按行拼接后写入npz
+        先写临时文件再改名，多个节点进程同时构建时不会读到半个文件
+        '''
+        if not self.zip_data:
+            return
+
+        scene_shape = np.array([one_zip_data.shape[:2] for one_zip_data in self.zip_data], dtype=np.int64)
+        grid_count = np.array([len(grids) for grids in self.cache["grids"]], dtype=np.int64)
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        tmp_file = "{}.{}.tmp.npz".format(cache_file[:-len(".npz")], os.getpid())
+        np.savez(tmp_file, scene_shape=scene_shape, grid_count=grid_count,
+                 scene_data=np.concatenate([a.reshape(-1, *a.shape[2:]) for a in self.zip_data]),
+                 seq_data=np.concatenate([a.reshape(-1, *a.shape[2:]) for a in self.cache["seq_data"]]),
+                 grids=np.concatenate(self.cache["grids"]),
+                 Local_Y=self.cache["Local_Y"])
+        os.replace(tmp_file, cache_file)
+
+    def loadCache(self, cache_file):
+        '''
+        从npz按组切回zip_data和预计算结果，均为大数组上的视图
+        '''
+        with np.load(cache_file) as f:
+            scene_shape = f["scene_shape"]
+            self.zip_data = self.splitRows(f["scene_data"], scene_shape)
+            self.cache = {"seq_data": self.splitRows(f["seq_data"], scene_shape),
+                          "grids": np.split(f["grids"], np.cumsum(f["grid_count"])[:-1]),
+                          "Local_Y": f["Local_Y"]}
+
+    def splitRows(self, rows, scene_shape):
+        '''
+        :param rows: array(sum(seq_length*vehicle_num),...) 按行拼接的各组数据
+        :param scene_shape: array(batches,2) 每组的(seq_length,vehicle_num)
+        :return: [batches, array(seq_length,vehicle_num,...)]
+        '''
+        offsets = np.cumsum(scene_shape[:, 0] * scene_shape[:, 1])[:-1]
+        return [one.reshape(shape[0], shape[1], *rows.shape[1:]) for one, shape in zip(np.split(rows, offsets), scene_shape)]
+
+    def cutTofinal(self, zip_data):
+        '''
+        每组数据按Global_Time首次出现的顺序稳定排序后重排为稠密数组
+        :param zip_data: [19, (array(2600,6), array(2600,))]  组内数据及帧编号
+        :return: [19, array(100,26,6)]
+        '''
+        for seq, (one_zip_data, frame_codes) in enumerate(zip_data):
+            frame_codes = frame_codes - frame_codes.min() if len(frame_codes) else frame_codes
+            frame_count = np.bincount(frame_codes)
+            vehicle_num = frame_count[0] if len(frame_count) else 0
+            if np.any(frame_count != vehicle_num):
+                raise ValueError("第{}组数据各帧车辆数不一致".format(seq))
+            order = np.argsort(frame_codes, kind="stable")
+            zip_data[seq] = one_zip_data[order].reshape(len(frame_count), vehicle_num, len(self.output_col))
 
         return zip_data
 
-    def cutbyDelimiter(self, init_data):
+    def readScenes(self, csv_source, scenes):
+        '''
+        按组索引seek到各组，只读该组的字节范围
+        :param csv_source: 已处理好csv文件位置
+        :param scenes: 组序号
+        :return: ([组数, 一组的csv字节(不含表头)], csv表头各列名称)
         '''
+        index = loadSceneIndex(csv_source)
+        with open(csv_source, "rb") as f:
+            columns = pd.read_csv(io.BytesIO(f.readline())).columns
+            scene_bytes = []
+            for start, end in zip(index["start"][scenes], index["end"][scenes]):
+                f.seek(start)
+                scene_bytes.append(f.read(end - start))
+        return scene_bytes, columns
 
+    def readParquet(self, parquet_file, need_col, scenes=None, locations=None):
+        '''
+        只读need_col列，scene_id、Location条件下推给pyarrow，按row group统计信息跳过无关的块
+        :param parquet_file: convertToParquet转换的parquet文件
+        :param need_col: 所需列名称
+        :param scenes: 组序号，按给出的顺序返回；None为全部
+        :param locations: Location取值；None为全部
+        :return: [组数, (组内数据array(rows,len(output_col)), 组内帧编号array(rows,))]，再经cutTofinal
+        '''
+        import pyarrow.parquet as pq
+        filters = []
+        if scenes is not None:
+            filters.append(("scene_id", "in", [int(scene) for scene in scenes]))
+        if locations is not None:
+            filters.append(("Location", "in", list(locations)))
+        table = pq.read_table(parquet_file, columns=list(dict.fromkeys(["scene_id"] + list(need_col))),
+                              filters=filters or None)
+
+        scene_id = table["scene_id"].to_numpy()
+        values = np.column_stack([table[col].to_numpy().astype(float) for col in self.output_col])
+        # 帧编号与cutbyDelimiter一样按(组号,Global_Time)首次出现的顺序编码
+        time_codes, time_uniques = pd.factorize(table["Global_Time"].to_numpy())
+        frame_codes, _ = pd.factorize(scene_id.astype(np.int64) * len(time_uniques) + time_codes)
+
+        # 写入时按scene_id有序，过滤后仍有序
+        scene_ids, first = np.unique(scene_id, return_index=True)
+        zip_data = dict(zip(scene_ids.tolist(), zip(np.split(values, first[1:]), np.split(frame_codes, first[1:]))))
+        order = scene_ids.tolist() if scenes is None else [int(scene) for scene in scenes if int(scene) in zip_data]
+        return [zip_data[scene] for scene in order]
+
+    def parseScenes(self, scenes, columns, need_col):
+        '''
+        各组csv字节一次解析，再按行数切开，与cutbyDelimiter、cutTofinal的结果一致
+        :param scenes: [组数, 一组的csv字节(不含表头)]
+        :param columns: csv表头各列名称
+        :param need_col: 所需列名称
+        :return: [组数, array(seq_length,vehicle_num,len(output_col))]
+        '''
+        rows = [scene.count(b"\n") for scene in scenes]
+        if sum(rows):
+            # round_trip与cutbyDelimiter中字符串列astype(float)的解析结果逐位一致
+            init_data = pd.read_csv(io.BytesIO(b"".join(scenes)), header=None, names=columns,
+                                    usecols=need_col, float_precision="round_trip", skip_blank_lines=False)
+            values, global_time = init_data[self.output_col].values.astype(float), init_data["Global_Time"].values
+        else:
+            values, global_time = np.zeros((0, len(self.output_col))), np.zeros(0)
+
+        offsets = np.cumsum(rows)[:-1]
+        zip_data = [(one_values, pd.factorize(one_time)[0])
+                    for one_values, one_time in zip(np.split(values, offsets), np.split(global_time, offsets))]
+        return self.cutTofinal(zip_data)
+
+    def cutbyDelimiter(self, init_data):
+        '''
+        用布尔掩码找到重复的表头分割行，按偏移量一次切分
+        最后一个分割行之后的数据与逐行实现一致，被丢弃
         :param init_data: 初始的带有分割行的df
-        :return: 分割后的df，在同一个list
-        '''
-        _index = 0
-        zip_data = []
-        for index, row in init_data.iterrows():
-            if row['Vehicle_ID'] == "Vehicle_ID":
-                zip_data.append(init_data[_index:index])
-                _index = index + 1
-        return zip_data
+        :return: 分割后的[(组内数据array(rows,len(output_col)), 组内帧编号array(rows,))]，在同一个list
+        '''
+        is_delimiter = (init_data['Vehicle_ID'] == "Vehicle_ID").values
+        delimiter = np.flatnonzero(is_delimiter)
+        if not len(delimiter):
+            return []
+
+        rows = np.flatnonzero(~is_delimiter[:delimiter[-1]])
+        values = init_data[self.output_col].values[rows].astype(float)
+
+        # 帧编号：(组号,Global_Time)按首次出现顺序编码，不同组的同一时刻不会合并
+        scene_index = np.cumsum(is_delimiter)[rows]
+        time_codes, time_uniques = pd.factorize(init_data['Global_Time'].values[rows])
+        frame_codes, _ = pd.factorize(scene_index * len(time_uniques) + time_codes)
+
+        offsets = delimiter[:-1] - np.arange(len(delimiter) - 1)  # 分割行之前的数据行数
+        return list(zip(np.split(values, offsets), np.split(frame_codes, offsets)))
 
     def __getitem__(self, item):
         '''
-        继续init的步骤，从提取的[batchs,seq_length,df(26,8)]中输出数据
+        继续init的步骤，从提取的[batchs,array(seq_length,26,6)]中输出数据
         筛选了19组数据，每组数据包含100个时间点，第一组数据中有26辆车，共输入8个特征
         提取数据，[num_batch,df(seq_length*vehicle_num,len(need_col)]
         long_term=False:
             输出x:tensor(seq_length-1,vehicle_num,9)
                 9个特征[local_x,local_y,v_length,v_width,motor,auto,truck,turn_left,turn_right]
             输出y:tensor(seq_length-1,vehicle_num,2)
-            输出grids:tensor(seq_len-1,vehicle_num,grids_height,grids_width)
+            输出grids:tensor(K,5)，seq_len-1帧中有车格子的稀疏索引，每行(frame,target,row,col,neighbor)
         long_term=True:
             输出x:tensor(seq_length/2,vehicle_num,9)
                 9个特征[local_x,local_y,v_length,v_width,motor,auto,truck,turn_left,turn_right]
             输出y:tensor(seq_length/2,vehicle_num,2)
-            输出grids:tensor(seq_len=99,vehicle_num,grids_height,grids_width)
+            输出grids:tensor(K,5)，前seq_length/2帧的稀疏索引
+        输出Local_Y:tensor(2,) float64，(min_Local_Y,max_Local_Y)
+            随样本一起返回而不是写在数据集对象上，DataLoader多进程加载时主进程也能拿到正确的值
         '''
-        grids = []
-        seq_data = []
-        # zip_data[item]： [seq_length=100,df(vehicle_num=26,vec=8)]  one_frame_df:df(vehicle_num=26,vec=8)
-        for one_frame_df in self.zip_data[item]:
-            one_frame_df = one_frame_df.loc[:, self.output_col]  # df(vehicle_num=26,vec=6)
-            grid = self.getGrid(one_frame_df)
-            grids.append(grid)
-            seq_data.append(one_frame_df.values.astype(float))
+        offset = 0
+        if self.window_index is not None:
+            item, offset = self.window_index[item]
+        elif self.scene_index is not None:
+            item = self.scene_index[item]
+        if self.cache is not None:
+            seq_data, grids = self.cache["seq_data"][item], self.cache["grids"][item]
+            Local_Y = self.cache["Local_Y"][item]
+        else:
+            seq_data, grids, Local_Y = self.computeScene(self.zip_data[item])
+        if self.window_index is not None:
+            seq_data, grids = self.windowSlice(seq_data, grids, offset)
+        return self.makeSample(seq_data, grids, Local_Y)
+
+    def windowSlice(self, seq_data, grids, offset):
+        '''
+        切出从offset帧开始的window帧，归一化沿用整组的结果
+        :return: (seq_data视图, 窗口内的grids)，grids只在offset>0时复制一份并把frame减去offset
+        '''
+        seq_data = seq_data[offset:offset + self.window]
+        low, high = np.searchsorted(grids[:, 0], [offset, offset + self.window])
+        grids = grids[low:high]
+        if offset:
+            grids = grids.copy()
+            grids[:, 0] -= offset
+        return seq_data, grids
+
+    def makeSample(self, seq_data, grids, Local_Y):
+        '''
+        按long_term把一组的特征与grids切成输入输出，均为视图不复制
+        :param seq_data: array(seq_length,vehicle_num,9) float32
+        :param grids: array(K,5) int16，按frame有序
+        :param Local_Y: (min_Local_Y,max_Local_Y)
+        :return: 同__getitem__
+        '''
+        Local_Y = torch.from_numpy(np.asarray(Local_Y, dtype=float))
 
         # 非长时预测
         if not self.long_term:
-            grids = np.array(grids[:-1])  # [seq_length-1,grids_height,grids_width]
-
-            seq_data = np.array(seq_data)
-            seq_data = self.normalization(seq_data=seq_data, col_seq=self.col_seq)
+            grids = grids[:np.searchsorted(grids[:, 0], len(seq_data) - 1)]  # 前seq_length-1帧，grids按frame有序
 
             x_seq_data = seq_data[:-1]  # [seq_length-1,df(vehicle_num=26,vec=6)]
             y_seq_data = seq_data[1:, :,
                          self.col_seq['Local_X']:self.col_seq['Local_Y'] + 1]  # [seq_length-1,df(vehicle_num=26,vec=2)]
 
-            return x_seq_data, y_seq_data, grids
+            return torch.from_numpy(x_seq_data), torch.from_numpy(y_seq_data), torch.from_numpy(grids), Local_Y
 
         # 长时预测
         else:
-            grids = np.array(grids)[0:len(grids) // 2]  # [seq_length/2,grids_height,grids_width]
-
-            seq_data = np.array(seq_data)
-            seq_data = self.normalization(seq_data=seq_data, col_seq=self.col_seq)
+            grids = grids[:np.searchsorted(grids[:, 0], len(seq_data) // 2)]  # 前seq_length/2帧
 
             x_seq_data = seq_data[:seq_data.shape[0] // 2]  # [seq_length/2,df(vehicle_num=26,vec=6)]
             y_seq_data = seq_data[seq_data.shape[0] // 2:, :,
                          self.col_seq['Local_X']:self.col_seq['Local_Y'] + 1]  # [seq_length/2,df(vehicle_num=26,vec=2)]
 
-            return x_seq_data, y_seq_data, grids
+            return torch.from_numpy(x_seq_data), torch.from_numpy(y_seq_data), torch.from_numpy(grids), Local_Y
 
     def normalization(self, seq_data, col_seq):  # [100,26,6]
         '''
-        归一化x_seq_data
+        归一化x_seq_data，按float64计算后直接写入预分配的float32输出数组，不修改传入的seq_data和数据集对象
         :param seq_data: array(seq_length=100,vehicle_num=26,vec=8)
                          vec=("Local_X","Local_Y","v_length","v_Width","v_Class","Lane_ID")
         :param col_seq: 列的排列顺序
-        :param min_Local_Y: 最小y
-        :param max_Local_Y: 最大y
-        :return: seq_data array(seq_length=99,vehicle_num=26,vec=9)
+        :return: seq_data array(seq_length=99,vehicle_num=26,vec=9) float32
                  vec=[local_x,local_y,v_length,v_width,motor,auto,truck,turn_left,turn_right]
+                 Local_Y (min_Local_Y,max_Local_Y) 反归一化用
         '''
+        # 去掉v_Class、Lane_ID后的原有列在前，之后是motor,auto,truck和turn_left,turn_right
+        keep = [seq for seq in range(seq_data.shape[-1]) if seq not in (col_seq["v_Class"], col_seq["Lane_ID"])]
+        out = np.empty(seq_data.shape[:-1] + (len(keep) + 5,), dtype=np.float32)
+        out[..., :len(keep)] = seq_data[..., keep]
+        new_col = {col: keep.index(seq) for col, seq in col_seq.items() if seq in keep}
+
         # local_X归一化
-        seq_data[:, :, col_seq['Local_X']] = seq_data[:, :, col_seq['Local_X']] / (self.road_info["max_Local_X"])
+        out[..., new_col['Local_X']] = seq_data[..., col_seq['Local_X']] / (self.road_info["max_Local_X"])
 
         # local_Y归一化
-        self.min_Local_Y, self.max_Local_Y = np.min(seq_data[:, :, col_seq['Local_Y']]), np.max(
-            seq_data[:, :, col_seq['Local_Y']]) + 20
-        seq_data[:, :, col_seq['Local_Y']] = (seq_data[:, :, col_seq['Local_Y']] - self.min_Local_Y) / (
-                self.max_Local_Y - self.min_Local_Y)
-        # seq_data[:, :, col_seq['Local_Y']] = (seq_data[:, :,col_seq['Local_Y']]) /self.road_info["max_Local_Y"]
+        local_y = seq_data[..., col_seq['Local_Y']]
+        # 没有车辆的空组没有取值范围，按min_Local_Y=0处理，输出也是空的
+        min_Local_Y, max_Local_Y = (np.min(local_y), np.max(local_y) + 20) if local_y.size else (0.0, 20.0)
+        out[..., new_col['Local_Y']] = (local_y - min_Local_Y) / (max_Local_Y - min_Local_Y)
 
         # v_length归一化
-        seq_data[:, :, col_seq["v_length"]] = (seq_data[:, :, col_seq["v_length"]] - self.road_info[
+        out[..., new_col["v_length"]] = (seq_data[..., col_seq["v_length"]] - self.road_info[
             "min_v_length"]) / (self.road_info["max_v_length"] - self.road_info["min_v_length"])
 
         # v_width归一化
-        seq_data[:, :, col_seq["v_Width"]] = (seq_data[:, :, col_seq["v_Width"]] - self.road_info[
+        out[..., new_col["v_Width"]] = (seq_data[..., col_seq["v_Width"]] - self.road_info[
             "min_v_Width"]) / (self.road_info["max_v_Width"] - self.road_info["min_v_Width"])
 
-        # v_Class归一化
-        v_Class = seq_data[:, :, col_seq["v_Class"]]
-        v_Class = self.oneHot_v_Class(v_Class)
-        seq_data = np.concatenate([seq_data, v_Class], axis=2)  # motor,auto,truck
-
-        # Lane_ID归一化
-        Land_ID = seq_data[:, :, col_seq["Lane_ID"]]
-        Land_ID = self.exeLane_ID(Land_ID)
-        seq_data = np.concatenate([seq_data, Land_ID], axis=2)
-        seq_data = np.delete(seq_data, [col_seq["v_Class"], col_seq["Lane_ID"]], axis=2)
-        return seq_data
+        # v_Class、Lane_ID查表
+        out[..., len(keep):len(keep) + 3] = self.oneHot_v_Class(seq_data[..., col_seq["v_Class"]])  # motor,auto,truck
+        out[..., len(keep) + 3:] = self.exeLane_ID(seq_data[..., col_seq["Lane_ID"]])
+        return out, (min_Local_Y, max_Local_Y)
 
     def exeLane_ID(self, data):
         '''
-        处理车道 二维数组
-        输入：narray[seq_length, vehicle_ID,1]
+        处理车道，查表代替逐车判断：1号车道[0,1]，5号车道[1,0]，其余[1,1]
+        输入：narray[seq_length, vehicle_ID]
         输出：narray[seq_length, vehicle_ID,2]
         '''
-        exeLane_ID_data = []
-        for frame in data:
-            vehicle_data = []
-            for one_vehicle in frame:
-                if one_vehicle == 1:
-                    vehicle_data.append([0, 1])
-                elif one_vehicle == 5:
-                    vehicle_data.append([1, 0])
-                else:
-                    vehicle_data.append([1, 1])
-            exeLane_ID_data.append(vehicle_data)
-        return np.array(exeLane_ID_data)
+        return np.stack([data != 1, data != 5], axis=-1).astype(int)
 
     def oneHot_v_Class(self, data):
         '''
-        One hot 二维数组
-        输入：narray[seq_length, vehicle_ID,1]
+        One hot，np.eye(3)按v_Class-1整体索引，与逐帧实现一样向0截断
+        输入：narray[seq_length, vehicle_ID]
         输出：narray[seq_length, vehicle_ID,3]
         '''
-        one_hot_data = []
-        for frame in data:
-            one_hot_data.append(np.eye(3)[np.array(frame - 1, dtype=np.int)])
-        return np.array(one_hot_data, dtype=np.int)
+        return np.eye(3, dtype=int)[np.asarray(data - 1).astype(int)]
 
-    def getGrid(self, x_seq, from_df=1):
+    def getGrid(self, x_seq, from_df=1, sparse=False, valid=None):
         '''
         亮瞎眼金坷垃闪光BUFF：为每一帧，每一辆车作为目标车，生成一个[grids_width,grids_height]的网格
         :param x_seq: df(vehicle_num=26,input_size=6)，只需要input_size的前两项，即Local_x，Local_y
+                      from_df=0时可为array/tensor(...,vehicle_num,input_size)，带帧维度时一次算完一组
         :param grids_width:横向格子数,奇数！
         :param grids_height:纵向格子数，奇数！
         :param meter_per_grid:格子边长代表的米数
         :param from_df:长时运算传入的非df
+        :param sparse:返回有车格子的稀疏索引而非稠密掩码
+        :param valid: array/tensor(...,vehicle_num) bool 有效车辆，补齐的车辆不参与；None为全部有效
 
-        :return:[vehicle_num=26,grids_height,grids_width]用以过滤hidden_state
+        :return:sparse=False: [...,vehicle_num=26,grids_height,grids_width]用以过滤hidden_state，没车为-1
+                sparse=True: array(K,5)，每行(frame,target,row,col,neighbor)；x_seq为tensor时见getGridTensor
         '''
         center_width = int(self.grids_width / 2)  # 对于5就是2  [0,1,2,3,4]
         center_height = int(self.grids_height / 2)  # 对于39就是19
 
-        vehicle_num = x_seq.shape[0]
-
-        masks = np.zeros((vehicle_num, self.grids_height, self.grids_width)) - 1  # | 土 |  (39,5)
-
+        if sparse and torch.is_tensor(x_seq):
+            return self.getGridTensor(x_seq, valid=valid)
         if from_df:
             x_seq = x_seq.values.astype(float)
+        elif hasattr(x_seq, "detach"):
+            x_seq = x_seq.detach().cpu().numpy()
+
+        # 显式给出帧数，没有车辆的空组(相邻两个分割行)也能reshape，得到空的grids
+        frames, vehicle_num = int(np.prod(x_seq.shape[:-2])), x_seq.shape[-2]
+        local_x = x_seq[..., self.col_seq["Local_X"]].reshape(frames, vehicle_num)
+        local_y = x_seq[..., self.col_seq["Local_Y"]].reshape(frames, vehicle_num)
+        if valid is not None:
+            valid = np.asarray(valid, dtype=bool).reshape(frames, vehicle_num)
 
-        for vehicle_a, vehicle_b in itertools.combinations(list(range(vehicle_num)), 2):
+        # 候选对(frame,target,neighbor)及以target作为目标车时neighbor的相对格数，与int()一样向0截断
+        if self.grid_search == "sweep":
+            frame, target, neighbor = self.sweepPairs(local_y, (center_height + 2) * self.meter_per_grid)
+            width_dist = np.trunc((local_x[frame, neighbor] - local_x[frame, target]) / self.meter_per_grid)
+            height_dist = np.trunc((local_y[frame, neighbor] - local_y[frame, target]) / self.meter_per_grid)
+            width_dist, height_dist = width_dist.astype(int), height_dist.astype(int)
+            inside = (np.abs(width_dist) <= center_width) & (np.abs(height_dist) <= center_height)
+            if valid is not None:
+                inside &= valid[frame, target] & valid[frame, neighbor]
+            frame, target, neighbor = frame[inside], target[inside], neighbor[inside]
+            width_dist, height_dist = width_dist[inside], height_dist[inside]
+        else:
+            width_dist = np.trunc((local_x[:, None, :] - local_x[:, :, None]) / self.meter_per_grid).astype(int)
+            height_dist = np.trunc((local_y[:, None, :] - local_y[:, :, None]) / self.meter_per_grid).astype(int)
+            inside = (np.abs(width_dist) <= center_width) & (np.abs(height_dist) <= center_height) & \
+                     ~np.eye(vehicle_num, dtype=bool)
+            if valid is not None:
+                inside &= valid[:, :, None] & valid[:, None, :]
+            frame, target, neighbor = np.nonzero(inside)
+            width_dist, height_dist = width_dist[inside], height_dist[inside]
 
-            width_dist = int((x_seq[vehicle_a][self.col_seq["Local_X"]] - x_seq[vehicle_b][
-                self.col_seq["Local_X"]]) / self.meter_per_grid)  # 以b作为目标车时
-            height_dist = int((x_seq[vehicle_a][self.col_seq["Local_Y"]] - x_seq[vehicle_b][
-                self.col_seq["Local_Y"]]) / self.meter_per_grid)
+        shape = (local_x.shape[0], vehicle_num, self.grids_height, self.grids_width)
+        # 越往右侧x索引越大，越往上侧y索引越小
+        cell = np.ravel_multi_index((frame, target, center_height - height_dist, center_width + width_dist), shape)
 
-            if abs(width_dist) > center_width or abs(height_dist) > center_height:
+        # 同一格子落入多辆邻车时，逐对循环中最后写入的是序号最大的邻车，按(格子,邻车)排序后取每格最后一个
+        order = np.lexsort((neighbor, cell))
+        cell, neighbor = cell[order], neighbor[order]
+        last = np.ones(len(cell), dtype=bool)
+        last[:-1] = cell[1:] != cell[:-1]
+        if sparse:
+            # 每行(frame,target,row,col,neighbor)，按frame、target有序；多维输入时frame为展平后的序号
+            return np.stack(np.unravel_index(cell[last], shape) + (neighbor[last],), axis=1)
+
+        masks = np.full(shape, -1, dtype=int)
+        masks.reshape(-1)[cell[last]] = neighbor[last]
+        return masks.reshape(x_seq.shape[:-2] + shape[1:])
+
+    def getGridTensor(self, x_seq, valid=None):
+        '''
+        getGrid(sparse=True)的torch实现，在x_seq所在的设备上两两广播算完，不回到numpy，结果与getGrid逐位一致
+        长时预测每一步都要用预测出的位置重算grids，多组数据时第一维为组，一次算完整个batch
+        :param x_seq: tensor(...,vehicle_num,input_size)，只用Local_X、Local_Y
+        :param valid: tensor(...,vehicle_num) bool 有效车辆，补齐的车辆不参与；None为全部有效
+        :return: tensor(K,5) long，每行(frame,target,row,col,neighbor)，frame为展平后的序号，按frame、target有序
+        '''
+        x_seq = x_seq.detach()
+        frames, vehicle_num = int(np.prod(x_seq.shape[:-2])), x_seq.shape[-2]
+        if valid is not None:
+            valid = valid.reshape(frames, vehicle_num).to(torch.bool)
+        return pairwiseGrid(x_seq[..., self.col_seq["Local_X"]].reshape(frames, vehicle_num),
+                            x_seq[..., self.col_seq["Local_Y"]].reshape(frames, vehicle_num), valid,
+                            self.grids_width, self.grids_height, float(self.meter_per_grid))
+
+    def sweepPairs(self, local_y, search_length):
+        '''
+        按Local_Y排序后扫描，只保留纵向距离小于search_length的候选对，复杂度O(N·k)而非O(N²)
+        :param local_y: array(frames,vehicle_num)
+        :param search_length: 纵向搜索半径(米)，须不小于格子窗口半高，候选对之后还要按格子窗口精确筛选
+        :return: 候选对(frame,target,neighbor)，每对两个方向各出现一次
+        '''
+        frames, vehicle_num = local_y.shape
+        if not local_y.size:
+            empty = np.zeros(0, dtype=int)
+            return empty, empty, empty
+
+        # 各帧首尾相接排成一条轴，帧间留出大于搜索半径的间隔，一次searchsorted扫完所有帧
+        span = np.ptp(local_y) + 2 * search_length + 1
+        key = (local_y - np.min(local_y)) + np.arange(frames)[:, None] * span
+        order = np.argsort(key, axis=None, kind="stable")
+        key = key.reshape(-1)[order]
+
+        count = np.searchsorted(key, key + search_length, side="left") - np.arange(len(key)) - 1
+        first = np.repeat(np.arange(len(key)), count)
+        second = first + 1 + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+
+        frame, first = np.divmod(order[first], vehicle_num)
+        second = order[second] % vehicle_num
+        return np.concatenate([frame, frame]), np.concatenate([first, second]), np.concatenate([second, first])
+
+    def sampleShapes(self):
+        '''
+        :return: array(len(self),2) 每个样本__getitem__输出的(帧数,车辆数)，不计算特征和grids
+        '''
+        shapes = np.array([one_zip_data.shape[:2] for one_zip_data in self.zip_data], dtype=np.int64).reshape(-1, 2)
+        if self.window_index is not None:
+            shapes = shapes[self.window_index[:, 0]]
+            shapes[:, 0] = self.window
+        elif self.scene_index is not None:
+            shapes = shapes[self.scene_index]
+        shapes[:, 0] = self.sampleFrames(shapes[:, 0])
+        return shapes
+
+    def sampleFrames(self, frames):
+        '''
+        :param frames: 组(或窗口)的帧数，int或array
+        :return: makeSample输出x的帧数
+        '''
+        return frames // 2 if self.long_term else np.maximum(frames - 1, 0)
+
+    def __len__(self):
+        if self.window_index is not None:
+            return len(self.window_index)
+        if self.scene_index is not None:
+            return len(self.scene_index)
+        return len(self.zip_data)
+
+
+class myStreamDataSet(IterableDataset):
+    '''
+    流式读取的myDataSet，用于放不进内存的大文件：按块读取csv，读到分割行就输出前面的一组
+    同时在内存中的只有正在读的一组、一个读取块和打乱缓冲区里的buffer_scenes组
+    多进程加载时按字节范围把文件分给各加载进程，每个进程只读自己的范围，输出的组互不重复
+    输出与myDataSet.__getitem__相同，可直接配合collateScenes
+    '''
+
+    def __init__(self, csv_source, need_col, output_col, grids_width, grids_height, meter_per_grid, road,
+                 long_term=False, grid_search="pairwise", chunk_bytes=1 << 22, buffer_scenes=64, shuffle=True,
+                 seed=None):
+        '''
+        :param csv_source: 已处理好csv文件位置，各组之间以重复的表头分割
+        :param need_col: 所需列名称
+        :param output_col: 最终输出包含列
+        :param grids_width: 横向格子数
+        :param grids_height: 纵向格子数
+        :param meter_per_grid: 格子比例尺
+        :param road: 路面名称
+        :param long_term: 提取长时预测数据
+        :param grid_search: grids邻车搜索方式，见myDataSet
+        :param chunk_bytes: 每次读取的字节数
+        :param buffer_scenes: 打乱缓冲区的组数，即每个加载进程同时持有的组数上限
+        :param shuffle: 是否在缓冲区内打乱，False时按文件顺序输出且不缓冲
+        :param seed: 随机种子，每轮与加载进程序号一起决定打乱顺序
+        '''
+        # 特征与grids的计算沿用myDataSet，只初始化参数不读文件
+        self.scene_builder = myDataSet(None, need_col, output_col, grids_width, grids_height, meter_per_grid, road,
+                                       long_term=long_term, grid_search=grid_search)
+        self.road_info = self.scene_builder.road_info  # 与myDataSet一样供长时预测的model.getFunction使用
+        self.csv_source = csv_source
+        self.need_col = need_col
+        self.output_col = output_col
+        self.chunk_bytes = chunk_bytes
+        self.buffer_scenes = max(buffer_scenes, 1)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.scene_count = None
+
+        with open(csv_source, "rb") as f:
+            self.header = f.readline()  # 带换行符的表头，分割行与其完全相同
+        self.columns = pd.read_csv(io.BytesIO(self.header)).columns
+        self.delimiter = b"\n" + self.header
+        self.file_size = os.path.getsize(csv_source)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        start, end = self.file_size * worker_id // workers, self.file_size * (worker_id + 1) // workers
+        rng = np.random.default_rng(None if self.seed is None else (self.seed, self.epoch, worker_id))
+        self.epoch += 1
+
+        buffer = []
+        scenes = (one_zip_data for block in self.readScenes(start, end)
+                  for one_zip_data in self.scene_builder.parseScenes(block, self.columns, self.need_col))
+        for one_zip_data in scenes:
+            # 与myDataSet一样跳过没有车辆或切出的x没有帧的组
+            if not one_zip_data.shape[1] or not self.scene_builder.sampleFrames(one_zip_data.shape[0]):
                 continue
+            sample = self.scene_builder.makeSample(*self.scene_builder.computeScene(one_zip_data))
+            if not self.shuffle:
+                yield sample
+            elif len(buffer) < self.buffer_scenes:
+                buffer.append(sample)
             else:
-                # 越往右侧x索引越大，越往上侧y索引越小
-                masks[vehicle_b][center_height - height_dist][center_width + width_dist] = vehicle_a
-                masks[vehicle_a][center_height + height_dist][center_width - width_dist] = vehicle_b
-        return masks.astype(np.int)
+                # 缓冲区满后随机换出一组
+                seq = rng.integers(len(buffer))
+                yield buffer[seq]
+                buffer[seq] = sample
+        for seq in rng.permutation(len(buffer)):
+            yield buffer[seq]
+
+    def getGrid(self, x_seq, from_df=1, sparse=False, valid=None):
+        '''
+        长时预测时model.getFunction使用的grids计算，见myDataSet.getGrid
+        '''
+        return self.scene_builder.getGrid(x_seq, from_df=from_df, sparse=sparse, valid=valid)
+
+    def readScenes(self, start, end):
+        '''
+        按块读取起点落在[start,end)内的各组，最后一组可以读过end；最后一个分割行之后的数据与myDataSet一致，被丢弃
+        组的起点是表头或分割行之后的第一个字节，各加载进程的范围首尾相接，每组恰好被一个进程读到
+        :param start: 字节范围起点
+        :param end: 字节范围终点
+        :return: 生成器，每读一块输出该块内读完的各组[组数, 一组的csv字节(不含表头)]
+        '''
+        with open(self.csv_source, "rb") as f:
+            # buffer总是从上一行结尾的"\n"开始，base为该"\n"在文件中的位置，组的起点为base+1
+            # 这样紧跟在分割行后的分割行也能匹配到，得到与myDataSet一致的空组
+            if start <= len(self.header):
+                base = len(self.header) - 1
+                f.seek(base)
+                buffer = bytearray()
+            else:
+                # 起点不早于start的第一组：其前一个分割行的"\n"不早于start-len(delimiter)
+                base = start - len(self.delimiter)
+                f.seek(base)
+                buffer = bytearray()
+                while True:
+                    found = buffer.find(self.delimiter)
+                    if found >= 0:
+                        del buffer[:found + len(self.delimiter) - 1]
+                        base += found + len(self.delimiter) - 1
+                        break
+                    # 保留可能是分割行开头的尾部
+                    drop = max(len(buffer) - len(self.delimiter) + 1, 0)
+                    del buffer[:drop]
+                    base += drop
+                    block = f.read(self.chunk_bytes)
+                    if not block:
+                        return
+                    buffer += block
+
+            scenes, scan = [], 0
+            while base + 1 < end:
+                found = buffer.find(self.delimiter, scan)
+                if found >= 0:
+                    scenes.append(bytes(buffer[1:found + 1]))
+                    del buffer[:found + len(self.delimiter) - 1]
+                    base += found + len(self.delimiter) - 1
+                    scan = 0
+                    continue
+                if scenes:
+                    yield scenes
+                    scenes = []
+                block = f.read(self.chunk_bytes)
+                if not block:
+                    return
+                scan = max(len(buffer) - len(self.delimiter) + 1, 0)
+                buffer += block
+            if scenes:
+                yield scenes
 
     def __len__(self):
-        return len(self.zip_data)
+        '''
+        :return: 组数，即分割行的个数；只在第一次调用时扫描一遍文件，不解析内容
+                 含__iter__跳过的空组，是实际输出组数的上界
+        '''
+        if self.scene_count is None:
+            # 数表头出现的次数再减去文件开头的表头；相邻的分割行共用换行符，不能直接数delimiter
+            self.scene_count = -1
+            with open(self.csv_source, "rb") as f:
+                tail = b""
+                for block in iter(lambda: f.read(self.chunk_bytes), b""):
+                    # 保留上一块的尾部，跨块的分割行不会漏计
+                    block = tail + block
+                    self.scene_count += block.count(self.header)
+                    tail = block[-(len(self.header) - 1):]
+        return self.scene_count
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    按车辆数分桶的batch_sampler，配合collateScenes使用，减少补齐的车辆
+    各组按(帧数,车辆数//bucket_width)排序，桶内打乱后依次装batch，
+    batch补齐后的车辆数*帧数不超过max_tokens，单组超出时独占一个batch；最后打乱batch顺序
+    帧数不同的组总是分在不同的batch，collateScenes只沿车辆维补齐
+    '''
+
+    def __init__(self, shapes, max_tokens, bucket_width=1, shuffle=True, seed=None):
+        '''
+        :param shapes: array(batches,2) 每组的(帧数,车辆数)，见myDataSet.sampleShapes
+        :param max_tokens: 每个batch补齐后车辆数*帧数的上限
+        :param bucket_width: 车辆数相差在bucket_width以内的组视为同一桶，越大各轮的batch组合越随机
+        :param shuffle: 桶内和batch顺序是否打乱，False时每轮相同
+        :param seed: 随机种子
+        '''
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.next_batches = None  # __len__时提前排好的下一轮batch
+
+    def planBatches(self):
+        '''
+        :return: [[组序号]] 一轮的全部batch
+        '''
+        order = self.rng.permutation(len(self.shapes)) if self.shuffle else np.arange(len(self.shapes))
+        frames, vehicles = self.shapes[order, 0], self.shapes[order, 1]
+        order = order[np.lexsort((vehicles // self.bucket_width, frames))]
+
+        batches, batch, max_vehicles = [], [], 0
+        for item in order.tolist():
+            item_frames, item_vehicles = self.shapes[item]
+            if batch and (item_frames != self.shapes[batch[0], 0] or
+                          (len(batch) + 1) * max(max_vehicles, item_vehicles) * item_frames > self.max_tokens):
+                batches.append(batch)
+                batch, max_vehicles = [], 0
+            batch.append(item)
+            max_vehicles = max(max_vehicles, item_vehicles)
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[seq] for seq in self.rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.next_batches if self.next_batches is not None else self.planBatches()
+        self.next_batches = None
+        return iter(batches)
+
+    def __len__(self):
+        if self.next_batches is None:
+            self.next_batches = self.planBatches()
+        return len(self.next_batches)
+
+
+def collateScenes(batch):
+    '''
+    多组数据沿车辆维补齐到同一车辆数后拼成一个batch，帧数须一致
+    第b组的车辆位于[b*vehicle_num, b*vehicle_num+N_b)，补齐的车辆输入为0且不出现在grids中
+    :param batch: [(x(seq_length,N_b,9), y(seq_length,N_b,2), grids(K_b,5), Local_Y(2,))]
+    :return: x:tensor(seq_length,batch*vehicle_num,9)
+             y:tensor(seq_length,batch*vehicle_num,2)
+             grids:tensor(K,5)，target和neighbor已加上所在组的偏移，按frame有序
+             mask:tensor(batch,vehicle_num) bool，有效车辆
+             Local_Y:tensor(batch,2)
+    '''
+    x, y, grids, Local_Y = zip(*batch)
+    if len(batch) == 1:  # 单组不用补齐，直接返回数据集中的视图
+        return x[0], y[0], grids[0], torch.ones(1, x[0].shape[1], dtype=torch.bool), Local_Y[0][None]
+    if len({len(one_x) for one_x in x}) > 1:
+        raise ValueError("同一batch内各组帧数须一致")
+    frames, vehicle_num = x[0].shape[0], max(one_x.shape[1] for one_x in x)
+
+    batch_x = x[0].new_zeros(frames, len(batch), vehicle_num, x[0].shape[2])
+    batch_y = y[0].new_zeros(frames, len(batch), vehicle_num, y[0].shape[2])
+    mask = torch.zeros(len(batch), vehicle_num, dtype=torch.bool)
+    for seq, (one_x, one_y) in enumerate(zip(x, y)):
+        batch_x[:, seq, :one_x.shape[1]] = one_x
+        batch_y[:, seq, :one_y.shape[1]] = one_y
+        mask[seq, :one_x.shape[1]] = True
+
+    # 加上组偏移后int16可能不够
+    dtype = grids[0].dtype if len(batch) * vehicle_num <= torch.iinfo(grids[0].dtype).max else torch.int32
+    batch_grids = torch.cat(grids).to(dtype)
+    offsets = torch.repeat_interleave(torch.arange(len(batch)) * vehicle_num,
+                                      torch.tensor([len(one_grids) for one_grids in grids]))
+    batch_grids[:, 1] += offsets.to(dtype)
+    batch_grids[:, 4] += offsets.to(dtype)
+    batch_grids = batch_grids[torch.argsort(batch_grids[:, 0], stable=True)]
+
+    return batch_x.reshape(frames, -1, batch_x.shape[-1]), batch_y.reshape(frames, -1, batch_y.shape[-1]), \
+           batch_grids, mask, torch.stack(Local_Y)
+
+
+def collatePacked(batch):
+    '''
+    多组数据沿车辆维直接拼接成一个batch，不补齐，帧数须一致
+    第b组的车辆位于[offsets[b], offsets[b+1])，grids的target和neighbor加上offsets[b]，仍只指向本组车辆
+    :param batch: [(x(seq_length,N_b,9), y(seq_length,N_b,2), grids(K_b,5), Local_Y(2,))]
+    :return: x:tensor(seq_length,sum(N_b),9)
+             y:tensor(seq_length,sum(N_b),2)
+             grids:tensor(K,5)，按frame有序
+             offsets:tensor(batch+1,) long
+             Local_Y:tensor(batch,2)
+    '''
+    x, y, grids, Local_Y = zip(*batch)
+    if len({len(one_x) for one_x in x}) > 1:
+        raise ValueError("同一batch内各组帧数须一致")
+    offsets = torch.cumsum(torch.tensor([0] + [one_x.shape[1] for one_x in x]), 0)
+
+    dtype = grids[0].dtype if offsets[-1] <= torch.iinfo(grids[0].dtype).max else torch.int32
+    batch_grids = torch.cat(grids).to(dtype)
+    shift = torch.repeat_interleave(offsets[:-1], torch.tensor([len(one_grids) for one_grids in grids])).to(dtype)
+    batch_grids[:, 1] += shift
+    batch_grids[:, 4] += shift
+    batch_grids = batch_grids[torch.argsort(batch_grids[:, 0], stable=True)]
+    return torch.cat(x, dim=1), torch.cat(y, dim=1), batch_grids, offsets, torch.stack(Local_Y)
+
+
+class BatchAugment(object):
+    '''
+    作为collate_fn在collateScenes之后对整个batch做数据增强，全部为tensor运算，不回到pandas和逐组计算
+    抽帧：每个batch随机选一个time_scales中的间隔s，每s帧取一帧，相当于s倍速的轨迹
+    镜像：每组以mirror的概率关于1、5号车道的中线横向翻转，1、5号车道的标志随之互换；翻转后有车越出路面的组不翻转
+    抖动：输入位置加上标准差为jitter米的高斯噪声，预测目标不变
+    位置有变化时按新的输入位置整个batch一次重算grids
+    '''
+
+    def __init__(self, dataset, jitter=0.0, mirror=0.0, time_scales=(1,)):
+        '''
+        :param dataset: 提供grids参数、road_info和long_term的myDataSet或myStreamDataSet
+        :param jitter: 位置抖动的标准差(米)，0为不抖动
+        :param mirror: 每组横向镜像的概率
+        :param time_scales: 抽帧间隔的候选，(1,)为不抽帧
+        '''
+        dataset = getattr(dataset, "scene_builder", dataset)
+        # 加载进程只需要参数，不带组数据
+        self.grid_builder = copy.copy(dataset)
+        self.grid_builder.init_data, self.grid_builder.zip_data, self.grid_builder.cache = None, None, None
+        self.grid_builder.window_index, self.grid_builder.scene_index = None, None
+        self.long_term = dataset.long_term
+        self.jitter = jitter
+        self.mirror = mirror
+        self.time_scales = list(time_scales)
+        road_info = dataset.road_info
+        self.max_Local_X = road_info["max_Local_X"]
+        self.mirror_axis = road_info["lane_one_max"] + road_info["lane_five_min"]  # 翻转为axis-x，米
+
+    def __call__(self, batch):
+        return self.augment(*collateScenes(batch))
+
+    def augment(self, x, y, grids, mask, Local_Y):
+        '''
+        :param x, y, grids, mask, Local_Y: collateScenes的输出
+        :return: 同collateScenes，抽帧后帧数变少
+        '''
+        scale = self.time_scales[torch.randint(len(self.time_scales), ()).item()]
+        if scale > 1:
+            x, y, grids = self.subsample(x, y, grids, scale)
+
+        scene_num, vehicle_num = mask.shape
+        moved = False
+        if self.mirror > 0:
+            flip = (torch.rand(scene_num) < self.mirror) & self.canMirror(x, y, mask)
+            if flip.any():
+                x, y = x.clone(), y.clone()
+                vehicle_flip = flip.repeat_interleave(vehicle_num) & mask.reshape(-1)  # 补齐的车辆保持为0
+                axis = self.mirror_axis / self.max_Local_X
+                x[:, vehicle_flip, 0] = axis - x[:, vehicle_flip, 0]
+                y[:, vehicle_flip, 0] = axis - y[:, vehicle_flip, 0]
+                x[:, vehicle_flip, -2:] = x[:, vehicle_flip, -2:].flip(-1)
+                moved = True
+        if self.jitter > 0:
+            scale_y = (Local_Y[:, 1] - Local_Y[:, 0]).to(x.dtype).repeat_interleave(vehicle_num)
+            noise = torch.randn(x.shape[:2] + (2,), dtype=x.dtype) * self.jitter
+            noise = noise / torch.stack([torch.full_like(scale_y, self.max_Local_X), scale_y], dim=1)
+            x = x.clone()
+            x[..., :2] += noise * mask.reshape(1, -1, 1)
+            moved = True
+        if moved:
+            grids = self.regrid(x, mask, Local_Y).to(grids.dtype)
+        return x, y, grids, mask, Local_Y
+
+    def subsample(self, x, y, grids, scale):
+        '''
+        每scale帧取一帧，短时预测为输入帧的下一帧，长时预测的前后两半各保留相同帧数
+        :return: (x, y, grids)，grids的frame按新的帧序号
+        '''
+        if self.long_term:
+            position = torch.cat([x[..., :2], y])  # 第t帧的位置
+            frames = x.shape[0] // scale
+            y = position[frames * scale:2 * frames * scale:scale]
+        else:
+            position = torch.cat([x[:1, :, :2], y])
+            frames = (x.shape[0]) // scale
+            y = position[scale:(frames + 1) * scale:scale]
+        x = x[:frames * scale:scale]
+        keep = (grids[:, 0] % scale == 0) & (grids[:, 0] < frames * scale)
+        grids = grids[keep].clone()
+        grids[:, 0] //= scale
+        return x, y, grids
+
+    def canMirror(self, x, y, mask):
+        '''
+        :return: tensor(batch,) bool，各组翻转后所有有效车辆仍在[0,max_Local_X]内
+        '''
+        scene_num, vehicle_num = mask.shape
+        local_x = torch.cat([x[..., 0], y[..., 0]]).reshape(-1, scene_num, vehicle_num) * self.max_Local_X
+        inside = ((local_x >= self.mirror_axis - self.max_Local_X) & (local_x <= self.mirror_axis)) | ~mask
+        return inside.all(dim=0).all(dim=1)
+
+    def regrid(self, x, mask, Local_Y):
+        '''
+        反归一化出输入位置，整个batch一次重算grids
+        :return: tensor(K,5)，与collateScenes一样target和neighbor带组偏移，按frame有序
+        '''
+        frames = x.shape[0]
+        scene_num, vehicle_num = mask.shape
+        position = x[..., :2].reshape(frames, scene_num, vehicle_num, 2).float()
+        Local_Y = Local_Y.to(position)
+        position = torch.stack([position[..., 0] * self.max_Local_X,
+                                position[..., 1] * (Local_Y[:, 1] - Local_Y[:, 0])[:, None] + Local_Y[:, 0][:, None]],
+                               dim=-1)
+        grids = self.grid_builder.getGridTensor(position.reshape(frames * scene_num, vehicle_num, 2),
+                                                valid=mask.expand(frames, -1, -1))
+        # frame列为(帧,组)展平后的序号
+        frame, scene = grids[:, 0] // scene_num, grids[:, 0] % scene_num
+        return torch.stack([frame, grids[:, 1] + scene * vehicle_num, grids[:, 2], grids[:, 3],
+                            grids[:, 4] + scene * vehicle_num], dim=1)
+
+
+def makeDataLoader(dataset, conf, shuffle=True, augment=False, packed=False):
+    '''
+    按train_conf中的加载参数构建DataLoader，样本自带反归一化参数，可以多进程加载
+    :param dataset: myDataSet或myStreamDataSet
+    :param conf: train_conf，使用batch_tokens、bucket_width(或batch_size)、num_workers、prefetch_factor
+    :param shuffle: 是否打乱，myStreamDataSet在构建时指定
+    :param augment: 是否按conf.augment做数据增强，只用于训练集
+    :param packed: 各组直接拼接不补齐，每个batch为collatePacked的输出，mask换为offsets；数据增强只支持补齐的batch
+    :return: DataLoader，每个batch为collateScenes的输出
+    '''
+    workers = conf.num_workers
+    if isinstance(dataset, IterableDataset):
+        # 流式读取时各组的形状事先未知，只能按读到的顺序每batch_size组一个batch
+        batching = {"batch_size": conf.batch_size}
+    elif conf.batch_tokens:
+        batching = {"batch_sampler": BucketBatchSampler(dataset.sampleShapes(), conf.batch_tokens,
+                                                        bucket_width=conf.bucket_width, shuffle=shuffle)}
+    else:
+        batching = {"batch_size": conf.batch_size, "shuffle": shuffle}
+    collate_fn = collatePacked if packed else collateScenes
+    if augment and conf.augment:
+        if packed:
+            raise ValueError("数据增强只支持collateScenes补齐的batch")
+        collate_fn = BatchAugment(dataset, jitter=conf.augment_jitter, mirror=conf.augment_mirror,
+                                  time_scales=conf.augment_time_scales)
+    return DataLoader(dataset, collate_fn=collate_fn, num_workers=workers, persistent_workers=workers > 0,
+                      prefetch_factor=conf.prefetch_factor if workers > 0 else None, **batching)
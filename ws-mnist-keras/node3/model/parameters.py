@@ -1,6 +1,7 @@
 class dataExecute_conf(object):
     def __init__(self):
-        self.data_source = "./data/data.csv"
+        self.data_source = "./data/data.csv"  # 原始NGSIM轨迹数据，见data_execute.py
+        self.output = "./data/train.csv"  # 切分结果，以重复的表头分割各组
         self.road = "us-101"
         self.useCols = [
             "Vehicle_ID",
@@ -18,21 +19,33 @@ class dataExecute_conf(object):
             "v_Vel",
             "Lane_ID"
         ]
-        self.area_length = 80
-        self.time_length = 10
-        self.area_step = 30
-        self.time_step = 30
-        self.stride = 5.0
-        self.hist_dist = 6
-        self.hist_time = 7
+        self.area_length = 80  # 区域长度(米)，首帧Local_Y在区域内的车为一组
+        self.time_length = 10  # 每组时长(秒)
+        self.area_step = 30  # 相邻区域起点的间隔(米)
+        self.time_step = 30  # 相邻时间窗口起点的间隔(秒)
+        self.stride = 5.0  # 组内相邻两帧间隔的原始帧数
+        self.hist_dist = 6  # noise=True时，原始相邻两帧位移超过此值(米)的车视为噪声去掉
+        self.hist_time = 7  # noise=True时，Local_X、Local_Y滑动平均的原始帧数
         self.noise = True
-        self.need_num = 10
+        self.need_num = 10  # 每组至少的车辆数
+        self.meter_per_foot = 0.3048  # 原始数据长度单位换算，已是米时为1
+        self.ms_per_frame = 100  # 原始数据帧间隔(毫秒)，Global_Time除以此值为帧序号，只用于切分
+        self.csv_time_unit = 100  # 输出csv中Global_Time的单位(毫秒)：随附的train.csv、test.csv为原始毫秒/100；1为原样写出毫秒
+        self.workers = None  # 切分进程数，None为CPU核数
+        self.partition_strategy = "iid"  # 训练集划分给各节点的方式：iid、lane、time、location，见partition.py
+        self.partition_workspaces = ["./ws-mnist-keras", "./ws2-mnist-pytorch"]  # 每个workspace为一组节点
+        self.partition_nodes = 3  # 每个workspace的节点数
+        self.shards_per_node = 1  # 非IID划分时每个节点分到的片数，越大越接近IID
+        self.partition_seed = 0
 
 
 class train_conf(object):
     def __init__(self):
         self.train_csv_source = "./data/train.csv"
         self.test_csv_source = "./data/test.csv"
+        self.train_scenes = None  # 本节点加载的训练组序号，如range(0, 1000)，按csv旁的组索引只读这些组；None为全部
+        self.train_locations = None  # 本节点加载的Location，如["us-101"]，训练集须为convertToParquet转换的parquet
+        self.cache_dir = "./data/cache"  # 预处理结果缓存目录，None不缓存；多个节点可指向同一目录共享
         self.road_name = "US101_info"
         self.need_col = [
             "Vehicle_ID",
@@ -55,7 +68,24 @@ class train_conf(object):
         self.grids_width = 5
         self.grids_height = 19
         self.meter_per_grid = 2
+        self.grid_search = "pairwise"  # grids邻车搜索：pairwise两两广播；sweep排序扫描，车多的稠密场景更快
+        self.precompute = True  # 构建时多进程预计算全部grids，训练和测试时只做切片
+        self.precompute_workers = None  # 预计算进程数，None为CPU核数
+        self.batch_size = 8  # 每个batch的组数，各组沿车辆维补齐，见data_loader.collateScenes
+        self.batch_tokens = 8000  # 按车辆数分桶组batch，补齐后车辆数*帧数的上限；None时按batch_size随机组batch
+        self.bucket_width = 4  # 车辆数相差在此以内的组视为同一桶
+        self.num_workers = 2  # DataLoader加载进程数，0为主进程加载
+        self.prefetch_factor = 2  # 每个加载进程预取的batch数
+        self.stream = False  # 训练集按块流式读取，用于放不进内存的大文件，见data_loader.myStreamDataSet
+        self.stream_chunk_bytes = 1 << 22  # 流式读取每块的字节数
+        self.stream_buffer = 64  # 流式读取时每个加载进程的打乱缓冲区组数，即同时在内存中的组数上限
+        self.augment = False  # 训练batch做数据增强，见data_loader.BatchAugment；开启后按下面三项抖动、镜像、抽帧
+        self.augment_jitter = 0.1  # 输入位置高斯抖动的标准差(米)
+        self.augment_mirror = 0.5  # 每组关于1、5号车道中线横向镜像的概率
+        self.augment_time_scales = [1, 1, 2]  # 每个batch从中随机选一个抽帧间隔
         self.long_term = False
+        self.window = None  # 训练集每组按window帧滑动切出多个样本，None时每组一个样本，见myDataSet.buildWindows
+        self.window_stride = 1  # 相邻窗口起点间隔的帧数
         self.load_model = 0
         self.pretrained_model = "./log/2020-12-28-09-32/net.pkl"
         self.save_model = 1
@@ -65,6 +95,8 @@ class train_conf(object):
         self.input_size = 9
         self.output_size = 5
         self.dropout_par = 0.4
+        self.social_pooling = "dense"  # social_tensor_conv1的计算方式，sparse只算有车格子，参数与dense通用
+        self.skip_isolated = True  # 没有邻车的车辆不经过social分支的卷积，每轮训练后打印跳过的比例
         self.epoches = 1
         self.learning_rate = 0.002
         self.optimizer = "Adagrad"
@@ -151,28 +151,55 @@ class visualize(object):
 #        loss[index] = num * max(1 / (index + 1), 0.2)  # [1,1/2,1/3,1/4,1/5,1/5,...]
 #    return loss.sum() / loss.shape[0]
 
-def lossCaculate(pred, true, conf):
+def lossCaculate(pred, true, conf, mask=None, offsets=None):
     '''
 
     :param pred: tensor(seq_length,vehicle_num,output_size=5)
     :param true: tensor(seq_length,vehicle_num,output_size=2)
     :param conf: 长时预测标志，RMSE标志
+    :param mask: 补齐成batch时的有效车辆tensor(batch,vehicle_num)，None为单组数据
+    :param offsets: 拼接成batch时各组车辆的起点tensor(batch+1,)，见data_loader.collatePacked
     :return: 每帧的损失值 tensor(seq_length,1)
     '''
 #    loss = Gaussian2DLikelihood(pred=pred, true=true, long_term=conf.long_term)
 #    if conf.add_RMSE:
-    loss = RMSE(pred=pred, true=true, long_term=conf.long_term)
+    loss = RMSE(pred=pred, true=true, long_term=conf.long_term, mask=mask, offsets=offsets)
 
 #        loss = loss + RMSE(pred=pred, true=true, long_term=conf.long_term)
 #    for index, num in enumerate(loss):
 #        loss[index] = num * max(1 / (index + 1), 0.2)  # [1,1/2,1/3,1/4,1/5,1/5,...]
     return loss.sum()
-def Gaussian2DLikelihood(pred, true, long_term):
+def maskedSum(loss, mask):
+    '''
+    补齐成batch时按组对有效车辆求和，之后除以mask.sum(axis=1)即为每组的车辆平均
+    :param loss: tensor(seq_length,batch*vehicle_num,...)
+    :param mask: tensor(batch,vehicle_num) bool
+    :return: tensor(seq_length,batch,...)
+    '''
+    loss = loss.reshape(loss.shape[:1] + mask.shape + loss.shape[2:])
+    return (loss * mask.reshape(mask.shape + (1,) * (loss.dim() - 3))).sum(axis=2)
+
+
+def packedSum(loss, offsets):
+    '''
+    拼接成batch时按组对车辆求和，之后除以offsets.diff()即为每组的车辆平均
+    :param loss: tensor(seq_length,车辆总数,...)
+    :param offsets: tensor(batch+1,) 第b组的车辆为[offsets[b],offsets[b+1])
+    :return: tensor(seq_length,batch,...)
+    '''
+    offsets = torch.as_tensor(offsets, device=loss.device)
+    scene = torch.repeat_interleave(torch.arange(len(offsets) - 1, device=loss.device), offsets.diff())
+    return loss.new_zeros(loss.shape[:1] + (len(offsets) - 1,) + loss.shape[2:]).index_add_(1, scene, loss)
+
+
+def Gaussian2DLikelihood(pred, true, long_term, mask=None, offsets=None):
     '''
     params:
     outputs : tensor(seq_length,vehicle_num,output_size=5)
     targets : tensor(seq_length,vehicle_num,output_size=2)
     long_term:长时预测标志
+    mask: 补齐成batch时的有效车辆tensor(batch,vehicle_num)，None为单组数据
+    offsets: 拼接成batch时各组车辆的起点tensor(batch+1,)
     return: 每帧的损失值 tensor(seq_length,1)
     '''
     # 提取五个[seq_length,vehicle_num=26,1]
@@ -199,15 +226,21 @@ def Gaussian2DLikelihood(pred, true, long_term):
     epsilon = 1e-20
     result = -torch.log(torch.clamp(result, min=epsilon))  # tensor[seq_length,vehicle_num]
 
+    if mask is not None:  # 每组对有效车辆求平均，再对各组求平均
+        return (maskedSum(result, mask) / mask.sum(axis=1)).mean(axis=1)
+    if offsets is not None:
+        return (packedSum(result, offsets) / torch.as_tensor(offsets, device=result.device).diff()).mean(axis=1)
     loss = result.sum(axis=1) / pred.shape[1]
     return loss
 
 
-def RMSE(pred, true, long_term):
+def RMSE(pred, true, long_term, mask=None, offsets=None):
     '''
     :param pred: 预测结果 tensor(seq_length,vehicle_num,vec=5)
     :param true: 真实结果 tensor(seq_length,vehicle_num,vec=2)
     :param long_term: 是否长时损失
+    :param mask: 补齐成batch时的有效车辆tensor(batch,vehicle_num)，None为单组数据
+    :param offsets: 拼接成batch时各组车辆的起点tensor(batch+1,)，与mask一样每组求平均再对各组求平均
     :return: 每帧的损失值 tensor(seq_length,1)
     '''
     if not long_term:
@@ -215,6 +248,12 @@ def RMSE(pred, true, long_term):
         true = true[2:, :, :]
     RMSE_loss = torch.nn.MSELoss(reduce=False, size_average=True)
 
+    if mask is not None:  # 每组对有效车辆求平均，再对各组求平均，只有一组时与下面逐位一致
+        loss = maskedSum(RMSE_loss(pred[:, :, :2], true), mask) * torch.tensor([2, 1], device=pred.device)
+        return (loss.sum(axis=2) / mask.sum(axis=1)).mean(axis=1)
+    if offsets is not None:
+        loss = packedSum(RMSE_loss(pred[:, :, :2], true), offsets) * torch.tensor([2, 1], device=pred.device)
+        return (loss.sum(axis=2) / torch.as_tensor(offsets, device=pred.device).diff()).mean(axis=1)
     loss = RMSE_loss(pred[:, :, :2], true).sum(axis=1)
     loss=loss*torch.tensor([2,1],device=pred.device)
     loss = loss.sum(axis=1) / pred.shape[1]
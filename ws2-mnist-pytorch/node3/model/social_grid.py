@@ -0,0 +1,34 @@
+from typing import Optional
+
+import torch
+
+
+def pairwiseGrid(local_x, local_y, valid: Optional[torch.Tensor], grids_width: int, grids_height: int,
+                 meter_per_grid: float):
+    '''
+    myDataSet.getGridTensor和StatelessVPTLSTM共用的grids计算，不依赖数据集对象，可以被torch.jit.script
+    :param local_x, local_y: tensor(frames,vehicle_num)
+    :param valid: tensor(frames,vehicle_num) bool 有效车辆，None为全部有效
+    :return: tensor(K,5) long，每行(frame,target,row,col,neighbor)，按frame、target有序
+    '''
+    center_width, center_height = grids_width // 2, grids_height // 2
+    vehicle_num = local_x.shape[1]
+
+    # 向0截断后|trunc(d)|<=c即|d|<c+1，先在浮点上筛出格子窗口内的车对，只对这些车对取整
+    width_dist = (local_x[:, None, :] - local_x[:, :, None]) / meter_per_grid
+    height_dist = (local_y[:, None, :] - local_y[:, :, None]) / meter_per_grid
+    inside = (width_dist.abs() < center_width + 1) & (height_dist.abs() < center_height + 1)
+    inside.diagonal(dim1=1, dim2=2).fill_(False)
+    if valid is not None:
+        inside &= valid[:, :, None] & valid[:, None, :]
+    frame, target, neighbor = torch.nonzero(inside).unbind(1)
+    row = center_height - torch.trunc(height_dist[frame, target, neighbor]).long()
+    col = center_width + torch.trunc(width_dist[frame, target, neighbor]).long()
+
+    # nonzero按(frame,target,neighbor)有序，稳定排序后每格最后一个即序号最大的邻车，与getGrid一致
+    cell = ((frame * vehicle_num + target) * grids_height + row) * grids_width + col
+    cell, order = torch.sort(cell, stable=True)
+    last = torch.ones_like(cell, dtype=torch.bool)
+    last[:-1] = cell[1:] != cell[:-1]
+    order = order[last]
+    return torch.stack([frame[order], target[order], row[order], col[order], neighbor[order]], dim=1)